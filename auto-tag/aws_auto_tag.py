@@ -1,5 +1,5 @@
-import json, boto3, datetime, os, base64, ast, sys
-from botocore.exceptions import ClientError
+import json, datetime, os, re, threading, time
+import aws_clients, aws_executor, api_accounting, tracing, emf_metrics, sqs_consumer, platform_resolver, patch_group, idempotency, backfill, digest, kv_store, identity_cache, secret_cache, directory_index, ldap_lookup
 
 # global variables used for email and slack
 URL = os.environ.get("sqs_url")
@@ -9,6 +9,22 @@ CHANNEL = os.environ.get("slack_channel")
 CHANNEL_ID = os.environ.get("slack_channel_id")
 MODE = ""
 
+# Metrics flushed as CloudWatch EMF documents at the end of each invocation
+METRICS = emf_metrics.MetricsLogger("aws_auto_tag")
+
+# describe_instances takes up to 1000 instance ids per call
+DESCRIBE_CHUNK = 1000
+INSTANCE_ID = re.compile(r'i-[0-9a-f]+')
+INSTANCE_NOT_FOUND = ('InvalidInstanceID.NotFound', 'InvalidInstanceID.Malformed')
+
+# create_tags takes up to 1000 resources, AWS recommends smaller batches
+TAG_CHUNK = 500
+
+# Auto Scaling groups: instances looked up per call, tags written per call and the tags set on the group
+ASG_CHUNK = 50
+GROUP_TAG = 'aws:autoscaling:groupName'
+GROUP_TAGS = ('Expiration', 'Creator ID', 'Patch Group')
+
 
 def lambda_handler(event, context):
     """
@@ -17,86 +33,677 @@ def lambda_handler(event, context):
     :param context: runtime information of type LambdaContext
     :return: codes indicating success or failure
     """
+
+    tracing.TRACER.reset()
+    METRICS.reset()
+    started = time.time()
+    try:
+        with tracing.profiled(tracing.profile_mode(event)):
+            return run_auto_tag(event, context)
+    finally:
+        METRICS.rate('receive', 'MessagesProcessedPerSecond', METRICS.total('receive', 'MessagesReceived'), time.time() - started)
+        METRICS.success_rate('notify', 'NotificationsSent', 'NotificationFailures', 'NotificationSuccessRate')
+        METRICS.flush()
+
+
+def run_auto_tag(event, context):
+    """
+    # Drains the launch queue: receive, describe and tag each instance, then notify owners.
+    # When invoked by the SQS event source the records of the event are processed
+    # instead and the records that failed are reported back in batchItemFailures.
+    # An event with "backfill": true tags existing resources instead, see run_backfill
+    :param event: event data in the form of a dict
+    :param context: runtime information of type LambdaContext
+    :return: codes indicating success or failure
+    """
+    global MODE
     MODE = os.environ.get('mode')
     if not MODE:
         MODE = 'audit'
 
     print("Operating in " + MODE + " mode")
-    sqs_client = boto3.client('sqs')
-
-    # keep looping until no more messages
-    missingOwners = {}
-    missingPatches = {}
-    while True:
-        sqs_response = sqs_client.receive_message(
-            QueueUrl = URL,
-            AttributeNames=['ApproximateNumberOfMessages'],
-            MaxNumberOfMessages= 10,
-            MessageAttributeNames=['instance-launch-info']
+    accountant = api_accounting.install()
+    accountant.reset()
+
+    if isinstance(event, dict) and event.get('backfill'):
+        return run_backfill(context, accountant)
+
+    findings = Findings()
+    batch_item_failures = None
+    if isinstance(event, dict) and event.get('Records'):
+        # invoked by the SQS event source, Lambda deletes every record not reported as failed
+        records = event['Records']
+        batch_item_failures = sqs_consumer.process_records(records,
+            lambda messages: process_batch(messages, findings),
+            workers=int(os.environ.get("sqs_workers") or 4)
         )
-        if 'Messages' in sqs_response:
-            for message in sqs_response['Messages']:
-                canDelete = False
-                instance_detail = json.loads(message['Body'])['detail']
-                nt_id = instance_detail['userIdentity']['principalId'].split(':')[1]
-                if instance_detail['responseElements'] != None:
-                    instances = instance_detail['responseElements']['instancesSet']['items']
-
-                    for instance in instances:
-                        instance_id = instance['instanceId']
-                        ec2client = boto3.client("ec2")
-                        response = ec2client.describe_instances(InstanceIds=[instance_id])
-
-                        if response["Reservations"] and response["Reservations"][0]["Instances"]:
-                            instValid, item1, item2 = checkTags(instance_id, 
-                                    response["Reservations"][0]['Instances'][0]['Tags'], nt_id,)
-
-                            if item1:
-                                if nt_id in missingOwners:
-                                    missingOwners[nt_id].append(item1)
-                                else:
-                                    missingOwners[nt_id] = [item1]
-                            if item2:
-                                if nt_id in missingPatches:
-                                    missingPatches[nt_id].append(item2)
-                                else:
-                                    missingPatches[nt_id] = [item2]
-
-                            canDelete = canDelete and instValid
-                else:
-                    canDelete = True
-                if canDelete:
-                    sqs_client.delete_message(
-                        QueueUrl= URL,
-                        ReceiptHandle= message['ReceiptHandle']
-                    )
-                    print("Deleted queue message")
-        else:
-            print("No more messages found in the queue")
-            break
+        queue_stats = {'received': len(records), 'failed': len(batch_item_failures)}
+    else:
+        # receivers and workers drain the queue in parallel until it comes back empty
+        consumer = sqs_consumer.SqsConsumer.from_environment(aws_clients.get_client('sqs'), URL,
+            lambda messages: process_batch(messages, findings),
+            deadline=get_deadline(context),
+            attribute_names=['ApproximateNumberOfMessages'],
+            message_attribute_names=['instance-launch-info']
+        )
+        queue_stats = consumer.run()
+    print("Queue consumer: " + json.dumps(queue_stats))
 
-    for user in missingOwners:
-            notify(user, str(missingOwners[user]), "is missing Owning_Mail or Owning_Team tags", 
-                    "Please add these tags to your resources.", "Missing Owner Tags", "Alert: Missing Owner tags!")
-    
-    for user in missingPatches:
-            notify(user, str(missingPatches[user]), "has an invalid Patch Group tag. These resources will receive the latest patches",
-                    "If you do not need the latest patches, please fix these tags", "Invalid Patch Tags", "Error: Invalid patch tags!")        
+    notify_owners(findings)
+
+    print("API executor metrics: " + json.dumps(aws_executor.get_executor().metrics()))
+    print("Secret cache: " + json.dumps(secret_cache.get_cache().stats()))
+
+    print(accountant.format_table())
+    response = {
+        "statusCode": 200,
+        "body": json.dumps('Tagged resources'),
+        "queue": queue_stats,
+        "api_calls": accountant.summary(),
+        "stages": tracing.TRACER.summary()
+    }
+    if batch_item_failures is not None:
+        response["batchItemFailures"] = batch_item_failures
+    return response
+
+
+def run_backfill(context, accountant):
+    """
+    # Tags the instances, AMIs and Auto Scaling groups that existed before auto-tag,
+    # continuing from the checkpoint of the previous backfill invocation
+    :param context: runtime information of type LambdaContext
+    :param accountant: api_accounting accountant of the invocation
+    :return: codes indicating success or failure, complete is False until every resource has been seen
+    """
 
+    if not os.environ.get('kv_table'):
+        # the SQLite fallback lives in this container's /tmp, the next invocation would start over
+        err = "Backfill needs kv_table to checkpoint its progress between invocations"
+        print(err)
+        return {
+            "statusCode": 500,
+            "body": json.dumps(err)
+        }
+
+    result = backfill.Backfill.from_environment(backfill_tags, MODE == 'enforce', get_deadline(context)).run()
+    print("Backfill: " + json.dumps(result))
+    METRICS.put('backfill', 'ResourcesScanned', result['scanned'])
+    METRICS.put('backfill', 'ResourcesMissingTags', result['missing'])
+    METRICS.put('backfill', 'ResourcesTagged', result['tagged'])
+
+    print(accountant.format_table())
     return {
         "statusCode": 200,
-        "body": json.dumps('Tagged resources')
+        "body": json.dumps('Backfilled resources'),
+        "backfill": result,
+        "api_calls": accountant.summary(),
+        "stages": tracing.TRACER.summary()
     }
 
 
-def checkTags(instance_id, tagSet, nt_id):
+def backfill_tags(resources):
+    """
+    # works out the missing tags of one page of existing resources with the
+    # checkTags rules. Instances without a valid Patch Group are described and
+    # their platforms resolved for the whole page at once
+    :param resources: ResourceTagMappingList entries from get_resources
+    :return: dict of ARN to the tags to add
+    """
+
+    creator = os.environ.get('backfill_creator') or 'unknown'
+    instances = {}
+    for resource in resources:
+        instance_id = backfill.instance_id(resource['ResourceARN'])
+        if instance_id:
+            instances[instance_id] = {'Tags': resource.get('Tags', [])}
+
+    needed = set(missingPatchGroups(instances))
+    described = describe_instances(list(needed)) if needed else {}
+    platforms = platform_resolver.PlatformResolver(described)
+    platforms.prefetch(list(described))
+
+    missing = {}
+    for resource in resources:
+        instance_id = backfill.instance_id(resource['ResourceARN'])
+        platform = None
+        if instance_id:
+            if instance_id in needed and instance_id not in described:
+                # terminated since it was listed
+                continue
+            platform = lambda instance_id=instance_id: platforms.platform_name(instance_id)
+        tags, _, _ = compute_missing_tags(resource.get('Tags', []), creator, platform)
+        if tags:
+            missing[resource['ResourceARN']] = tags
+    return missing
+
+
+def get_deadline(context):
+    """
+    # time after which no new messages are received, leaving room to finish in-flight batches and notify
+    :param context: runtime information of type LambdaContext, None when run outside Lambda
+    :return: time.time() deadline or None for no limit
+    """
+
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000.0
+    return time.time() + remaining - min(60.0, remaining / 4.0)
+
+
+class Findings(object):
+    """
+    # Instances missing owner tags or with invalid patch tags, grouped by the
+    # launching user and collected from every worker
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.missing_owners = {}
+        self.invalid_patches = {}
+
+    def add(self, nt_id, missing_owner, invalid_patch):
+        """
+        # records the findings for one instance
+        :param nt_id: launching user
+        :param missing_owner: instance id when the owner tags are missing, else empty
+        :param invalid_patch: instance id when the patch tag is invalid, else empty
+        :return: N/A
+        """
+
+        with self.lock:
+            if missing_owner:
+                self.missing_owners.setdefault(nt_id, []).append(missing_owner)
+            if invalid_patch:
+                self.invalid_patches.setdefault(nt_id, []).append(invalid_patch)
+
+
+def process_batch(messages, findings):
+    """
+    # processes one receive batch, a failing message does not stop the others
+    :param messages: SQS messages
+    :param findings: Findings shared by the workers
+    :return: MessageIds of the messages that can be deleted
+    """
+
+    METRICS.put('receive', 'MessagesReceived', len(messages))
+    launches = []
+    for message in messages:
+        try:
+            launches.append((message, parse_launch(message)))
+        except Exception as e:
+            print("Error parsing message " + message['MessageId'] + ": " + str(e))
+
+    # instances of redelivered or duplicate events were already handled, skip them without any API calls
+    ledger = idempotency.get_ledger()
+    try:
+        done = ledger.done([(launch['event_id'], launch['instance_ids']) for _, launch in launches if launch])
+    except Exception as e:
+        print("Error reading the idempotency ledger: " + str(e))
+        done = set()
+    if done:
+        METRICS.put('receive', 'DuplicateInstancesSkipped', len(done))
+        for _, launch in launches:
+            if launch:
+                launch['instance_ids'] = [instance_id for instance_id in launch['instance_ids']
+                                          if ledger.key(launch['event_id'], instance_id) not in done]
+
+    # instances launched by an Auto Scaling group are checked once per group and window,
+    # the other launches of a claimed group are tagged from the group. Audit mode writes
+    # no tags, so it takes no claims
+    from_event = {}
+    for _, launch in launches:
+        if launch and launch['instances'] is not None:
+            for instance_id in launch['instance_ids']:
+                from_event[instance_id] = launch['instances'][instance_id]
+    group_sources = {}
+    window = int(os.environ.get('asg_suppress_seconds') or 900)
+    if window > 0 and MODE == 'enforce':
+        try:
+            group_sources = claim_groups(launches, from_event, ledger, window)
+        except Exception as e:
+            print("Error finding Auto Scaling groups: " + str(e))
+
+    # launches whose event carries the tags are checked from the event, the rest in one describe stage
+    instance_ids = []
+    for _, launch in launches:
+        if launch and launch['instances'] is None:
+            instance_ids += launch['instance_ids']
+    if from_event:
+        METRICS.put('describe', 'InstancesFromEvent', len(from_event))
+    try:
+        described = describe_instances(instance_ids) if instance_ids else {}
+    except Exception as e:
+        print("Error describing instances: " + str(e))
+        release_groups(ledger, group_sources)
+        return []
+    for instance_id, instance in from_event.items():
+        described.setdefault(instance_id, instance)
+
+    # one platform lookup stage for every instance that will need a patch group
+    active = dict((instance_id, described[instance_id]) for _, launch in launches if launch
+                  for instance_id in launch['instance_ids'] if instance_id in described)
+    platforms = platform_resolver.PlatformResolver(active)
+    with tracing.span('platform'):
+        platforms.prefetch(missingPatchGroups(active))
+
+    # one check stage for the batch, not a span per instance
+    pending_tags = {}
+    processed = []
+    with tracing.span('tag', instances=len(active)):
+        for message, launch in launches:
+            try:
+                if process_message(launch, described, findings, pending_tags, platforms):
+                    processed.append((message, launch))
+            except Exception as e:
+                print("Error processing message " + message['MessageId'] + ": " + str(e))
+
+    # instances of a group claimed earlier are not checked, they get the group's tags in the same write
+    suppressed = dict(item for _, launch in launches if launch for item in launch['suppressed'].items())
+    untagged_groups = set()
+    if suppressed:
+        try:
+            untagged_groups = tags_from_groups(suppressed, pending_tags)
+        except Exception as e:
+            print("Error reading Auto Scaling group tags: " + str(e))
+            untagged_groups = set(suppressed)
+
+    # one tag write stage for every instance in the batch
+    try:
+        results = write_tags(pending_tags)
+    except Exception as e:
+        print("Error writing tags: " + str(e))
+        release_groups(ledger, group_sources)
+        return []
+
+    # later launches of a claimed group get the same tags from the group itself
+    if group_sources:
+        failed_groups = list(group_sources)
+        try:
+            failed_groups = tag_groups(group_sources, described, pending_tags)
+        except Exception as e:
+            print("Error tagging Auto Scaling groups: " + str(e))
+        release_groups(ledger, failed_groups)
+
+    # fully processed messages are acknowledged whatever the mode or tag findings. Launches
+    # whose group was not tagged yet stay in the queue until the claiming invocation has tagged it
+    acknowledged = []
+    finished = []
+    for message, launch in processed:
+        if launch:
+            launched = launch['instance_ids'] + list(launch['suppressed'])
+            if any(results.get(instance_id) == 'failed' or instance_id in untagged_groups for instance_id in launched):
+                continue
+            finished.append((launch['event_id'], launched))
+        acknowledged.append(message['MessageId'])
+
+    try:
+        ledger.record(finished)
+    except Exception as e:
+        print("Error writing the idempotency ledger: " + str(e))
+    return acknowledged
+
+
+def parse_launch(message):
+    """
+    # reads the launching user and instance ids out of a RunInstances event
+    :param message: SQS message whose body is the CloudTrail event
+    :return: dict with event_id, autoscaling, nt_id, instance_ids, instances and suppressed, None when the launch failed and has no instances
+    """
+
+    instance_detail = json.loads(message['Body'])['detail']
+    if instance_detail['responseElements'] == None:
+        return None
+
+    identity = instance_detail['userIdentity']
+    return {
+        'event_id': instance_detail.get('eventID') or message['MessageId'],
+        'autoscaling': identity.get('invokedBy') == 'autoscaling.amazonaws.com' or 'AWSServiceRoleForAutoScaling' in (identity.get('arn') or ''),
+        'nt_id': identity['principalId'].split(':')[1],
+        'instance_ids': [instance['instanceId'] for instance in instance_detail['responseElements']['instancesSet']['items']],
+        'instances': event_instances(instance_detail),
+        'suppressed': {},
+    }
+
+
+def event_instances(instance_detail):
+    """
+    # builds the instances of a RunInstances event from the event itself, with the
+    # tags from tagSpecificationSet and each item's tagSet, so they need no describe
+    :param instance_detail: detail of the CloudTrail event
+    :return: dict of instance id to instance in the describe_instances shape, None when the event is truncated or missing fields
+    """
+
+    request = instance_detail.get('requestParameters')
+    items = ((instance_detail.get('responseElements') or {}).get('instancesSet') or {}).get('items')
+    if not isinstance(request, dict) or not items:
+        return None
+
+    # tags requested for every instance of the launch
+    launch_tags = {}
+    for specification in (request.get('tagSpecificationSet') or {}).get('items', []):
+        if specification.get('resourceType') == 'instance':
+            for tag in specification.get('tags', []):
+                launch_tags[tag['key']] = tag['value']
+
+    instances = {}
+    for item in items:
+        if not item.get('instanceId') or not item.get('imageId'):
+            return None
+        tags = dict(launch_tags)
+        for tag in (item.get('tagSet') or {}).get('items', []):
+            tags[tag['key']] = tag['value']
+        instance = {
+            'InstanceId': item['instanceId'],
+            'ImageId': item['imageId'],
+            'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()],
+        }
+        if item.get('platform'):
+            instance['Platform'] = item['platform']
+        instances[item['instanceId']] = instance
+    return instances
+
+
+def claim_groups(launches, from_event, ledger, window):
+    """
+    # finds the launches made by an Auto Scaling group and claims each group for
+    # the window, before anything is described. Launches of a claimed group are
+    # processed as usual and their group is tagged afterwards. Launches of a group
+    # claimed earlier are moved from instance_ids to suppressed, they are tagged
+    # from the group without being described, validated or notified about
+    :param launches: list of (message, parse_launch result)
+    :param from_event: dict of instance id to instance built from the launch events
+    :param ledger: idempotency Ledger holding the claims
+    :param window: seconds per instance processing stays suppressed after a group is claimed
+    :return: dict of claimed group name to its instances in this batch, the tags are taken from one of them
+    """
+
+    # the group tag is on the instance when the event carries it, autoscaling launches without it are looked up
+    groups = {}
+    lookup = []
+    for _, launch in launches:
+        if not launch:
+            continue
+        for instance_id in launch['instance_ids']:
+            tags = from_event.get(instance_id, {}).get('Tags', [])
+            name = next((tag['Value'] for tag in tags if tag['Key'] == GROUP_TAG), None)
+            if name:
+                groups[instance_id] = name
+            elif launch['autoscaling']:
+                lookup.append(instance_id)
+    if lookup:
+        groups.update(find_groups(lookup))
+
+    claims = {}
+    sources = {}
+    suppressed = 0
+    for _, launch in launches:
+        if not launch:
+            continue
+        remaining = []
+        for instance_id in launch['instance_ids']:
+            name = groups.get(instance_id)
+            if name is None:
+                remaining.append(instance_id)
+                continue
+            if name not in claims:
+                claims[name] = ledger.claim_group(name, window)
+            if claims[name]:
+                sources.setdefault(name, []).append(instance_id)
+                remaining.append(instance_id)
+            else:
+                launch['suppressed'][instance_id] = name
+                suppressed += 1
+        launch['instance_ids'] = remaining
+
+    if suppressed:
+        METRICS.put('tag', 'AsgInstancesSuppressed', suppressed)
+    return sources
+
+
+def release_groups(ledger, names):
+    """
+    # gives claims back, so the next launch of those groups is processed again
+    :param ledger: idempotency Ledger holding the claims
+    :param names: group names
+    :return: N/A
+    """
+
+    for group_name in names:
+        try:
+            ledger.release_group(group_name)
+        except Exception as e:
+            print("Error releasing Auto Scaling group " + group_name + ": " + str(e))
+
+
+def find_groups(instance_ids):
+    """
+    # looks up the Auto Scaling group of instances whose tags do not name it
+    :param instance_ids: instance ids
+    :return: dict of instance id to group name for the instances in a group
+    """
+
+    groups = {}
+    client = aws_clients.get_client('autoscaling')
+    for start in range(0, len(instance_ids), ASG_CHUNK):
+        chunk = instance_ids[start:start + ASG_CHUNK]
+        for page in aws_executor.paginate(client, 'describe_auto_scaling_instances', InstanceIds=chunk, MaxRecords=ASG_CHUNK):
+            for instance in page.get('AutoScalingInstances', []):
+                groups[instance['InstanceId']] = instance['AutoScalingGroupName']
+    return groups
+
+
+def tag_groups(sources, described, pending_tags):
+    """
+    # sets the Expiration, Creator ID and Patch Group of one instance on its whole
+    # Auto Scaling group with PropagateAtLaunch, so later instances launch with them.
+    # Tags the group already propagates are kept unless the Patch Group is invalid
+    :param sources: dict of group name to its instances, the first described one is the source
+    :param described: dict of instance id to instance
+    :param pending_tags: dict of instance id to the tags written for it in this batch
+    :return: names of the groups whose tags could not be written, or that were left without an
+             Expiration because none of their instances was described
+    """
+
+    client = aws_clients.get_client('autoscaling')
+    current = group_tags(list(sources))
+
+    writes = []
+    failed = set()
+    for name, instance_ids in sources.items():
+        if name not in current:
+            # deleted since the launch
+            continue
+        instance_id = next((instance_id for instance_id in instance_ids if instance_id in described), None)
+        if instance_id is None:
+            # nothing to take the tags from, the claim is given back so the launches are retried
+            failed.add(name)
+            continue
+        values = dict((tag['Key'], tag['Value']) for tag in described[instance_id].get('Tags', []))
+        values.update((tag['Key'], tag['Value']) for tag in pending_tags.get(instance_id, []))
+        first = len(writes)
+        for key in GROUP_TAGS:
+            value = values.get(key)
+            if not value or value == 'Not yet populated':
+                continue
+            tag = current[name].get(key)
+            if tag and tag.get('PropagateAtLaunch') and (key != 'Patch Group' or patch_group.get_validator().is_valid(tag['Value'])):
+                continue
+            writes.append({
+                'ResourceId': name,
+                'ResourceType': 'auto-scaling-group',
+                'Key': key,
+                'Value': value,
+                'PropagateAtLaunch': True
+            })
+        if 'Expiration' not in current[name] and not any(tag['Key'] == 'Expiration' for tag in writes[first:]):
+            # launches suppressed by the claim wait for an Expiration the group would never get
+            failed.add(name)
+
+    for start in range(0, len(writes), ASG_CHUNK):
+        chunk = writes[start:start + ASG_CHUNK]
+        try:
+            with tracing.span('group_tag_write', tags=len(chunk)):
+                aws_executor.call(client, 'create_or_update_tags', Tags=chunk)
+        except Exception as e:
+            print("Error tagging Auto Scaling groups: " + str(e))
+            failed.update(tag['ResourceId'] for tag in chunk)
+    METRICS.put('tag', 'AsgGroupsTagged', len(set(tag['ResourceId'] for tag in writes) - failed))
+    return list(failed)
+
+
+def group_tags(names):
+    """
+    # reads the tags of Auto Scaling groups
+    :param names: group names
+    :return: dict of group name to dict of tag key to tag, groups that no longer exist are left out
+    """
+
+    client = aws_clients.get_client('autoscaling')
+    names = list(names)
+    current = {}
+    for start in range(0, len(names), ASG_CHUNK):
+        for page in aws_executor.paginate(client, 'describe_auto_scaling_groups',
+                                          AutoScalingGroupNames=names[start:start + ASG_CHUNK], MaxRecords=ASG_CHUNK):
+            for group in page.get('AutoScalingGroups', []):
+                current[group['AutoScalingGroupName']] = dict((tag['Key'], tag) for tag in group.get('Tags', []))
+    return current
+
+
+def tags_from_groups(suppressed, pending_tags):
+    """
+    # adds the Expiration, Creator ID and Patch Group of their group to the pending tags of suppressed
+    # instances. PropagateAtLaunch only covers instances launched after the group was tagged, so the
+    # ones already running when it was claimed are tagged here
+    :param suppressed: dict of instance id to group name
+    :param pending_tags: dict collecting the tags to write for the batch
+    :return: set of the instance ids whose group carries no Expiration yet
+    """
+
+    current = group_tags(set(suppressed.values()))
+    untagged = set()
+    for instance_id, name in suppressed.items():
+        tags = current.get(name, {})
+        if 'Expiration' not in tags:
+            # the claiming invocation has not tagged the group yet
+            untagged.add(instance_id)
+            continue
+        pending_tags[instance_id] = [{'Key': key, 'Value': tags[key]['Value']} for key in GROUP_TAGS if key in tags]
+    return untagged
+
+
+def describe_instances(instance_ids):
+    """
+    # describes many instances with as few calls as possible. Ids that no longer
+    # exist are taken out of the error message and the call is retried without them
+    :param instance_ids: instance ids, duplicates are described once
+    :return: dict of instance id to instance, terminated instances are left out
+    """
+    from botocore.exceptions import ClientError
+
+    pending = list(dict.fromkeys(instance_ids))
+    described = {}
+    client = aws_clients.get_client('ec2')
+    for start in range(0, len(pending), DESCRIBE_CHUNK):
+        chunk = pending[start:start + DESCRIBE_CHUNK]
+        while chunk:
+            try:
+                with tracing.span('describe', instances=len(chunk)) as span:
+                    response = aws_executor.call(client, 'describe_instances', InstanceIds=chunk)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in INSTANCE_NOT_FOUND:
+                    raise
+                missing = set(INSTANCE_ID.findall(e.response['Error'].get('Message', ''))) & set(chunk)
+                if not missing:
+                    raise
+                METRICS.put('describe', 'InstancesNotFound', len(missing))
+                chunk = [instance_id for instance_id in chunk if instance_id not in missing]
+                continue
+
+            METRICS.put('describe', 'DescribeLatency', span['wall_ms'], 'Milliseconds')
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    described[instance['InstanceId']] = instance
+            break
+
+    METRICS.put('describe', 'InstancesDescribed', len(described))
+    return described
+
+
+def process_message(launch, described, findings, pending_tags, platforms):
+    """
+    # checks the tags of every instance launched in one RunInstances event
+    :param launch: result of parse_launch
+    :param described: dict of instance id to instance from describe_instances
+    :param findings: Findings shared by the workers
+    :param pending_tags: dict collecting the tags to write for the batch
+    :param platforms: PlatformResolver prefetched for the batch
+    :return: True once every instance has been checked
+    """
+
+    if launch is None:
+        return True
+
+    nt_id = launch['nt_id']
+    checked = missing_owners = invalid_patches = 0
+    for instance_id in launch['instance_ids']:
+        instance = described.get(instance_id)
+        if instance is None:
+            # terminated before it could be described, nothing left to tag
+            continue
+
+        _, item1, item2 = checkTags(instance_id, instance.get('Tags', []), nt_id, pending_tags, platforms)
+        checked += 1
+        missing_owners += 1 if item1 else 0
+        invalid_patches += 1 if item2 else 0
+        findings.add(nt_id, item1, item2)
+
+    METRICS.put('tag', 'InstancesChecked', checked)
+    METRICS.put('tag', 'MissingOwnerTags', missing_owners)
+    METRICS.put('tag', 'InvalidPatchTags', invalid_patches)
+    return True
+
+
+def checkTags(instance_id, tagSet, nt_id, pending_tags=None, platforms=None):
     """
     # Checks for tags and adds them if they are not present
+    :param instance_id: the id of the instance
+    :param tagSet: the instance's current tags
+    :param nt_id: the launching user
+    :param pending_tags: dict collecting the tags to write later with write_tags, None to write them now
+    :param platforms: PlatformResolver prefetched for the batch, None to look platforms up one by one
+    :return: (valid, instance id if owner tags are missing, instance id if the patch tag is invalid)
     """
-    tags = []
-    missingOwnersItem = ""
+    tags, missingOwners, invalidPatch = compute_missing_tags(tagSet, nt_id,
+        lambda: instancePlatform(instance_id, platforms))
+
+    missingOwnersItem = instance_id if missingOwners else ""
     missingPatchesItem = ""
     patch_name = ""
+    if invalidPatch:
+        print("invalid patch tags!")
+        missingPatchesItem = instance_id
+        patch_name = next(tag['Value'] for tag in tags if tag['Key'] == 'Patch Group')
+
+    print("Attaching tags: " + str(tags) + " to instance " + instance_id)
+    if MODE == 'enforce':
+        if pending_tags is None:
+            attachInstanceTags(instance_id, tags)
+        else:
+            pending_tags[instance_id] = tags
+    
+    instValid = MODE == "enforce" and patch_name != "Not yet populated" and not missingOwners
+    return instValid, missingOwnersItem, missingPatchesItem
+
+
+def compute_missing_tags(tagSet, nt_id, platform=None):
+    """
+    # works out the tags a resource is missing with the checkTags rules, without any API calls
+    :param tagSet: the resource's current tags
+    :param nt_id: value for a missing Creator ID tag
+    :param platform: function returning the resource's platform name, called only when a Patch Group is needed. None for resources that are not patched EX) AMIs
+    :return: (tags to add, True if owner tags are missing, True if the patch tag is missing or invalid)
+    """
+    tags = []
     isPatchTag = False
     isExpiration = False
     isCreatorID = False
@@ -131,25 +738,29 @@ def checkTags(instance_id, tagSet, nt_id):
             'Value': nt_id
         })
 
-    if not isOwnerTeamTag or not isOwnerMailTag:
-        missingOwnersItem = instance_id
+    invalidPatch = platform is not None and not isPatchTag
+    if invalidPatch:
+        tags.append(
+        {
+            'Key': 'Patch Group',
+            'Value': defaultPatchGroup(platform())
+        })
 
-    if not isPatchTag:
-        print("invalid patch tags!")
-        missingPatchesItem = instance_id
+    return tags, not isOwnerTeamTag or not isOwnerMailTag, invalidPatch
 
-        patch_name = createPatchTag(tags, instance_id, nt_id)
-        tags.append({ 'Patch Group' :  patch_name })
 
-    print("Attaching tags: " + str(tags) + " to instance " + instance_id)
-    if MODE == 'enforce':
-        attachInstanceTags(instance_id, tags)
-    
-    if MODE == "enforce" and patch_name != "Not yet populated" and isOwnerMailTag and isOwnerTeamTag:
-        return True
-    
-    return False, missingOwnersItem, missingPatchesItem
+def missingPatchGroups(described):
+    """
+    # finds the instances without a valid Patch Group tag, validating the batch's values in one pass
+    :param described: dict of instance id to instance from describe_instances
+    :return: list of instance ids
+    """
 
+    values = {}
+    for instance_id, instance in described.items():
+        values[instance_id] = [tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Patch Group']
+    results = patch_group.get_validator().validate([value for found in values.values() for value in found])
+    return [instance_id for instance_id, found in values.items() if not any(results[value] is None for value in found)]
 
 
 def checkPatchValidity(val):
@@ -159,39 +770,25 @@ def checkPatchValidity(val):
     :return: boolean if valid or not
     """
 
-    tag_list = val.split('-')
-    if len(tag_list) < 5:
-        return False
-
-    if tag_list[0] not in os.environ.get('environment'):
-        return False
-
-    if tag_list[1] not in os.environ.get('platform'):
-        return False
-
-    if tag_list[2] not in os.environ.get('role'):
-        return False 
-
-    if tag_list[3] not in os.environ.get('urgency'):
-        return False 
-
-    if tag_list[4] not in os.environ.get('order'):
-        return False
+    segment = patch_group.get_validator().failed_segment(val)
+    if segment is not None:
+        print("Patch Group " + val + " has an invalid " + segment)
+    return segment is None
 
-    return True 
 
-
-def createPatchTag(tags, instance_id, nt_id):
+def instancePlatform(instance_id, platforms=None):
     """
-    # creates a patch tag based on platform, filler if platform not found
-    :param tags: the list of tags to add to a resource
-    :param instance_id: the id of the resource
-    :param nt_id: the nt_id owner of a resource
-    :return: The tag value
+    # finds the platform of an instance
+    :param instance_id: the id of the instance
+    :param platforms: PlatformResolver prefetched for the batch, None to look the instance up in SSM
+    :return: platform name EX) Red Hat Enterprise Linux, empty if unknown
     """
 
-    client = boto3.client('ssm')
-    response = client.describe_instance_information(
+    if platforms is not None:
+        return platforms.platform_name(instance_id)
+
+    client = aws_clients.get_client('ssm')
+    response = aws_executor.call(client, 'describe_instance_information',
         InstanceInformationFilterList=[
             {
                 'key': 'InstanceIds',
@@ -199,17 +796,25 @@ def createPatchTag(tags, instance_id, nt_id):
             }
         ]
     )
-    patch_tag_value = ''
-    platform_name = ''
     if (response['InstanceInformationList']):
-        platform_name = response['InstanceInformationList'][0]['PlatformName'] 
+        return response['InstanceInformationList'][0]['PlatformName'] 
+    return ''
+
+
+def defaultPatchGroup(platform_name):
+    """
+    # picks the default patch group for a platform, filler if the platform is not known
+    :param platform_name: platform name EX) Red Hat Enterprise Linux
+    :return: The tag value
+    """
+
     if 'Red Hat Enterprise Linux' in platform_name:
         patch_tag_value = 'default-rhel'
     elif 'Windows' in platform_name:
         patch_tag_value = 'default-windows'
     elif 'Ubuntu' in platform_name:
         patch_tag_value = 'default-ubuntu'
-    elif 'Centos' in platform_name:
+    elif 'centos' in platform_name.lower():
         patch_tag_value = 'default-centos'
     elif 'Amazon Linux 2' in platform_name:
         patch_tag_value = 'default-amazon2'
@@ -229,35 +834,75 @@ def attachInstanceTags(instance_id, tags):
     :param tags: list of tags to add
     :return: boolean value to indicate if the instance exists or not, true if not found!
     """
-    
-    empty = False
-    lambda_client = boto3.client('lambda')
-    data = {
-        'comp_name': "attachInstanceTags", 
-        'action': "attach tags", 
-        'level': "info", 
-        'msg': "attached " + str(tags) + " to instance " + instance_id
-    }     
-    try:
-        client = boto3.client('ec2')
-        response = client.create_tags(
-            Resources=[instance_id],
-            Tags= tags
-        )
-        print("Attached tags to instance")
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
-            print("No such instance exists")
-            empty = True
-        else:
-            print("Error attaching tags to instance: " + str(e))
-    
-    if (not empty):
-        invoke_response = lambda_client.invoke(
-            FunctionName= os.environ.get("notify_snitch"),
-            InvocationType= "RequestResponse",
-            Payload= json.dumps(data)
-        )
+
+    return write_tags({instance_id: tags}).get(instance_id) == 'not_found'
+
+
+def write_tags(pending):
+    """
+    # attaches pending tags with one create_tags call per group of instances getting
+    # exactly the same tags, and notifies snitch once per group
+    :param pending: dict of instance id to the list of tags to add
+    :return: dict of instance id to 'tagged', 'not_found' or 'failed'
+    """
+    from botocore.exceptions import ClientError
+
+    groups = {}
+    for instance_id, tags in pending.items():
+        if tags:
+            key = tuple(sorted((tag['Key'], tag['Value']) for tag in tags))
+            groups.setdefault(key, []).append(instance_id)
+
+    results = {}
+    client = aws_clients.get_client('ec2')
+    # one span for the stage, not one per create_tags call
+    with tracing.span('tag_write', instances=len(pending)):
+        for key, instance_ids in groups.items():
+            tags = [{'Key': tag_key, 'Value': tag_value} for tag_key, tag_value in key]
+            tagged = []
+            for start in range(0, len(instance_ids), TAG_CHUNK):
+                chunk = instance_ids[start:start + TAG_CHUNK]
+                while chunk:
+                    try:
+                        aws_executor.call(client, 'create_tags',
+                            Resources=chunk,
+                            Tags= tags
+                        )
+                    except ClientError as e:
+                        missing = set()
+                        if e.response['Error']['Code'] in INSTANCE_NOT_FOUND:
+                            missing = set(INSTANCE_ID.findall(e.response['Error'].get('Message', ''))) & set(chunk)
+                        if not missing:
+                            print("Error attaching tags to instances: " + str(e))
+                            results.update((instance_id, 'failed') for instance_id in chunk)
+                            break
+                        # create_tags is all or nothing, retry without the instances that are gone
+                        print("No such instances exist: " + str(sorted(missing)))
+                        results.update((instance_id, 'not_found') for instance_id in missing)
+                        chunk = [instance_id for instance_id in chunk if instance_id not in missing]
+                        continue
+
+                    results.update((instance_id, 'tagged') for instance_id in chunk)
+                    tagged += chunk
+                    break
+
+            if tagged:
+                print("Attached tags " + str(tags) + " to " + str(len(tagged)) + " instances")
+                METRICS.put('tag', 'InstancesTagged', len(tagged))
+                lambda_client = aws_clients.get_client('lambda')
+                data = {
+                    'comp_name': "attachInstanceTags", 
+                    'action': "attach tags", 
+                    'level': "info", 
+                    'msg': "attached " + str(tags) + " to instances " + str(tagged)
+                }
+                invoke_response = aws_executor.call(lambda_client, 'invoke',
+                    FunctionName= os.environ.get("notify_snitch"),
+                    InvocationType= "RequestResponse",
+                    Payload= json.dumps(data)
+                )
+
+    return results
 
 
 def create_messages(application, action, remedy):
@@ -289,42 +934,94 @@ def create_messages(application, action, remedy):
     return messages                     
 
 
-def get_email(nt_id):
+def notify_owners(findings):
     """
-    # Retrieves the email from an nt_id
-    :param nt_id: the id to search through
-    :return: email address or None if not found
+    # buffers the findings of this invocation and sends one combined notification
+    # to every owner whose digest_window_seconds window has passed. Without kv_table
+    # nothing is buffered and the findings are sent at once
+    :param findings: Findings of this invocation
+    :return: N/A
     """
 
-    secret = json.loads(get_secret())
-    username = secret['account_name']
-    pw = secret['password']
-    data = {
-                "domain": "corporate.t-mobile.com",
-                "base_dname": "OU=Production,OU=Users,OU=Accounts,DC=Corporate,DC=T-Mobile,DC=com",
-                "bind_dname": "CN=%s,OU=LDAPS,OU=Non-production,OU=Services,OU=Accounts,DC=corporate,DC=t-mobile,DC=com" % username,
-                "password": pw,
-                "obj_name": nt_id,
-                "obj_class": "user",
-                "attributes": ["mail"],
-            }
-    lambda_client = boto3.client('lambda')
-    invoke_response = lambda_client.invoke(
-        FunctionName= os.environ.get("query_ldap"),
-        InvocationType= "RequestResponse",
-        Payload= json.dumps(data)
-    )
-    if ("FunctionError" not in invoke_response):
-        data = ast.literal_eval(json.load(invoke_response['Payload'])['body'])
-        print(data)
-        return data[0][0][1]['mail'][0]
+    found = {'missing_owners': findings.missing_owners, 'invalid_patches': findings.invalid_patches}
+    window = int(os.environ.get('digest_window_seconds') or 3600)
+    if not os.environ.get('kv_table'):
+        # the SQLite fallback is per container and lost with it, buffered findings would be dropped
+        window = 0
+    buffer = digest.DigestBuffer(kv_store.get_store('digest') if window > 0 else None, window)
+    try:
+        buffer.add(found)
+        owners = buffer.due(found)
+    except Exception as e:
+        # without the buffer the findings are still sent, just not combined across invocations
+        print("Error reading the digest buffer: " + str(e))
+        buffer = digest.DigestBuffer(None, 0)
+        owners = buffer.due(found)
+    if not owners:
+        return
+
+    METRICS.put('notify', 'DigestsDue', len(owners))
+    with tracing.span('email_lookup', owners=len(owners)):
+        emails = get_emails(list(owners))
+    for nt_id, (kinds, keys) in owners.items():
+        with tracing.span('notify', reason='digest'):
+            notify_digest(nt_id, kinds, emails.get(nt_id))
+        try:
+            buffer.done(keys)
+        except Exception as e:
+            print("Error clearing the digest of " + nt_id + ": " + str(e))
+
+
+def notify_digest(nt_id, kinds, email):
+    """
+    # notifies an owner about every finding buffered for them in one email and slack message
+    :param nt_id: owner id to send to
+    :param kinds: dict of missing_owners and invalid_patches to instance ids
+    :param email: the owner's email address
+    :return: N/A
+    """
+
+    missing = kinds.get('missing_owners') or []
+    invalid = kinds.get('invalid_patches') or []
+    if missing and invalid:
+        send_notification(nt_id, email,
+            "Missing Owning_Mail or Owning_Team tags: " + str(missing) + "\nInvalid Patch Group tags: " + str(invalid),
+            "have missing or invalid tags",
+            "Please add the owner tags to your resources. If you do not need the latest patches, please fix the Patch Group tags",
+            "Missing And Invalid Tags", "Alert: Missing and invalid tags!")
+    elif missing:
+        send_notification(nt_id, email, str(missing), "is missing Owning_Mail or Owning_Team tags",
+            "Please add these tags to your resources.", "Missing Owner Tags", "Alert: Missing Owner tags!")
+    elif invalid:
+        send_notification(nt_id, email, str(invalid), "has an invalid Patch Group tag. These resources will receive the latest patches",
+            "If you do not need the latest patches, please fix these tags", "Invalid Patch Tags", "Error: Invalid patch tags!")
+
+
+def get_emails(nt_ids):
+    """
+    # Retrieves the emails of many nt_ids, from the directory index when one is exported,
+    # then from the identity cache when they were looked up before, then from LDAP
+    :param nt_ids: the ids to search through
+    :return: dict of nt_id to email address or None if not found
+    """
+
+    if not nt_ids:
+        return {}
+    emails = {}
+    index = directory_index.get_index()
+    if index is not None:
+        emails = dict((nt_id, entry['mail']) for nt_id, entry in index.lookup_many(nt_ids).items() if entry['mail'])
+    missing = [nt_id for nt_id in nt_ids if nt_id not in emails]
+    if missing:
+        emails.update(identity_cache.get_cache('email').resolve_many(missing, ldap_lookup.lookup_emails))
+    return emails
 
-    return None
 
-def notify(nt_id, application, action, remedy, subj, heading):
+def send_notification(nt_id, email, application, action, remedy, subj, heading):
     """
-    # notifies an owner through email and slack
+    # sends the email and slack message of a notification to an owner whose email is known
     :param nt_id: owner id to send to
+    :param email: the owner's email address
     :param application: the resource affected
     :param action: the thing happening to the resource
     :param remedy: steps taken to remedy
@@ -333,8 +1030,7 @@ def notify(nt_id, application, action, remedy, subj, heading):
     :return: N/A
     """
 
-    email = get_email(nt_id)
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_clients.get_client('lambda')
     messages = create_messages(application, action, remedy)
     print(email)
     email_data = {
@@ -345,12 +1041,13 @@ def notify(nt_id, application, action, remedy, subj, heading):
         'messages': messages,
         'region': os.environ.get("AWS_DEFAULT_REGION")
     }
-    invoke_email_response = lambda_client.invoke(
+    invoke_email_response = aws_executor.call(lambda_client, 'invoke',
         FunctionName= os.environ.get("formatted_email"),
         InvocationType= "RequestResponse",
         Payload= json.dumps(email_data)
     )
     err = checkError(invoke_email_response, "Error sending email!")
+    METRICS.put('notify', 'NotificationFailures' if err else 'NotificationsSent', 1)
     if err:
         print(str(err))
 
@@ -361,46 +1058,17 @@ def notify(nt_id, application, action, remedy, subj, heading):
         'channel_id': CHANNEL_ID,
         'nt_ids': [nt_id]
     }
-    invoke_slack_response = lambda_client.invoke(
+    invoke_slack_response = aws_executor.call(lambda_client, 'invoke',
         FunctionName= os.environ.get("slack_message"),
         InvocationType= "RequestResponse",
         Payload= json.dumps(slack_data)
     )
     err = checkError(invoke_slack_response, "Error sending slack message!")
+    METRICS.put('notify', 'NotificationFailures' if err else 'NotificationsSent', 1)
     if err:
         print(str(err))
 
 
-def get_secret():
-    """
-    # gets the secret from AWS secrets manager
-    :param N/A:
-    :return: the secrets value or None if not found
-    """
-
-    secret_name = "Jido-Active-Directory-Service-Account"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name= os.environ.get("AWS_DEFAULT_REGION")
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId= secret_name
-        )
-    except ClientError as e:
-        print("Error getting secret key!: " + str(e))
-        return None
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        if 'SecretString' in get_secret_value_response:
-            return get_secret_value_response['SecretString']
-
-    return None
-
-
 def checkError(invoke_response, message):
     """
     # checks for errors in lambda functions from invoke
@@ -0,0 +1,175 @@
+import os, time
+import aws_clients, aws_executor, kv_store, tracing
+from concurrent.futures import ThreadPoolExecutor
+
+# tag_resources takes up to 20 ARNs per call, get_resources returns up to 100 per page
+TAG_CHUNK = 20
+PAGE_SIZE = 100
+
+DEFAULT_RESOURCE_TYPES = 'ec2:instance,ec2:image,autoscaling:autoScalingGroup'
+
+# the checkpoint outlives a paused backfill for a week
+CHECKPOINT_TTL = 7 * 24 * 3600
+
+# failed resources carried in the checkpoint, well under the DynamoDB item size. Beyond
+# that they are left to the next full pass, which works their tags out again
+RETRY_LIMIT = 1000
+
+
+class Backfill(object):
+    """
+    # Tags resources that were created before auto-tag watched the queue. Every
+    # resource of the configured types is paged through with the Resource Groups
+    # Tagging API, the missing tags are worked out per page and written with
+    # tag_resources, 20 ARNs per call, from a bounded pool of workers. The
+    # pagination token is checkpointed after each page, per mode, so a large
+    # account is backfilled over as many invocations as it takes. Resources whose
+    # tags could not be written are kept with the checkpoint and retried first.
+    """
+
+    def __init__(self, compute, store, resource_types, workers=4, enforce=False, deadline=None):
+        """
+        :param compute: function(resources) returning a dict of ARN to the tags to add, resources being get_resources ResourceTagMappingList entries
+        :param store: kv_store store holding the checkpoint
+        :param resource_types: ResourceTypeFilters EX) ['ec2:instance']
+        :param workers: tag_resources calls in flight at once
+        :param enforce: write the tags, otherwise only count them
+        :param deadline: time.time() after which no new page is started
+        """
+
+        self.compute = compute
+        self.store = store
+        self.resource_types = resource_types
+        self.workers = max(1, workers)
+        self.enforce = enforce
+        self.deadline = deadline
+
+    @classmethod
+    def from_environment(cls, compute, enforce, deadline=None):
+        """
+        # builds a backfill from the backfill_resource_types and backfill_workers environment variables
+        :param compute: function(resources) returning a dict of ARN to the tags to add
+        :param enforce: write the tags, otherwise only count them
+        :param deadline: time.time() after which no new page is started
+        :return: Backfill
+        """
+
+        types = os.environ.get('backfill_resource_types') or DEFAULT_RESOURCE_TYPES
+        return cls(compute, kv_store.get_store('backfill'),
+                   [resource_type.strip() for resource_type in types.split(',') if resource_type.strip()],
+                   workers=int(os.environ.get('backfill_workers') or 4),
+                   enforce=enforce, deadline=deadline)
+
+    def _out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def run(self):
+        """
+        # backfills from the checkpoint until every page is done or time runs out. An audit
+        # run keeps its own checkpoint, so it never moves an enforce run past pages it did not tag
+        :return: dict of counters, failed being the resources whose tags are still not written,
+                 complete is False when a later invocation has to continue
+        """
+
+        key = 'checkpoint-' + ('enforce' if self.enforce else 'audit')
+        checkpoint = self.store.get(key) or {'token': '', 'scanned': 0, 'missing': 0, 'tagged': 0, 'failed': 0}
+        retry = checkpoint.pop('retry', None) or {}
+        client = aws_clients.get_client('resourcegroupstaggingapi')
+        complete = False
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if retry and not self._out_of_time():
+                tagged, retry = self.write(pool, retry)
+                checkpoint['tagged'] += tagged
+                checkpoint['failed'] -= tagged
+            while not self._out_of_time():
+                kwargs = {'ResourceTypeFilters': self.resource_types, 'ResourcesPerPage': PAGE_SIZE}
+                if checkpoint['token']:
+                    kwargs['PaginationToken'] = checkpoint['token']
+                with tracing.span('backfill_scan'):
+                    page = aws_executor.call(client, 'get_resources', **kwargs)
+                resources = page.get('ResourceTagMappingList', [])
+                missing = self.compute(resources) if resources else {}
+
+                checkpoint['scanned'] += len(resources)
+                checkpoint['missing'] += len(missing)
+                if self.enforce and missing:
+                    tagged, failed = self.write(pool, missing)
+                    checkpoint['tagged'] += tagged
+                    checkpoint['failed'] += len(failed)
+                    for arn in list(failed)[:max(0, RETRY_LIMIT - len(retry))]:
+                        retry[arn] = failed[arn]
+
+                # resume after this page next time, its tags are written or kept to be retried
+                checkpoint['token'] = page.get('PaginationToken') or ''
+                if not checkpoint['token']:
+                    complete = True
+                    break
+                self.store.put(key, dict(checkpoint, retry=retry), CHECKPOINT_TTL)
+
+        if complete:
+            # the next pass starts over and works out the tags still missing, failed ones included
+            self.store.delete(key)
+        else:
+            self.store.put(key, dict(checkpoint, retry=retry), CHECKPOINT_TTL)
+        result = dict(checkpoint)
+        result.pop('token')
+        result['complete'] = complete
+        return result
+
+    def write(self, pool, missing):
+        """
+        # writes one page of tags, one tag_resources call per 20 ARNs getting the same tags
+        :param pool: ThreadPoolExecutor the calls run on
+        :param missing: dict of ARN to the tags to add
+        :return: (resources tagged, dict of ARN to the tags of the resources that failed)
+        """
+
+        groups = {}
+        for arn, tags in missing.items():
+            key = tuple(sorted((tag['Key'], tag['Value']) for tag in tags))
+            groups.setdefault(key, []).append(arn)
+
+        calls = []
+        for key, arns in groups.items():
+            for start in range(0, len(arns), TAG_CHUNK):
+                calls.append((dict(key), arns[start:start + TAG_CHUNK]))
+
+        failed = {}
+        for arns in pool.map(lambda call: self.tag(*call), calls):
+            for arn in arns:
+                failed[arn] = missing[arn]
+        tagged = len(missing) - len(failed)
+        return tagged, failed
+
+    def tag(self, tags, arns):
+        """
+        # one tag_resources call
+        :param tags: dict of tag key to value
+        :param arns: up to 20 resource ARNs
+        :return: ARNs of the resources that failed
+        """
+
+        client = aws_clients.get_client('resourcegroupstaggingapi')
+        try:
+            with tracing.span('backfill_write', resources=len(arns)):
+                response = aws_executor.call(client, 'tag_resources', ResourceARNList=arns, Tags=tags)
+        except Exception as e:
+            print("Error tagging " + str(len(arns)) + " resources: " + str(e))
+            return list(arns)
+        failures = response.get('FailedResourcesMap') or {}
+        for arn, failure in failures.items():
+            print("Error tagging " + arn + ": " + str(failure.get('ErrorMessage')))
+        return [arn for arn in arns if arn in failures]
+
+
+def instance_id(arn):
+    """
+    # the instance id of an EC2 instance ARN
+    :param arn: resource ARN EX) arn:aws:ec2:us-east-1:123456789012:instance/i-0abc
+    :return: instance id, None for other resources
+    """
+
+    resource = arn.split(':', 5)[-1]
+    if resource.startswith('instance/'):
+        return resource.split('/', 1)[1]
+    return None
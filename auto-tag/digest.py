@@ -0,0 +1,90 @@
+import time, uuid
+
+# kinds of findings an owner is notified about
+KINDS = ('missing_owners', 'invalid_patches')
+
+
+class DigestBuffer(object):
+    """
+    # Buffers tag findings per owner in a kv_store across invocations, so an
+    # owner gets one combined notification per window instead of one per
+    # invocation. Every invocation appends its own entry per owner, so
+    # concurrent containers never overwrite each other, and a flush claims the
+    # owner first so only one container sends the digest.
+    """
+
+    def __init__(self, store, window):
+        """
+        :param store: kv_store store the pending findings are kept in, None when the window is 0
+        :param window: seconds between an owner's first buffered finding and the digest, 0 to send at once
+        """
+
+        self.store = store
+        self.window = window
+
+    def add(self, findings):
+        """
+        # buffers the findings of one invocation
+        :param findings: dict of kind EX) missing_owners to a dict of nt_id to instance ids
+        :return: N/A
+        """
+
+        if self.window <= 0:
+            return
+        now = time.time()
+        entries = {}
+        for kind in KINDS:
+            for nt_id, instance_ids in findings.get(kind, {}).items():
+                entry = entries.setdefault(nt_id, dict((name, []) for name in KINDS))
+                entry[kind] += instance_ids
+
+        suffix = '#%.6f#%s' % (now, uuid.uuid4().hex)
+        items = dict(('pending#' + nt_id + suffix, dict(entry, at=now)) for nt_id, entry in entries.items())
+        if items:
+            # kept well past the window in case no invocation flushes for a while
+            self.store.put_many(items, self.window * 4 + 24 * 3600)
+
+    def due(self, findings=None):
+        """
+        # collects the owners whose window has passed and claims them for this invocation
+        :param findings: findings of this invocation, sent at once when there is no window
+        :return: dict of nt_id to (dict of kind to sorted instance ids, buffered keys to pass to done)
+        """
+
+        if self.window <= 0:
+            owners = {}
+            for kind in KINDS:
+                for nt_id, instance_ids in (findings or {}).get(kind, {}).items():
+                    merged = owners.setdefault(nt_id, (dict((name, []) for name in KINDS), []))[0]
+                    merged[kind] = sorted(set(merged[kind] + instance_ids))
+            return owners
+
+        now = time.time()
+        pending = {}
+        for key, entry in self.store.items('pending#'):
+            nt_id = key.split('#')[1]
+            merged, keys, first = pending.get(nt_id, (dict((name, set()) for name in KINDS), [], entry['at']))
+            for kind in KINDS:
+                merged[kind].update(entry.get(kind, []))
+            keys.append(key)
+            pending[nt_id] = (merged, keys, min(first, entry['at']))
+
+        owners = {}
+        for nt_id, (merged, keys, first) in pending.items():
+            if first > now - self.window:
+                continue
+            if not self.store.add('flush#' + nt_id, now, self.window):
+                # another invocation is sending this owner's digest
+                continue
+            owners[nt_id] = (dict((kind, sorted(merged[kind])) for kind in KINDS), keys)
+        return owners
+
+    def done(self, keys):
+        """
+        # drops buffered findings once their digest was sent
+        :param keys: keys returned by due
+        :return: N/A
+        """
+
+        if keys:
+            self.store.delete_many(keys)
@@ -0,0 +1,138 @@
+import os, threading, time
+import kv_store
+
+# long enough to outlive the default SQS retention of four days
+DEFAULT_TTL = 4 * 24 * 3600
+
+# entries kept in memory before the expired and then the oldest are dropped
+MEMORY_LIMIT = 100000
+
+_LEDGER = None
+_LOCK = threading.Lock()
+
+
+class Ledger(object):
+    """
+    # Records which instances of which CloudTrail event have been fully
+    # processed, so a redelivered or duplicate message skips every API call.
+    # Keys are eventID#instance id. Lookups go to an in-memory cache first and
+    # only the misses are read from the kv_store, in one call per batch. Claims
+    # on Auto Scaling groups are kept the same way under asg#group name.
+    """
+
+    def __init__(self, store, ttl=DEFAULT_TTL):
+        """
+        :param store: kv_store store the entries are persisted in
+        :param ttl: seconds an entry is remembered
+        """
+
+        self.store = store
+        self.ttl = ttl
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(event_id, instance_id):
+        return event_id + '#' + instance_id
+
+    def done(self, launches):
+        """
+        # finds the instances that were already processed
+        :param launches: list of (event id, instance ids)
+        :return: set of event id#instance id keys already in the ledger
+        """
+
+        keys = [self.key(event_id, instance_id) for event_id, instance_ids in launches for instance_id in instance_ids]
+        now = time.time()
+        found = set()
+        with self.lock:
+            for key in keys:
+                if self.memory.get(key, 0) > now:
+                    found.add(key)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            stored = self.store.get_many(missing)
+            with self.lock:
+                for key in stored:
+                    self.memory[key] = now + self.ttl
+            found.update(stored)
+        return found
+
+    def record(self, launches):
+        """
+        # marks instances as processed
+        :param launches: list of (event id, instance ids)
+        :return: N/A
+        """
+
+        keys = [self.key(event_id, instance_id) for event_id, instance_ids in launches for instance_id in instance_ids]
+        if not keys:
+            return
+        now = time.time()
+        self.store.put_many(dict((key, int(now)) for key in keys), self.ttl)
+        with self.lock:
+            for key in keys:
+                self.memory[key] = now + self.ttl
+            if len(self.memory) > MEMORY_LIMIT:
+                self._trim(now)
+
+    def claim_group(self, group_name, window):
+        """
+        # claims an Auto Scaling group for a window, only the first claim within the window succeeds
+        :param group_name: name of the Auto Scaling group
+        :param window: seconds the claim lasts
+        :return: True when this caller holds the claim, False while another claim is active
+        """
+
+        key = 'asg#' + group_name
+        now = time.time()
+        with self.lock:
+            if self.memory.get(key, 0) > now:
+                return False
+        claimed = self.store.add(key, now + window, window)
+        expires = now + window if claimed else (self.store.get(key) or now + window)
+        with self.lock:
+            self.memory[key] = expires
+        return claimed
+
+    def release_group(self, group_name):
+        """
+        # gives a claim back early, so the next launch of the group is processed again
+        :param group_name: name of the Auto Scaling group
+        :return: N/A
+        """
+
+        key = 'asg#' + group_name
+        with self.lock:
+            self.memory.pop(key, None)
+        self.store.delete(key)
+
+    def _trim(self, now):
+        self.memory = dict((key, expires) for key, expires in self.memory.items() if expires > now)
+        if len(self.memory) > MEMORY_LIMIT:
+            newest = sorted(self.memory.items(), key=lambda entry: entry[1])[-MEMORY_LIMIT // 2:]
+            self.memory = dict(newest)
+
+
+def get_ledger():
+    """
+    # returns the ledger shared across warm invocations, kept for idempotency_ttl seconds
+    :return: Ledger
+    """
+
+    global _LEDGER
+    with _LOCK:
+        if _LEDGER is None:
+            _LEDGER = Ledger(kv_store.get_store('idempotency'), int(os.environ.get('idempotency_ttl') or DEFAULT_TTL))
+        return _LEDGER
+
+
+def reset():
+    """
+    # drops the shared ledger and its in-memory cache
+    :return: N/A
+    """
+
+    global _LEDGER
+    with _LOCK:
+        _LEDGER = None
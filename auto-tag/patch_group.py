@@ -0,0 +1,149 @@
+import json, os, threading, time
+import aws_clients, aws_executor
+
+# Patch Group format: {environment}-{platform}-{role}-{urgency}-{order}
+SEGMENTS = ('environment', 'platform', 'role', 'urgency', 'order')
+
+# seconds a validator loaded from the central config is reused before it is fetched again
+DEFAULT_TTL = 300
+
+_VALIDATOR = None
+_LOCK = threading.Lock()
+
+
+class PatchGroupValidator(object):
+    """
+    # Validates Patch Group tag values against one set of allowed values per
+    # segment position. Built once and reused, so checking a value is a split
+    # and five set lookups, and a segment only matches an allowed value exactly.
+    """
+
+    def __init__(self, allowed, expires=None):
+        """
+        :param allowed: dict of segment name to the allowed values for it
+        :param expires: time.time() after which the allowed values should be reloaded, None to keep them
+        """
+
+        self.allowed = [frozenset(allowed.get(segment) or ()) for segment in SEGMENTS]
+        self.expires = expires
+
+    @classmethod
+    def from_environment(cls):
+        """
+        # builds a validator from the comma separated environment, platform, role, urgency and order variables
+        :return: PatchGroupValidator
+        """
+
+        return cls(dict((segment, split_values(os.environ.get(segment))) for segment in SEGMENTS))
+
+    @classmethod
+    def from_parameter(cls, name, ttl=DEFAULT_TTL):
+        """
+        # builds a validator from a JSON SSM parameter EX) {"environment": ["prd", "dev"], "platform": [...], ...}
+        :param name: name of the SSM parameter
+        :param ttl: seconds before the parameter is fetched again
+        :return: PatchGroupValidator
+        """
+
+        client = aws_clients.get_client('ssm')
+        response = aws_executor.call(client, 'get_parameter', Name=name)
+        document = json.loads(response['Parameter']['Value'])
+        allowed = {}
+        for segment in SEGMENTS:
+            values = document.get(segment) or []
+            allowed[segment] = split_values(values) if isinstance(values, str) else [value.strip() for value in values]
+        return cls(allowed, time.time() + ttl)
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def failed_segment(self, value):
+        """
+        # finds the first part of a Patch Group value that is not allowed
+        :param value: the tag value EX) prd-rhel-security-critical-first
+        :return: name of the failing segment, 'format' if there are too few segments, None if the value is valid
+        """
+
+        parts = value.split('-')
+        if len(parts) < len(SEGMENTS):
+            return 'format'
+        for segment, part, allowed in zip(SEGMENTS, parts, self.allowed):
+            if part not in allowed:
+                return segment
+        return None
+
+    def is_valid(self, value):
+        """
+        # checks one Patch Group value
+        :param value: the tag value
+        :return: boolean if valid or not
+        """
+
+        return self.failed_segment(value) is None
+
+    def validate(self, values):
+        """
+        # checks a list of Patch Group values in one pass
+        :param values: tag values
+        :return: dict of every distinct value to its failing segment, None for valid values
+        """
+
+        results = {}
+        for value in values:
+            if value not in results:
+                results[value] = self.failed_segment(value)
+        return results
+
+
+def split_values(text):
+    """
+    # splits a comma separated list of allowed values EX) prd, dev, tst
+    :param text: the list, None for no values
+    :return: list of values
+    """
+
+    return [value.strip() for value in (text or '').split(',') if value.strip()]
+
+
+def get_validator():
+    """
+    # returns the validator shared across warm invocations. It is built from the
+    # patch_group_parameter SSM parameter when that variable is set, cached for
+    # patch_group_ttl seconds, and from the environment variables otherwise.
+    # If the parameter cannot be read, the previous validator is kept, or the
+    # environment variables are used on a cold start.
+    :return: PatchGroupValidator
+    """
+
+    global _VALIDATOR
+    validator = _VALIDATOR
+    if validator is not None and not validator.expired():
+        return validator
+
+    with _LOCK:
+        if _VALIDATOR is not None and not _VALIDATOR.expired():
+            return _VALIDATOR
+        parameter = os.environ.get('patch_group_parameter')
+        if parameter:
+            try:
+                _VALIDATOR = PatchGroupValidator.from_parameter(parameter, int(os.environ.get('patch_group_ttl') or DEFAULT_TTL))
+            except Exception as e:
+                print("Error loading patch group config " + parameter + ": " + str(e))
+                if _VALIDATOR is None:
+                    _VALIDATOR = PatchGroupValidator.from_environment()
+                # try the parameter again after another ttl instead of on every call
+                _VALIDATOR.expires = time.time() + int(os.environ.get('patch_group_ttl') or DEFAULT_TTL)
+        else:
+            _VALIDATOR = PatchGroupValidator.from_environment()
+        return _VALIDATOR
+
+
+def reset():
+    """
+    # drops the shared validator so the next call rebuilds it
+    :return: N/A
+    """
+
+    global _VALIDATOR
+    with _LOCK:
+        _VALIDATOR = None
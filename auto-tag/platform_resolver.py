@@ -0,0 +1,112 @@
+import threading
+import aws_clients, aws_executor
+from collections import OrderedDict
+
+# describe_instance_information takes up to 50 values in the InstanceIds filter
+SSM_CHUNK = 50
+
+# PlatformDetails values that do not name the distribution
+AMBIGUOUS_DETAILS = ('', 'Linux/UNIX')
+
+# platform name per AMI, instances launched from the same image share a platform.
+# An AMI's platform never changes, the least recently used are dropped past IMAGE_CACHE_SIZE
+IMAGE_CACHE_SIZE = 1000
+_IMAGE_PLATFORMS = OrderedDict()
+_LOCK = threading.Lock()
+
+
+class PlatformResolver(object):
+    """
+    # Resolves the platform name of every instance in a batch up front. The
+    # describe_instances fields are used first, then platforms already seen for
+    # the same AMI, and only the instances still unknown are looked up in SSM
+    # with one describe_instance_information call per 50 instances.
+    """
+
+    def __init__(self, described):
+        """
+        :param described: dict of instance id to instance from describe_instances
+        """
+
+        self.described = described
+        self.platforms = {}
+
+    def prefetch(self, instance_ids):
+        """
+        # resolves the platforms of the given instances
+        :param instance_ids: instances that need a platform
+        :return: N/A
+        """
+
+        unresolved = []
+        for instance_id in instance_ids:
+            name = self._from_instance(self.described.get(instance_id, {}))
+            if name:
+                self.platforms[instance_id] = name
+            else:
+                unresolved.append(instance_id)
+        if not unresolved:
+            return
+
+        client = aws_clients.get_client('ssm')
+        for start in range(0, len(unresolved), SSM_CHUNK):
+            chunk = unresolved[start:start + SSM_CHUNK]
+            try:
+                pages = aws_executor.paginate(client, 'describe_instance_information',
+                    Filters=[
+                        {
+                            'Key': 'InstanceIds',
+                            'Values': chunk
+                        }
+                    ],
+                    MaxResults=SSM_CHUNK
+                )
+                for page in pages:
+                    for information in page.get('InstanceInformationList', []):
+                        self._remember(information['InstanceId'], information.get('PlatformName'))
+            except Exception as e:
+                print("Error looking up platforms in SSM: " + str(e))
+
+        # instances not registered with SSM yet can still share an image with one that is
+        for instance_id in unresolved:
+            if instance_id not in self.platforms:
+                name = self._from_image(self.described.get(instance_id, {}))
+                if name:
+                    self.platforms[instance_id] = name
+
+    def platform_name(self, instance_id):
+        """
+        # the resolved platform name
+        :param instance_id: the id of the instance
+        :return: platform name EX) Red Hat Enterprise Linux, empty if unknown
+        """
+
+        return self.platforms.get(instance_id, '')
+
+    def _from_instance(self, instance):
+        details = instance.get('PlatformDetails') or ''
+        if details not in AMBIGUOUS_DETAILS:
+            return details
+        if (instance.get('Platform') or '').lower() == 'windows':
+            return 'Windows'
+        return self._from_image(instance)
+
+    def _from_image(self, instance):
+        image_id = instance.get('ImageId')
+        with _LOCK:
+            name = _IMAGE_PLATFORMS.get(image_id)
+            if name is not None:
+                _IMAGE_PLATFORMS.move_to_end(image_id)
+            return name
+
+    def _remember(self, instance_id, name):
+        if not name:
+            return
+        self.platforms[instance_id] = name
+        image_id = self.described.get(instance_id, {}).get('ImageId')
+        if image_id:
+            with _LOCK:
+                _IMAGE_PLATFORMS[image_id] = name
+                _IMAGE_PLATFORMS.move_to_end(image_id)
+                while len(_IMAGE_PLATFORMS) > IMAGE_CACHE_SIZE:
+                    _IMAGE_PLATFORMS.popitem(last=False)
@@ -0,0 +1,260 @@
+import os, threading, time
+import aws_executor, tracing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# SQS limits for a single receive, delete or visibility batch
+MAX_BATCH = 10
+MAX_WAIT_SECONDS = 20
+
+
+class SqsConsumer(object):
+    """
+    # Drains an SQS queue with several long-polling receivers feeding a bounded
+    # pool of workers. Each worker hands a whole receive batch to process_batch,
+    # deletes the acknowledged messages with delete_message_batch and a
+    # heartbeat keeps extending the visibility of batches still in flight.
+    """
+
+    def __init__(self, client, queue_url, process_batch, receivers=2, workers=4, wait_seconds=MAX_WAIT_SECONDS,
+                 visibility_timeout=60, heartbeat_seconds=None, deadline=None,
+                 attribute_names=None, message_attribute_names=None):
+        """
+        :param client: boto3 SQS client
+        :param queue_url: URL of the queue to drain
+        :param process_batch: function(messages) returning the MessageIds that can be deleted
+        :param receivers: receive calls kept in flight at once
+        :param workers: batches processed at once, also the number of batches buffered ahead
+        :param wait_seconds: long polling wait, a receiver stops after one empty receive
+        :param visibility_timeout: seconds a received message stays hidden, renewed by the heartbeat
+        :param heartbeat_seconds: how often in-flight messages are extended, defaults to a third of the timeout
+        :param deadline: time.time() after which no new batches are received
+        :param attribute_names: AttributeNames passed to receive_message
+        :param message_attribute_names: MessageAttributeNames passed to receive_message
+        """
+
+        self.client = client
+        self.queue_url = queue_url
+        self.process_batch = process_batch
+        self.receivers = max(1, receivers)
+        self.workers = max(1, workers)
+        self.wait_seconds = min(MAX_WAIT_SECONDS, max(0, wait_seconds))
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_seconds = heartbeat_seconds or max(1.0, visibility_timeout / 3.0)
+        self.deadline = deadline
+        self.attribute_names = attribute_names or []
+        self.message_attribute_names = message_attribute_names or []
+
+        self.batches = queue.Queue(maxsize=self.workers)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = {
+            'receives': 0,
+            'empty_receives': 0,
+            'received': 0,
+            'acknowledged': 0,
+            'delete_failures': 0,
+            'batch_errors': 0,
+            'visibility_extensions': 0,
+        }
+
+    @classmethod
+    def from_environment(cls, client, queue_url, process_batch, deadline=None, **kwargs):
+        """
+        # builds a consumer from the sqs_receivers, sqs_workers, sqs_wait_seconds and sqs_visibility_timeout environment variables
+        :param client: boto3 SQS client
+        :param queue_url: URL of the queue
+        :param process_batch: function(messages) returning the MessageIds that can be deleted
+        :param deadline: time.time() after which no new batches are received
+        :return: SqsConsumer
+        """
+
+        return cls(client, queue_url, process_batch,
+                   receivers=int(os.environ.get("sqs_receivers") or 2),
+                   workers=int(os.environ.get("sqs_workers") or 4),
+                   wait_seconds=int(os.environ.get("sqs_wait_seconds") or MAX_WAIT_SECONDS),
+                   visibility_timeout=int(os.environ.get("sqs_visibility_timeout") or 60),
+                   deadline=deadline, **kwargs)
+
+    def _count(self, field, amount=1):
+        with self.lock:
+            self.stats[field] += amount
+
+    def _out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def receive(self):
+        """
+        # receiver thread, long polls until the queue comes back empty or time runs out
+        :return: N/A
+        """
+
+        while not self.stopped.is_set() and not self._out_of_time():
+            # never wait past the deadline
+            wait = self.wait_seconds
+            if self.deadline is not None:
+                wait = int(max(0, min(wait, self.deadline - time.time())))
+            try:
+                with tracing.span('receive'):
+                    response = aws_executor.call(self.client, 'receive_message',
+                        QueueUrl=self.queue_url,
+                        AttributeNames=self.attribute_names,
+                        MessageAttributeNames=self.message_attribute_names,
+                        MaxNumberOfMessages=MAX_BATCH,
+                        WaitTimeSeconds=wait,
+                        VisibilityTimeout=self.visibility_timeout
+                    )
+            except Exception as e:
+                print("Error receiving messages: " + str(e))
+                return
+            self._count('receives')
+
+            messages = response.get('Messages') or []
+            if not messages:
+                self._count('empty_receives')
+                print("No more messages found in the queue")
+                return
+
+            self._count('received', len(messages))
+            now = time.time()
+            with self.lock:
+                for message in messages:
+                    self.in_flight[message['MessageId']] = [message['ReceiptHandle'], now]
+            # blocks while every worker is busy, the heartbeat covers the wait
+            self.batches.put(messages)
+
+    def work(self):
+        """
+        # worker thread, processes batches until it is handed the stop marker
+        :return: N/A
+        """
+
+        while True:
+            messages = self.batches.get()
+            if messages is None:
+                return
+            try:
+                acknowledged = set(self.process_batch(messages) or [])
+            except Exception as e:
+                self._count('batch_errors')
+                print("Error processing batch: " + str(e))
+                acknowledged = set()
+
+            self.delete([message for message in messages if message['MessageId'] in acknowledged])
+            with self.lock:
+                for message in messages:
+                    self.in_flight.pop(message['MessageId'], None)
+
+    def delete(self, messages):
+        """
+        # deletes acknowledged messages in batches of ten
+        :param messages: SQS messages to delete
+        :return: N/A
+        """
+
+        for start in range(0, len(messages), MAX_BATCH):
+            chunk = messages[start:start + MAX_BATCH]
+            entries = [{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']} for index, message in enumerate(chunk)]
+            try:
+                response = aws_executor.call(self.client, 'delete_message_batch', QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                print("Error deleting messages: " + str(e))
+                self._count('delete_failures', len(chunk))
+                continue
+            self._count('acknowledged', len(response.get('Successful', [])))
+            for failure in response.get('Failed', []):
+                print("Error deleting message: " + str(failure))
+                self._count('delete_failures')
+
+    def heartbeat(self):
+        """
+        # heartbeat thread, extends the visibility of messages that have been in flight for a while
+        :return: N/A
+        """
+
+        while not self.stopped.wait(self.heartbeat_seconds):
+            now = time.time()
+            with self.lock:
+                due = [(message_id, entry[0]) for message_id, entry in self.in_flight.items()
+                       if now - entry[1] >= self.heartbeat_seconds]
+                for message_id, _ in due:
+                    self.in_flight[message_id][1] = now
+
+            for start in range(0, len(due), MAX_BATCH):
+                chunk = due[start:start + MAX_BATCH]
+                entries = [{'Id': str(index), 'ReceiptHandle': handle, 'VisibilityTimeout': self.visibility_timeout}
+                           for index, (_, handle) in enumerate(chunk)]
+                try:
+                    response = aws_executor.call(self.client, 'change_message_visibility_batch',
+                                                 QueueUrl=self.queue_url, Entries=entries)
+                    self._count('visibility_extensions', len(response.get('Successful', [])))
+                except Exception as e:
+                    print("Error extending message visibility: " + str(e))
+
+    def run(self):
+        """
+        # drains the queue and waits for every received batch to be processed
+        :return: dict of counters
+        """
+
+        workers = [threading.Thread(target=self.work) for _ in range(self.workers)]
+        receivers = [threading.Thread(target=self.receive) for _ in range(self.receivers)]
+        heartbeat = threading.Thread(target=self.heartbeat)
+        for thread in workers + receivers + [heartbeat]:
+            thread.daemon = True
+            thread.start()
+
+        for thread in receivers:
+            thread.join()
+        for _ in workers:
+            self.batches.put(None)
+        for thread in workers:
+            thread.join()
+        self.stopped.set()
+        heartbeat.join()
+
+        with self.lock:
+            return dict(self.stats)
+
+
+def process_records(records, process_batch, workers=4):
+    """
+    # processes the records of an SQS event source batch on a thread pool
+    :param records: event['Records'] as delivered by the Lambda SQS event source
+    :param process_batch: function(messages) returning the MessageIds that were processed
+    :param workers: threads the records are spread over
+    :return: batchItemFailures list naming every record that was not processed
+    """
+
+    # same shape as receive_message so process_batch serves both paths
+    messages = [{
+        'MessageId': record['messageId'],
+        'ReceiptHandle': record.get('receiptHandle'),
+        'Body': record['body'],
+        'Attributes': record.get('attributes', {}),
+        'MessageAttributes': record.get('messageAttributes', {}),
+    } for record in records]
+    if not messages:
+        return []
+
+    size = max(1, (len(messages) + workers - 1) // workers)
+    chunks = [messages[start:start + size] for start in range(0, len(messages), size)]
+
+    def run(chunk):
+        try:
+            return set(process_batch(chunk) or [])
+        except Exception as e:
+            print("Error processing batch: " + str(e))
+            return set()
+
+    processed = set()
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        for acknowledged in pool.map(run, chunks):
+            processed |= acknowledged
+
+    return [{'itemIdentifier': message['MessageId']} for message in messages if message['MessageId'] not in processed]
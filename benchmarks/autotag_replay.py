@@ -0,0 +1,466 @@
+"""
+# Replays RunInstances CloudTrail events through aws_auto_tag to measure how fast a backlog drains.
+
+Events are generated from a seed or loaded from a file of recorded events. A
+generated storm mixes single-instance launches with multi-instance instancesSet
+events, like an ASG scale-out. Every event is put on an in-memory SQS queue, and
+the handler is invoked until the queue stops handing out messages. SQS, EC2,
+SSM, Lambda and Secrets Manager are real boto3 clients answered by fake_aws
+with a configurable per-call latency, so the API accounting is the same as in
+Lambda.
+
+Reported per run:
+
+* messages, instances - the size of the replayed backlog
+* time_to_drain_s - wall time until a receive came back empty
+* messages_per_second, instances_per_second
+* api_calls_per_message - from api_accounting, with a per-operation breakdown
+* acknowledged, left_in_queue - messages deleted by the handler and still queued
+* duplicates - events delivered twice, their second copy should cost no EC2 or SSM calls
+* handler_errors - exceptions raised out of lambda_handler, one per failed invocation
+
+Usage:
+    python benchmarks/autotag_replay.py [--instances 2000] [--per-event 1,1,1,5,10,50]
+        [--asg-ratio 0.5 --groups 10] [--ssm-registered-ratio 0.8] [--duplicate-ratio 0.1] [--truncated-ratio 0.05]
+        [--latency ec2=30,ssm=20,lambda=50,sqs=10] [--events recorded.jsonl] [--json results.json]
+"""
+import argparse, json, os, random, sys, tempfile, time, uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "common"), os.path.join(ROOT, "auto-tag")]
+
+QUEUE_URL = "https://sqs.us-east-1.amazonaws.com/123456789012/autotag-replay"
+
+os.environ.update({
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    # a fresh idempotency ledger for every run of the script
+    "kv_path": os.path.join(tempfile.mkdtemp(prefix="autotag-replay-"), "ledger.sqlite3"),
+    "sqs_url": QUEUE_URL,
+    "sender_email": "sender@example.com",
+    "slack_application_url": "http://127.0.0.1:9",
+    "slack_channel": "benchmark",
+    "slack_channel_id": "benchmark",
+    "formatted_email": "format-message",
+    "slack_message": "slack-message",
+    "notify_snitch": "notify-snitch",
+    "query_ldap": "ldap-query-attribute",
+    "environment": "prd,dev",
+    "platform": "rhel,win",
+    "role": "security",
+    "urgency": "critical",
+    "order": "first,last",
+    # measure the handler, not the client side rate limits
+    "api_rate_limits": json.dumps({"autoscaling": 1e9, "ec2": 1e9, "ssm": 1e9, "lambda": 1e9, "sqs": 1e9, "secretsmanager": 1e9}),
+})
+
+import boto3
+import aws_clients, api_accounting, fake_aws
+
+DEFAULT_LATENCY = "sqs=10,ec2=30,ssm=20,lambda=50,secretsmanager=20"
+# (PlatformDetails, Platform, SSM PlatformName) as the APIs report them, most Linux AMIs only say Linux/UNIX
+PLATFORMS = [
+    ("Red Hat Enterprise Linux", None, "Red Hat Enterprise Linux Server"),
+    ("Windows", "windows", "Microsoft Windows Server 2019 Datacenter"),
+    ("Linux/UNIX", None, "Ubuntu"),
+    ("Linux/UNIX", None, "Amazon Linux 2"),
+    ("Linux/UNIX", None, "CentOS Linux"),
+]
+
+
+def generate_events(instances, per_event, owners, seed, asg_ratio=0.0, groups=10):
+    """
+    # builds RunInstances events until the requested number of instances is launched
+    :param instances: total instances across all events
+    :param per_event: list of instance counts an event is drawn from
+    :param owners: number of distinct launching users
+    :param seed: random seed
+    :param asg_ratio: share of events that are Auto Scaling group scale-outs
+    :param groups: number of distinct Auto Scaling groups scaling out
+    :return: list of EventBridge events
+    """
+
+    rand = random.Random(seed)
+    events = []
+    launched = 0
+    while launched < instances:
+        count = min(rand.choice(per_event), instances - launched)
+        nt_id = "nt%05d" % rand.randrange(owners)
+        image_id = "ami-%08x" % rand.randrange(16)
+        identity = {
+            "type": "AssumedRole",
+            "principalId": "AROAREPLAYEXAMPLE:" + nt_id,
+            "arn": "arn:aws:sts::123456789012:assumed-role/engineer/" + nt_id,
+        }
+        launch_tags = [{"key": "Name", "value": "replay"}]
+        if rand.random() < asg_ratio:
+            # scale-outs launch one instance per event from the group's fixed image
+            group = rand.randrange(groups)
+            count = 1
+            image_id = "ami-%08x" % group
+            identity = {
+                "type": "AssumedRole",
+                "principalId": "AROAREPLAYASG:AutoScaling",
+                "arn": "arn:aws:sts::123456789012:assumed-role/AWSServiceRoleForAutoScaling/AutoScaling",
+                "invokedBy": "autoscaling.amazonaws.com",
+            }
+            launch_tags.append({"key": "aws:autoscaling:groupName", "value": "replay-asg-%02d" % group})
+        items = []
+        for _ in range(count):
+            items.append({
+                "instanceId": "i-%017x" % rand.getrandbits(68),
+                "imageId": image_id,
+                "instanceType": "t3.micro",
+                "tagSet": {"items": [{"key": "Name", "value": "replay-%d" % launched}]},
+            })
+            launched += 1
+        events.append({
+            "version": "0",
+            "id": str(uuid.UUID(int=rand.getrandbits(128))),
+            "detail-type": "AWS API Call via CloudTrail",
+            "source": "aws.ec2",
+            "region": "us-east-1",
+            "detail": {
+                "eventName": "RunInstances",
+                "eventSource": "ec2.amazonaws.com",
+                "eventID": str(uuid.UUID(int=rand.getrandbits(128))),
+                "userIdentity": identity,
+                "requestParameters": {
+                    "instancesSet": {"items": [{"imageId": image_id, "minCount": count, "maxCount": count}]},
+                    "tagSpecificationSet": {"items": [{"resourceType": "instance", "tags": launch_tags}]},
+                },
+                "responseElements": {"instancesSet": {"items": items}},
+            },
+        })
+    return events
+
+
+def load_events(path):
+    """
+    # reads recorded events, either a JSON list or one event per line
+    :param path: file of EventBridge events or SQS message bodies
+    :return: list of events
+    """
+
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        events = json.loads(text)
+    else:
+        events = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [json.loads(event) if isinstance(event, str) else event for event in events]
+
+
+class FakeFleet(object):
+    """
+    # Instances behind the fake EC2 and SSM clients, with tags drawn per instance id.
+    # The drawn tags and platform are written back into each event's instancesSet,
+    # the way CloudTrail reports the tags a launch was created with.
+    """
+
+    def __init__(self, events, owner_tagged_ratio, valid_patch_ratio, missing_ratio, seed, ssm_registered_ratio=1.0):
+        """
+        :param events: replayed events, every instance in them exists unless it is drawn as missing
+        :param owner_tagged_ratio: share of instances with Owning_Mail and Owning_Team tags
+        :param valid_patch_ratio: share of instances with a valid Patch Group tag
+        :param missing_ratio: share of instances already terminated when they are described
+        :param seed: random seed
+        :param ssm_registered_ratio: share of instances the SSM agent has already registered
+        """
+
+        rand = random.Random(seed)
+        self.instances = {}
+        self.ssm_platforms = {}
+        self.groups = {}
+        self.group_instances = {}
+        images = {}
+        for event in events:
+            request = event["detail"].get("requestParameters") or {}
+            launch_tags = [{"Key": tag["key"], "Value": tag["value"]}
+                           for specification in request.get("tagSpecificationSet", {}).get("items", [])
+                           for tag in specification.get("tags", [])]
+            group = next((tag["Value"] for tag in launch_tags if tag["Key"] == "aws:autoscaling:groupName"), None)
+            if group:
+                self.groups.setdefault(group, {})
+            elements = event["detail"].get("responseElements") or {}
+            for item in elements.get("instancesSet", {}).get("items", []):
+                if group:
+                    self.group_instances[item["instanceId"]] = group
+                if rand.random() < missing_ratio:
+                    continue
+                tags = [tag for tag in launch_tags if tag["Key"] != "Name"]
+                tags += [{"Key": tag["key"], "Value": tag["value"]} for tag in item.get("tagSet", {}).get("items", [])]
+                if rand.random() < owner_tagged_ratio:
+                    tags += [{"Key": "Owning_Mail", "Value": "team@example.com"},
+                             {"Key": "Owning_Team", "Value": "team"}]
+                if rand.random() < valid_patch_ratio:
+                    tags.append({"Key": "Patch Group", "Value": "prd-rhel-security-critical-first"})
+                image_id = item.get("imageId", "ami-00000000")
+                if image_id not in images:
+                    images[image_id] = rand.choice(PLATFORMS)
+                details, platform, ssm_name = images[image_id]
+                instance = {
+                    "InstanceId": item["instanceId"],
+                    "ImageId": image_id,
+                    "State": {"Code": 16, "Name": "running"},
+                    "PlatformDetails": details,
+                    "Tags": tags,
+                }
+                if platform:
+                    instance["Platform"] = platform
+                    item["platform"] = platform
+                item["tagSet"] = {"items": [{"key": tag["Key"], "value": tag["Value"]} for tag in tags]}
+                self.instances[item["instanceId"]] = instance
+                if rand.random() < ssm_registered_ratio:
+                    self.ssm_platforms[item["instanceId"]] = ssm_name
+        self.tagged = 0
+        self.groups_tagged = 0
+
+    def describe_instances(self, params):
+        ids = params.get("InstanceIds") or []
+        missing = [instance_id for instance_id in ids if instance_id not in self.instances]
+        if missing:
+            raise fake_aws.FakeError("InvalidInstanceID.NotFound",
+                                     "The instance IDs '%s' do not exist" % ", ".join(missing))
+        return {"Reservations": [{"ReservationId": "r-" + instance_id[2:], "Instances": [self.instances[instance_id]]}
+                                 for instance_id in ids]}
+
+    def create_tags(self, params):
+        for resource in params["Resources"]:
+            if resource not in self.instances:
+                raise fake_aws.FakeError("InvalidInstanceID.NotFound", "The instance ID '%s' does not exist" % resource)
+        for resource in params["Resources"]:
+            tags = self.instances[resource]["Tags"]
+            keys = set(tag["Key"] for tag in params["Tags"])
+            tags[:] = [tag for tag in tags if tag["Key"] not in keys] + [dict(tag) for tag in params["Tags"]]
+            self.tagged += 1
+        return {}
+
+    def describe_auto_scaling_groups(self, params):
+        names = params.get("AutoScalingGroupNames") or list(self.groups)
+        return {"AutoScalingGroups": [{
+            "AutoScalingGroupName": name,
+            "Tags": [{"ResourceId": name, "ResourceType": "auto-scaling-group", "Key": key, "Value": value,
+                      "PropagateAtLaunch": True} for key, value in self.groups[name].items()],
+        } for name in names if name in self.groups]}
+
+    def describe_auto_scaling_instances(self, params):
+        return {"AutoScalingInstances": [
+            {"InstanceId": instance_id, "AutoScalingGroupName": self.group_instances[instance_id]}
+            for instance_id in params.get("InstanceIds", []) if instance_id in self.group_instances]}
+
+    def create_or_update_tags(self, params):
+        for tag in params["Tags"]:
+            if tag["ResourceId"] not in self.groups:
+                raise fake_aws.FakeError("ValidationError", "AutoScalingGroup name not found - " + tag["ResourceId"])
+        for tag in params["Tags"]:
+            self.groups[tag["ResourceId"]][tag["Key"]] = tag["Value"]
+        self.groups_tagged += len(set(tag["ResourceId"] for tag in params["Tags"]))
+        return {}
+
+    def describe_instance_information(self, params):
+        ids = []
+        for item in params.get("InstanceInformationFilterList", []):
+            if item["key"] == "InstanceIds":
+                ids += item["valueSet"]
+        for item in params.get("Filters", []):
+            if item["Key"] == "InstanceIds":
+                ids += item["Values"]
+        return {"InstanceInformationList": [
+            {"InstanceId": instance_id, "PlatformName": self.ssm_platforms[instance_id], "PingStatus": "Online"}
+            for instance_id in ids if instance_id in self.ssm_platforms]}
+
+
+def invoke(params):
+    """
+    # stands in for the notification and LDAP lambdas
+    :param params: Invoke parameters
+    :return: Invoke response
+    """
+
+    if params["FunctionName"] == os.environ["query_ldap"]:
+        nt_ids = json.loads(params["Payload"])["obj_names"]
+        body = json.dumps({"found": dict((nt_id, {"mail": ["%s@example.com" % nt_id]}) for nt_id in nt_ids)})
+        return {"StatusCode": 200, "Payload": fake_aws.payload({"statusCode": 200, "body": body})}
+    return {"StatusCode": 200, "Payload": fake_aws.payload({"statusCode": 200})}
+
+
+def parse_latency(text):
+    return dict((service, float(ms)) for service, ms in (part.split("=") for part in text.split(",") if part))
+
+
+def install_fakes(fleet, queue, latency):
+    """
+    # builds the fake clients and hands them to aws_clients
+    :param fleet: FakeFleet
+    :param queue: fake_aws.FakeQueue
+    :param latency: dict of service to milliseconds per call
+    :return: dict of service to FakeService
+    """
+
+    api_accounting.install()
+    aws_clients.reset()
+    services = {
+        "sqs": fake_aws.FakeService(queue.handlers(), latency.get("sqs", 0)),
+        "ec2": fake_aws.FakeService({
+            "DescribeInstances": fleet.describe_instances,
+            "CreateTags": fleet.create_tags,
+        }, latency.get("ec2", 0)),
+        "ssm": fake_aws.FakeService({
+            "DescribeInstanceInformation": fleet.describe_instance_information,
+        }, latency.get("ssm", 0)),
+        "autoscaling": fake_aws.FakeService({
+            "DescribeAutoScalingGroups": fleet.describe_auto_scaling_groups,
+            "DescribeAutoScalingInstances": fleet.describe_auto_scaling_instances,
+            "CreateOrUpdateTags": fleet.create_or_update_tags,
+        }, latency.get("autoscaling", 0)),
+        "lambda": fake_aws.FakeService({"Invoke": invoke}, latency.get("lambda", 0)),
+        "secretsmanager": fake_aws.FakeService({
+            "GetSecretValue": lambda params: {
+                "Name": params["SecretId"],
+                "SecretString": json.dumps({"account_name": "replay", "password": "replay"}),
+            },
+        }, latency.get("secretsmanager", 0)),
+    }
+    for service, fake in services.items():
+        client = fake.attach(boto3.client(service))
+        aws_clients.set_client(service, client)
+    aws_clients.set_client("secretsmanager", aws_clients.get_client("secretsmanager"), os.environ["AWS_DEFAULT_REGION"])
+    return services
+
+
+def replay(events, args):
+    """
+    # seeds the queue and invokes the handler until it stops receiving messages
+    :param events: events to replay
+    :param args: parsed command line
+    :return: dict of results
+    """
+
+    import aws_auto_tag
+    aws_auto_tag.URL = QUEUE_URL
+
+    fleet = FakeFleet(events, args.owner_tagged_ratio, args.valid_patch_ratio, args.missing_ratio, args.seed,
+                      args.ssm_registered_ratio)
+    rand = random.Random(args.seed)
+    # oversized events arrive without requestParameters and have to be described
+    for event in events:
+        if rand.random() < args.truncated_ratio:
+            event["detail"]["requestParameters"] = None
+
+    queue = fake_aws.FakeQueue(args.visibility_timeout)
+    for event in events:
+        queue.send(json.dumps(event))
+    # at least once delivery: some events arrive a second time after the originals
+    duplicates = [event for event in events if rand.random() < args.duplicate_ratio]
+    for event in duplicates:
+        queue.send(json.dumps(event))
+    install_fakes(fleet, queue, parse_latency(args.latency))
+
+    accountant = api_accounting.ACCOUNTANT
+    operations = {}
+    errors = []
+    invocations = 0
+    received = last_received = 0
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        while invocations < args.max_invocations:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                aws_auto_tag.lambda_handler({}, None)
+            except Exception as e:
+                errors.append(type(e).__name__ + ": " + str(e))
+            finally:
+                sys.stdout = stdout
+            invocations += 1
+            # read from the accountant so invocations that raised are counted too
+            for operation, counters in accountant.summary()["operations"].items():
+                operations[operation] = operations.get(operation, 0) + counters["calls"]
+            if not queue.depth():
+                break
+            if queue.received == received:
+                if invocations > 1 and queue.received == last_received:
+                    break
+                # what is left is hidden by the visibility timeout, wait for it to be delivered again
+                time.sleep(args.visibility_timeout)
+            last_received, received = received, queue.received
+    elapsed = time.perf_counter() - started
+
+    messages = len(events)
+    instances = sum(len((event["detail"].get("responseElements") or {}).get("instancesSet", {}).get("items", []))
+                    for event in events)
+    total_calls = sum(operations.values())
+    return {
+        "messages": messages,
+        "instances": instances,
+        "duplicates": len(duplicates),
+        "invocations": invocations,
+        "time_to_drain_s": round(elapsed, 3),
+        "messages_per_second": round(messages / elapsed, 2) if elapsed else None,
+        "instances_per_second": round(instances / elapsed, 2) if elapsed else None,
+        "api_calls": total_calls,
+        "api_calls_per_message": round(total_calls / float(messages), 2) if messages else None,
+        "api_calls_by_operation": operations,
+        "received": queue.received,
+        "acknowledged": queue.deleted,
+        "left_in_queue": queue.depth(),
+        "instances_tagged": fleet.tagged,
+        "groups_tagged": fleet.groups_tagged,
+        "handler_errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay RunInstances events through aws_auto_tag")
+    parser.add_argument("--events", help="recorded events, a JSON list or one event per line")
+    parser.add_argument("--instances", type=int, default=2000, help="instances to launch in generated events")
+    parser.add_argument("--per-event", default="1,1,1,5,10,50", help="instance counts generated events are drawn from")
+    parser.add_argument("--asg-ratio", type=float, default=0.0, help="share of generated events that are Auto Scaling scale-outs")
+    parser.add_argument("--groups", type=int, default=10, help="Auto Scaling groups the scale-outs are spread over")
+    parser.add_argument("--owners", type=int, default=50, help="distinct launching users in generated events")
+    parser.add_argument("--owner-tagged-ratio", type=float, default=0.5, help="share of instances with owner tags")
+    parser.add_argument("--valid-patch-ratio", type=float, default=0.5, help="share of instances with a valid Patch Group")
+    parser.add_argument("--missing-ratio", type=float, default=0.0, help="share of instances terminated before they are described")
+    parser.add_argument("--truncated-ratio", type=float, default=0.0, help="share of events without requestParameters")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="share of events delivered a second time")
+    parser.add_argument("--ssm-registered-ratio", type=float, default=0.8, help="share of instances already registered with SSM")
+    parser.add_argument("--latency", default=DEFAULT_LATENCY, help="milliseconds per call for each service")
+    parser.add_argument("--mode", choices=["audit", "enforce"], default="enforce", help="value of the mode variable")
+    parser.add_argument("--visibility-timeout", type=int, default=30, help="seconds a received message stays hidden")
+    parser.add_argument("--max-invocations", type=int, default=20, help="handler invocations before giving up")
+    parser.add_argument("--seed", type=int, default=1, help="seed for generated events and tags")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    os.environ["mode"] = args.mode
+    # the consumer asks for its own visibility timeout on every receive
+    os.environ["sqs_visibility_timeout"] = str(args.visibility_timeout)
+    if args.events:
+        events = load_events(args.events)
+    else:
+        events = generate_events(args.instances, [int(count) for count in args.per_event.split(",")], args.owners, args.seed,
+                                 args.asg_ratio, args.groups)
+
+    result = replay(events, args)
+    for key in ("messages", "instances", "duplicates", "invocations", "time_to_drain_s", "messages_per_second",
+                "instances_per_second", "api_calls", "api_calls_per_message", "received", "acknowledged",
+                "left_in_queue", "instances_tagged", "groups_tagged"):
+        print("%-24s %s" % (key, result[key]))
+    for operation, calls in sorted(result["api_calls_by_operation"].items()):
+        print("    %-40s %d" % (operation, calls))
+    for error in result["handler_errors"]:
+        print("handler error: " + error)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "timestamp": int(time.time()),
+                "python": sys.version.split()[0],
+                "parameters": vars(args),
+                "results": result,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
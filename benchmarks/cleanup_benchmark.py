@@ -0,0 +1,340 @@
+"""
+# Benchmarks the cleanup sweep over deterministic synthetic fleets.
+
+A fleet of instances, AMIs and auto scaling groups is generated from a seed.
+The expired ratio, expiring ratio, owner count and tags per resource can all be
+set. EC2, Auto Scaling and Lambda are real boto3 clients backed by botocore's
+Stubber, so parameter validation, events and API accounting all run as they do
+in Lambda. No network calls are made.
+
+For every fleet size the script reports:
+
+* handler - aws_cleanup.lambda_handler end to end in audit mode
+* add_to_list - classifying every resource of the fleet
+* add_to_emails - grouping every instance of the fleet by owner
+* string_dict - formatting the expired owner dict
+
+Each entry has the median wall time over --repeat runs and the peak traced
+memory from one extra run under tracemalloc. The handler entry also has the API
+call counts from api_accounting. Stubbed responses are queued before the clock
+starts, so they count toward neither time nor memory. The fleet is held in
+memory, so sizes past a few hundred thousand need a lot of RAM.
+
+Usage:
+    python benchmarks/cleanup_benchmark.py [--sizes 1000,10000,100000] [--expired-ratio 0.2]
+        [--owners 500] [--tags 8] [--repeat 3] [--json results.json]
+"""
+import argparse, datetime, json, os, random, statistics, sys, time, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "common"), os.path.join(ROOT, "cleanup")]
+
+os.environ.update({
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "mode": "audit",
+    "expiration_fudge_factor": "5",
+    "except_asg_name": "",
+    "except_image_id": "",
+    "except_instance_id": "",
+    "sender_email": "sender@example.com",
+    "slack_application_url": "http://127.0.0.1:9",
+    "slack_channel": "benchmark",
+    "slack_channel_id": "benchmark",
+    "formatted_email": "format-message",
+    "slack_message": "slack-message",
+    "notify_snitch": "notify-snitch",
+    # measure the sweep itself, not the client side rate limits
+    "api_rate_limits": json.dumps({"autoscaling": 1e9, "ec2": 1e9, "lambda": 1e9}),
+})
+
+import boto3
+from botocore.stub import Stubber
+import aws_clients, api_accounting, aws_cleanup
+
+FUDGE_FACTOR = 5
+PAGE_SIZES = {"asg": 100, "ec2": 1000, "ami": 1000}
+INSTANCES_PER_RESERVATION = 10
+
+
+def build_fleet(size, mix, expired_ratio, expiring_ratio, owners, tags, seed):
+    """
+    # generates the same fleet for the same arguments and day
+    :param size: total number of resources
+    :param mix: dict of resource type to share of the fleet
+    :param expired_ratio: share of resources past the expiration date
+    :param expiring_ratio: share of resources expiring today
+    :param owners: number of distinct owners
+    :param tags: tags per resource, at least the 5 the sweep reads
+    :param seed: random seed
+    :return: dict of resource type to list of (id, tags)
+    """
+
+    rand = random.Random(seed)
+    today = datetime.date.today()
+    fleet = {}
+    for resource, share in sorted(mix.items()):
+        items = []
+        for number in range(int(size * share)):
+            roll = rand.random()
+            if roll < expired_ratio:
+                expiration = today - datetime.timedelta(days=FUDGE_FACTOR + rand.randint(0, 60))
+            elif roll < expired_ratio + expiring_ratio:
+                expiration = today
+            else:
+                expiration = today + datetime.timedelta(days=rand.randint(1, 60))
+            owner = rand.randrange(owners)
+            resource_tags = [
+                {"Key": "Expiration", "Value": expiration.strftime("%Y-%m-%d")},
+                {"Key": "Owning_Mail", "Value": "owner%d@example.com" % owner},
+                {"Key": "Creator_ID", "Value": "nt%05d" % owner},
+                {"Key": "Stack", "Value": "stack%d" % rand.randrange(20)},
+                {"Key": "Role", "Value": "role%d" % rand.randrange(10)},
+            ]
+            for extra in range(max(0, tags - len(resource_tags))):
+                resource_tags.append({"Key": "Tag%d" % extra, "Value": "value%d" % rand.randrange(100)})
+            items.append(("%s-%08x" % (resource, number), resource_tags))
+        fleet[resource] = items
+    return fleet
+
+
+def to_asg(item):
+    name, tags = item
+    return {
+        "AutoScalingGroupName": name,
+        "MinSize": 1,
+        "MaxSize": 1,
+        "DesiredCapacity": 1,
+        "DefaultCooldown": 300,
+        "AvailabilityZones": ["us-east-1a"],
+        "HealthCheckType": "EC2",
+        "CreatedTime": datetime.datetime(2020, 1, 1),
+        "Tags": [dict(tag, ResourceId=name, ResourceType="auto-scaling-group", PropagateAtLaunch=True) for tag in tags],
+    }
+
+
+def to_instance(item):
+    return {"InstanceId": item[0], "Tags": [dict(tag) for tag in item[1]]}
+
+
+def to_image(item):
+    return {"ImageId": item[0], "Tags": [dict(tag) for tag in item[1]]}
+
+
+def pages(items, size, build, token):
+    """
+    # splits items into response pages linked by NextToken
+    :param items: fleet items
+    :param size: items per page
+    :param build: function building one page from a slice of items
+    :param token: name of the pagination token
+    :return: list of responses, always at least one
+    """
+
+    responses = []
+    for start in range(0, max(1, len(items)), size):
+        response = build(items[start:start + size])
+        if start + size < len(items):
+            response[token] = "page-%d" % (start + size)
+        responses.append(response)
+    return responses
+
+
+def expected_invokes(fleet):
+    """
+    # counts the lambda invokes the audit sweep will make for this fleet
+    :param fleet: fleet from build_fleet
+    :return: number of invokes
+    """
+
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    expired_date = aws_cleanup.get_expiration_date(FUDGE_FACTOR)
+    expired_owners = set()
+    expiring_owners = set()
+    for items in fleet.values():
+        for _, tags in items:
+            values = dict((tag["Key"], tag["Value"]) for tag in tags)
+            if values["Expiration"] == today:
+                expiring_owners.add(values["Owning_Mail"])
+            if values["Expiration"] <= expired_date:
+                expired_owners.add(values["Owning_Mail"])
+    # snitch once if anything expired, then one email and one slack message per owner
+    return (1 if expired_owners else 0) + 2 * len(expiring_owners) + 2 * len(expired_owners)
+
+
+def install_stubs(fleet):
+    """
+    # builds stubbed clients with every response of one sweep queued and hands them to aws_clients
+    :param fleet: fleet from build_fleet
+    :return: list of active Stubbers
+    """
+
+    api_accounting.install()
+    aws_clients.reset()
+    stubbers = []
+
+    autoscaling = boto3.client("autoscaling")
+    stubber = Stubber(autoscaling)
+    for response in pages(fleet.get("asg", []), PAGE_SIZES["asg"],
+                          lambda chunk: {"AutoScalingGroups": [to_asg(item) for item in chunk]}, "NextToken"):
+        stubber.add_response("describe_auto_scaling_groups", response)
+    stubbers.append(stubber)
+    aws_clients.set_client("autoscaling", autoscaling)
+
+    ec2 = boto3.client("ec2")
+    stubber = Stubber(ec2)
+    for response in pages(fleet.get("ec2", []), PAGE_SIZES["ec2"], lambda chunk: {"Reservations": [
+            {"ReservationId": "r-%d" % start, "Instances": [to_instance(item) for item in chunk[start:start + INSTANCES_PER_RESERVATION]]}
+            for start in range(0, len(chunk), INSTANCES_PER_RESERVATION)]}, "NextToken"):
+        stubber.add_response("describe_instances", response)
+    for response in pages(fleet.get("ami", []), PAGE_SIZES["ami"],
+                          lambda chunk: {"Images": [to_image(item) for item in chunk]}, "NextToken"):
+        stubber.add_response("describe_images", response)
+    stubbers.append(stubber)
+    aws_clients.set_client("ec2", ec2)
+
+    lambda_client = boto3.client("lambda")
+    stubber = Stubber(lambda_client)
+    for _ in range(expected_invokes(fleet)):
+        stubber.add_response("invoke", {"StatusCode": 200})
+    stubbers.append(stubber)
+    aws_clients.set_client("lambda", lambda_client)
+
+    for stubber in stubbers:
+        stubber.activate()
+    return stubbers
+
+
+def setup_handler(fleet):
+    return install_stubs(fleet)
+
+
+def run_handler(stubbers):
+    """
+    # runs lambda_handler once against the stubbed fleet with its output silenced
+    :param stubbers: Stubbers from install_stubs
+    :return: the handler's response
+    """
+
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            response = aws_cleanup.lambda_handler({}, None)
+        finally:
+            sys.stdout = stdout
+    for stubber in stubbers:
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+    return response
+
+
+def setup_resources(fleet):
+    return [to_instance(item) for item in fleet.get("ec2", [])]
+
+
+def run_add_to_list(resources):
+    aws_cleanup.add_to_list([], {}, {}, aws_cleanup.get_expiration_date(FUDGE_FACTOR), resources, "InstanceId", "")
+
+
+def run_add_to_emails(resources):
+    emails = {}
+    for item in resources:
+        aws_cleanup.add_to_emails(emails, item)
+
+
+def setup_string_dict(fleet):
+    emails = {}
+    for item in setup_resources(fleet):
+        aws_cleanup.add_to_emails(emails, item)
+    return emails
+
+
+def run_string_dict(emails):
+    aws_cleanup.string_dict("expired resource emails", emails)
+
+
+# case name: (setup building the input outside the measurement, measured function)
+CASES = [
+    ("handler", setup_handler, run_handler),
+    ("add_to_list", setup_resources, run_add_to_list),
+    ("add_to_emails", setup_resources, run_add_to_emails),
+    ("string_dict", setup_string_dict, run_string_dict),
+]
+
+
+def measure(fleet, setup, run, repeat):
+    """
+    # times a case several times, then runs it once more under tracemalloc
+    :param fleet: fleet from build_fleet
+    :param setup: function building the case input from the fleet
+    :param run: function being measured
+    :param repeat: timed runs
+    :return: dict of results
+    """
+
+    timings = []
+    response = None
+    for _ in range(repeat):
+        state = setup(fleet)
+        started = time.perf_counter()
+        response = run(state)
+        timings.append(time.perf_counter() - started)
+
+    # tracemalloc slows allocation down, so memory gets its own untimed run
+    state = setup(fleet)
+    tracemalloc.start()
+    run(state)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "wall_ms": round(statistics.median(timings) * 1000.0, 2),
+        "peak_memory_kb": round(peak / 1024.0, 1),
+    }
+    if response and "api_calls" in response:
+        result["api_calls"] = dict((operation, counters["calls"])
+                                   for operation, counters in response["api_calls"]["operations"].items())
+        result["api_calls_total"] = response["api_calls"]["total_calls"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cleanup sweep benchmark over synthetic fleets")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated total fleet sizes")
+    parser.add_argument("--mix", default="ec2:0.7,ami:0.2,asg:0.1", help="share of each resource type")
+    parser.add_argument("--expired-ratio", type=float, default=0.2, help="share of expired resources")
+    parser.add_argument("--expiring-ratio", type=float, default=0.05, help="share of resources expiring today")
+    parser.add_argument("--owners", type=int, default=500, help="distinct owners in the fleet")
+    parser.add_argument("--tags", type=int, default=8, help="tags per resource")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the fleet generator")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--case", action="append", choices=[case[0] for case in CASES], help="only run these cases")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    mix = dict((resource, float(share)) for resource, share in (part.split(":") for part in args.mix.split(",")))
+    results = []
+    print("%-10s %-14s %12s %14s %10s" % ("size", "case", "wall_ms", "peak_memory_kb", "api_calls"))
+    for size in [int(size) for size in args.sizes.split(",")]:
+        fleet = build_fleet(size, mix, args.expired_ratio, args.expiring_ratio, args.owners, args.tags, args.seed)
+        for name, setup, run in CASES:
+            if args.case and name not in args.case:
+                continue
+            result = dict({"size": size, "case": name}, **measure(fleet, setup, run, args.repeat))
+            results.append(result)
+            print("%-10s %-14s %12s %14s %10s" % (size, name, result["wall_ms"], result["peak_memory_kb"],
+                                                  result.get("api_calls_total", "-")))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "timestamp": int(time.time()),
+                "python": sys.version.split()[0],
+                "parameters": dict(vars(args), mix=mix),
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+# In-memory AWS stand-ins for the benchmarks.
+
+FakeService answers calls on a real boto3 client from a before-call hook,
+the same way botocore's Stubber does. Unlike Stubber, responses are built per
+request by Python functions instead of being queued up front, and an optional
+latency is slept on every call. Parameter validation, the other botocore events
+and api_accounting all still run.
+"""
+import io, json, threading, time, uuid
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+
+class FakeError(Exception):
+    """
+    # Raised by a handler to answer with an AWS error code
+    """
+
+    def __init__(self, code, message="", status=400):
+        super(FakeError, self).__init__(code + ": " + message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class FakeService(object):
+    """
+    # Answers a client's operations with handler functions
+    """
+
+    def __init__(self, handlers, latency_ms=0.0):
+        """
+        :param handlers: dict of operation name EX) DescribeInstances to function(params) returning a response dict
+        :param latency_ms: milliseconds slept on every call
+        """
+
+        self.handlers = handlers
+        self.latency = latency_ms / 1000.0
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def attach(self, client):
+        """
+        # routes every call made with the client to the handlers
+        :param client: boto3 client
+        :return: the client
+        """
+
+        client.meta.events.register('before-parameter-build.*', self._capture)
+        client.meta.events.register('before-call.*', self._respond)
+        return client
+
+    def _capture(self, params, context, **kwargs):
+        # before-call only sees the serialized request, so keep the API parameters
+        context['fake_aws_params'] = dict(params)
+
+    def _respond(self, model, context, **kwargs):
+        params = context.get('fake_aws_params', {})
+        with self.lock:
+            self.calls[model.name] = self.calls.get(model.name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = self.handlers.get(model.name)
+        if handler is None:
+            return error_response('UnsupportedOperation', model.name + " is not faked", 400)
+        try:
+            response = handler(params)
+        except FakeError as e:
+            return error_response(e.code, e.message, e.status)
+        response.setdefault('ResponseMetadata', {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': 200})
+        return AWSResponse(None, 200, {}, None), response
+
+
+def error_response(code, message, status):
+    return AWSResponse(None, status, {}, None), {
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': status},
+    }
+
+
+def payload(data):
+    """
+    # wraps a Lambda invoke result the way boto3 returns it
+    :param data: JSON serializable result of the function
+    :return: StreamingBody
+    """
+
+    raw = json.dumps(data).encode('utf-8')
+    return StreamingBody(io.BytesIO(raw), len(raw))
+
+
+class FakeQueue(object):
+    """
+    # SQS queue with visibility timeouts, enough for receive/delete/visibility calls
+    """
+
+    def __init__(self, visibility_timeout=30.0):
+        """
+        :param visibility_timeout: seconds a received message stays hidden
+        """
+
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}
+        self.order = []
+        self.lock = threading.Lock()
+        self.deleted = 0
+        self.received = 0
+
+    def send(self, body):
+        """
+        # enqueues one message
+        :param body: message body string
+        :return: message id
+        """
+
+        with self.lock:
+            message_id = str(uuid.uuid4())
+            self.messages[message_id] = {'Body': body, 'visible_at': 0.0, 'receives': 0}
+            self.order.append(message_id)
+            return message_id
+
+    def depth(self):
+        with self.lock:
+            return len(self.messages)
+
+    def handlers(self):
+        """
+        # operation handlers for FakeService
+        :return: dict of operation name to function
+        """
+
+        return {
+            'ReceiveMessage': self.receive_message,
+            'DeleteMessage': self.delete_message,
+            'DeleteMessageBatch': self.delete_message_batch,
+            'ChangeMessageVisibility': self.change_message_visibility,
+            'ChangeMessageVisibilityBatch': self.change_message_visibility_batch,
+            'GetQueueAttributes': self.get_queue_attributes,
+        }
+
+    def receive_message(self, params):
+        now = time.monotonic()
+        timeout = params.get('VisibilityTimeout', self.visibility_timeout)
+        messages = []
+        with self.lock:
+            for message_id in self.order:
+                if len(messages) >= params.get('MaxNumberOfMessages', 1):
+                    break
+                message = self.messages.get(message_id)
+                if message is None or message['visible_at'] > now:
+                    continue
+                message['visible_at'] = now + timeout
+                message['receives'] += 1
+                handle = message_id + '#' + str(message['receives'])
+                messages.append({'MessageId': message_id, 'ReceiptHandle': handle, 'Body': message['Body']})
+            self.order = [message_id for message_id in self.order if message_id in self.messages]
+            self.received += len(messages)
+        return {'Messages': messages} if messages else {}
+
+    def _delete(self, handle):
+        message_id, receives = handle.rsplit('#', 1)
+        message = self.messages.get(message_id)
+        if message is None or str(message['receives']) != receives:
+            raise FakeError('ReceiptHandleIsInvalid', handle)
+        del self.messages[message_id]
+        self.deleted += 1
+
+    def delete_message(self, params):
+        with self.lock:
+            self._delete(params['ReceiptHandle'])
+        return {}
+
+    def delete_message_batch(self, params):
+        successful = []
+        failed = []
+        with self.lock:
+            for entry in params['Entries']:
+                try:
+                    self._delete(entry['ReceiptHandle'])
+                    successful.append({'Id': entry['Id']})
+                except FakeError as e:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': e.code})
+        return {'Successful': successful, 'Failed': failed}
+
+    def _change_visibility(self, handle, timeout):
+        message_id, receives = handle.rsplit('#', 1)
+        message = self.messages.get(message_id)
+        if message is None or str(message['receives']) != receives:
+            raise FakeError('ReceiptHandleIsInvalid', handle)
+        message['visible_at'] = time.monotonic() + timeout
+
+    def change_message_visibility(self, params):
+        with self.lock:
+            self._change_visibility(params['ReceiptHandle'], params['VisibilityTimeout'])
+        return {}
+
+    def change_message_visibility_batch(self, params):
+        successful = []
+        failed = []
+        with self.lock:
+            for entry in params['Entries']:
+                try:
+                    self._change_visibility(entry['ReceiptHandle'], entry.get('VisibilityTimeout', 0))
+                    successful.append({'Id': entry['Id']})
+                except FakeError as e:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': e.code})
+        return {'Successful': successful, 'Failed': failed}
+
+    def get_queue_attributes(self, params):
+        now = time.monotonic()
+        with self.lock:
+            visible = sum(1 for message in self.messages.values() if message['visible_at'] <= now)
+            return {'Attributes': {
+                'ApproximateNumberOfMessages': str(visible),
+                'ApproximateNumberOfMessagesNotVisible': str(len(self.messages) - visible),
+            }}
@@ -0,0 +1,282 @@
+"""
+# Benchmarks the owner notification chain of the cleanup sweep.
+
+For every owner, aws_cleanup.notify_owners renders the messages with
+string_dict and create_messages, then invokes the format_message Lambda.
+format_message wraps the HTML in the inline-styled template
+(create_email_message) and invokes the send_email Lambda, which calls SES.
+Separately, the slack_message Lambda is invoked, and it posts to Slack.
+
+Here every Lambda hop is dispatched in-process to the real handler through a
+fake_aws Lambda client. SES is a fake_aws client and Slack is a local HTTP
+server. Time is split into:
+
+* render - string_dict, create_messages and create_email_message
+* serialize - every json.dumps/json.loads of the payloads, in the handlers and the
+  Lambda runtime stand-in, on both sides of each hop
+* dispatch per hop - invoke time minus the time spent inside the called handler,
+  i.e. botocore, the executor and the configured latency
+
+Payload bytes are reported per notification for each hop, plus the SES message
+and the Slack post.
+
+The Slack hop sends the same body slack_message.send_message builds, using
+urllib, because current botocore no longer ships botocore.vendored.requests.
+Owners have no Creator_ID, so the Slack user lookup, which calls slack.com
+directly, is not exercised.
+
+Usage:
+    python benchmarks/notify_benchmark.py [--owners 1000,10000,50000] [--stacks-per-owner 3]
+        [--latency lambda=0,ses=0] [--json results.json]
+"""
+import argparse, json, os, sys, threading, time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "common"), os.path.join(ROOT, "cleanup"), os.path.join(ROOT, "functions")]
+
+os.environ.update({
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "sender_email": "sender@example.com",
+    "slack_channel": "benchmark",
+    "slack_channel_id": "benchmark",
+    "formatted_email": "format-message",
+    "slack_message": "slack-message",
+    "send_email": "send-email",
+    "notify_snitch": "notify-snitch",
+    # measure the chain itself, not the client side rate limits
+    "api_rate_limits": json.dumps({"lambda": 1e9, "ses": 1e9}),
+})
+
+import boto3
+import aws_clients, api_accounting, fake_aws
+
+
+class Clock(object):
+    """
+    # Accumulates seconds per bucket, tracking what runs inside a Lambda handler
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = {}
+
+    def add(self, bucket, seconds):
+        with self.lock:
+            self.seconds[bucket] = self.seconds.get(bucket, 0.0) + seconds
+
+    def timed(self, bucket, function):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(bucket, time.perf_counter() - started)
+        return wrapper
+
+
+class TimedJson(object):
+    """
+    # Stands in for the json module inside a handler so its dumps and loads are timed
+    """
+
+    def __init__(self, clock):
+        self.dumps = clock.timed('serialize', json.dumps)
+        self.loads = clock.timed('serialize', json.loads)
+        self.load = clock.timed('serialize', json.load)
+
+
+class SlackStub(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def build_owners(owners, stacks_per_owner):
+    """
+    # owner dict in the shape cleanup builds while classifying
+    :param owners: number of owners
+    :param stacks_per_owner: stacks listed for each owner
+    :return: dict of email to {stack: [roles], 'nt_ids': []}
+    """
+
+    emails = {}
+    for owner in range(owners):
+        entry = {'nt_ids': []}
+        for stack in range(stacks_per_owner):
+            entry['stack%d-owner%d' % (stack, owner)] = ['role%d' % role for role in range(stack % 3 + 1)]
+        emails['owner%d@example.com' % owner] = entry
+    return emails
+
+
+def install(clock, latency, slack_url):
+    """
+    # wires the fake Lambda and SES clients, the in-process dispatcher and the timing wrappers
+    :param clock: Clock collecting the buckets
+    :param latency: dict of service to milliseconds per call
+    :param slack_url: URL of the Slack stub
+    :return: dict of counters filled in while notifications are sent
+    """
+
+    import aws_cleanup, format_message, send_email, slack_message
+    counters = {'ses_bytes': 0, 'slack_bytes': 0}
+
+    handlers = {
+        os.environ['formatted_email']: format_message.lambda_handler,
+        os.environ['send_email']: send_email.lambda_handler,
+        os.environ['slack_message']: slack_message.lambda_handler,
+    }
+
+    # the Lambda runtime's own (de)serialization of the event and result
+    runtime_loads = clock.timed('serialize', json.loads)
+    runtime_payload = clock.timed('serialize', fake_aws.payload)
+
+    def invoke(params):
+        function = params['FunctionName']
+        started = time.perf_counter()
+        event = runtime_loads(params['Payload'])
+        result = handlers[function](event, None)
+        response = {'StatusCode': 200, 'Payload': runtime_payload(result)}
+        clock.add('inside ' + function, time.perf_counter() - started)
+        return response
+
+    def ses_send_email(params):
+        body = params['Message']['Body']
+        counters['ses_bytes'] += len(body['Html']['Data'].encode('utf-8')) + len(body['Text']['Data'].encode('utf-8'))
+        return {'MessageId': 'benchmark'}
+
+    def post_slack(application_url, channel, message):
+        data = ('{"text": "%s"}' % message).encode('utf-8')
+        counters['slack_bytes'] += len(data)
+        urlopen(Request(slack_url, data=data, headers={'Content-type': 'application/json'})).read()
+
+    api_accounting.install()
+    aws_clients.reset()
+    lambda_client = fake_aws.FakeService({'Invoke': invoke}, latency.get('lambda', 0)).attach(boto3.client('lambda'))
+    ses_client = fake_aws.FakeService({'SendEmail': ses_send_email}, latency.get('ses', 0)).attach(boto3.client('ses'))
+    aws_clients.set_client('lambda', lambda_client)
+    aws_clients.set_client('ses', ses_client, os.environ['AWS_DEFAULT_REGION'])
+
+    aws_cleanup.APP_URL = slack_url
+    aws_cleanup.string_dict = clock.timed('render', aws_cleanup.string_dict)
+    aws_cleanup.create_messages = clock.timed('render', aws_cleanup.create_messages)
+    format_message.create_email_message = clock.timed('render', format_message.create_email_message)
+    slack_message.send_message = clock.timed('dispatch slack', post_slack)
+    for module in (aws_cleanup, format_message, send_email, slack_message):
+        module.json = TimedJson(clock)
+    return counters
+
+
+def run(owners, stacks_per_owner, clock, counters):
+    """
+    # notifies every owner once and splits the time into render, serialize and dispatch
+    :param owners: number of owners
+    :param stacks_per_owner: stacks listed in each notification
+    :param clock: Clock the timing wrappers report to
+    :param counters: byte counters from install
+    :return: dict of results
+    """
+
+    import aws_cleanup
+    clock.reset()
+    counters.update(ses_bytes=0, slack_bytes=0)
+    emails = build_owners(owners, stacks_per_owner)
+
+    accountant = api_accounting.ACCOUNTANT
+    accountant.reset()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            started = time.perf_counter()
+            error = aws_cleanup.notify_owners(emails, {}, 5)
+            elapsed = time.perf_counter() - started
+        finally:
+            sys.stdout = stdout
+
+    summary = accountant.summary()
+    hops = {}
+    payload_bytes = {}
+    for function, entry in summary['lambda_invocations'].items():
+        inside = clock.seconds.get('inside ' + function, 0.0) * 1000.0
+        hops['lambda ' + function] = round(entry['total_ms'] - inside, 2)
+        payload_bytes['lambda ' + function] = round(entry['payload_bytes'] / float(owners), 1)
+    ses = summary['operations'].get('ses.SendEmail', {})
+    hops['ses'] = ses.get('total_ms', 0.0)
+    hops['slack'] = round(clock.seconds.get('dispatch slack', 0.0) * 1000.0, 2)
+    payload_bytes['ses'] = round(counters['ses_bytes'] / float(owners), 1)
+    payload_bytes['slack'] = round(counters['slack_bytes'] / float(owners), 1)
+
+    return {
+        'owners': owners,
+        'error': error,
+        'wall_ms': round(elapsed * 1000.0, 2),
+        'per_owner_ms': round(elapsed * 1000.0 / owners, 3),
+        'render_ms': round(clock.seconds.get('render', 0.0) * 1000.0, 2),
+        'serialize_ms': round(clock.seconds.get('serialize', 0.0) * 1000.0, 2),
+        'dispatch_ms': hops,
+        'payload_bytes_per_notification': payload_bytes,
+        'api_calls': summary['total_calls'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Owner notification chain benchmark")
+    parser.add_argument('--owners', default='1000,10000,50000', help="comma separated owner counts")
+    parser.add_argument('--stacks-per-owner', type=int, default=3, help="stacks listed in each notification")
+    parser.add_argument('--latency', default='lambda=0,ses=0', help="milliseconds per call for each service")
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    server = SlackStub(('127.0.0.1', 0), SlackHandler)
+    threading.Thread(target=server.serve_forever).start()
+    slack_url = 'http://127.0.0.1:%d/services/benchmark' % server.server_address[1]
+
+    clock = Clock()
+    latency = dict((service, float(ms)) for service, ms in (part.split('=') for part in args.latency.split(',') if part))
+    counters = install(clock, latency, slack_url)
+
+    results = []
+    try:
+        for owners in [int(owners) for owners in args.owners.split(',')]:
+            result = run(owners, args.stacks_per_owner, clock, counters)
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'timestamp': int(time.time()),
+                'python': sys.version.split()[0],
+                'parameters': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+# Measures cold start cost for every Lambda handler in the repository.
+
+Each handler is imported in a fresh interpreter. The script reports:
+
+* import_ms - importing the handler module
+* boto3_import_ms - importing boto3 afterwards (0 when the handler already pulled it in)
+* first_invoke_ms - the first lambda_handler call, which builds clients and other lazy state
+* warm_invoke_ms - a second call in the same process
+
+AWS calls go to in-process moto by default, or to a local stand-in such as
+moto server when --endpoint-url is given. HTTP endpoints (Slack, Snitch, LDAP)
+point at a closed local port so they fail fast. A handler that errors still
+reports its latency, with the error in the status column.
+
+Usage:
+    python benchmarks/startup_benchmark.py [--repeat 5] [--handler aws_cleanup] [--json results.json]
+"""
+import argparse, contextlib, io, json, os, statistics, subprocess, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOSED_URL = "http://127.0.0.1:9"
+
+BASE_ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "mode": "audit",
+    "sender_email": "sender@example.com",
+    "slack_application_url": CLOSED_URL,
+    "slack_channel": "benchmark",
+    "slack_channel_id": "benchmark",
+    "formatted_email": "format-message",
+    "slack_message": "slack-message",
+    "notify_snitch": "notify-snitch",
+    "query_ldap": "ldap-query-attribute",
+    "send_email": "send-email",
+}
+
+# handler name: (directory, extra environment, event)
+HANDLERS = {
+    "aws_cleanup": ("cleanup", {
+        "expiration_fudge_factor": "5",
+        "except_asg_name": "",
+        "except_image_id": "",
+        "except_instance_id": "",
+    }, {}),
+    "aws_auto_tag": ("auto-tag", {
+        "environment": "prd,dev",
+        "platform": "rhel,win",
+        "role": "security",
+        "urgency": "critical",
+        "order": "first,last",
+        # one short receive instead of a 20 second long poll of the empty queue
+        "sqs_wait_seconds": "0",
+    }, {}),
+    "format_message": ("functions", {}, {
+        "sender_mail": "sender@example.com",
+        "email": "owner@example.com",
+        "subj": "Benchmark",
+        "heading": "Benchmark",
+        "messages": ["<p>benchmark</p>", "benchmark"],
+        "region": "us-east-1",
+    }),
+    "ldap_query_attribute": ("functions", {}, {
+        "domain": "127.0.0.1",
+        "base_dname": "DC=example,DC=com",
+        "bind_dname": "CN=benchmark,DC=example,DC=com",
+        "password": "benchmark",
+        "obj_names": ["benchmark"],
+        "obj_class": "user",
+        "attributes": ["mail"],
+    }),
+    "notify_snitch": ("functions", {
+        "headers": "{}",
+        "snitch_endpoint": CLOSED_URL,
+        "email_recipient": "owner@example.com",
+    }, {
+        "comp_name": "benchmark",
+        "action": "benchmark",
+        "level": "info",
+        "msg": "benchmark",
+    }),
+    "send_email": ("functions", {}, {
+        "email_sender": "sender@example.com",
+        "email": "owner@example.com",
+        "subj": "Benchmark",
+        "heading": "Benchmark",
+        "html_message": "<p>benchmark</p>",
+        "text_message": "benchmark",
+        "region": "us-east-1",
+    }),
+    "slack_message": ("functions", {}, {
+        "application_url": CLOSED_URL,
+        "channel": "benchmark",
+        "message": "benchmark",
+    }),
+}
+
+
+def timed_invoke(module, event):
+    """
+    # calls the handler with its output silenced
+    :param module: imported handler module
+    :param event: event to pass
+    :return: (milliseconds, status)
+    """
+
+    status = "ok"
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            module.lambda_handler(json.loads(json.dumps(event)), None)
+        except BaseException as e:
+            status = "error: " + type(e).__name__
+    return (time.perf_counter() - started) * 1000.0, status
+
+
+def run_child(name, endpoint_url):
+    """
+    # runs one measurement inside a fresh interpreter and prints it as JSON
+    :param name: handler name
+    :param endpoint_url: AWS endpoint of a local stand-in, None for in-process moto
+    :return: N/A
+    """
+
+    directory, env, event = HANDLERS[name]
+    os.environ.update(BASE_ENV)
+    os.environ.update(env)
+    if endpoint_url:
+        os.environ["AWS_ENDPOINT_URL"] = endpoint_url
+    sys.path[:0] = [os.path.join(ROOT, "common"), os.path.join(ROOT, directory)]
+
+    result = {"handler": name}
+    started = time.perf_counter()
+    try:
+        module = __import__(name)
+    except Exception as e:
+        result["status"] = "import error: " + type(e).__name__ + ": " + str(e)
+        print(json.dumps(result))
+        return
+    result["import_ms"] = (time.perf_counter() - started) * 1000.0
+
+    started = time.perf_counter()
+    import boto3
+    result["boto3_import_ms"] = (time.perf_counter() - started) * 1000.0
+
+    mock = None
+    if not endpoint_url:
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+    if name == "aws_auto_tag":
+        queue = boto3.client("sqs").create_queue(QueueName="startup-benchmark")["QueueUrl"]
+        module.URL = queue
+
+    result["first_invoke_ms"], result["status"] = timed_invoke(module, event)
+    result["warm_invoke_ms"], _ = timed_invoke(module, event)
+    if mock:
+        mock.stop()
+    print(json.dumps(result))
+
+
+def measure(name, repeat, endpoint_url):
+    """
+    # runs the child measurement several times and keeps the medians
+    :param name: handler name
+    :param repeat: number of fresh interpreters
+    :param endpoint_url: AWS endpoint or None
+    :return: dict of medians and last status
+    """
+
+    samples = []
+    for _ in range(repeat):
+        command = [sys.executable, os.path.abspath(__file__), "--child", name]
+        if endpoint_url:
+            command += ["--endpoint-url", endpoint_url]
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip().splitlines()
+        samples.append(json.loads(output[-1]) if output else {"handler": name, "status": "no output"})
+
+    result = {"handler": name, "status": samples[-1].get("status"), "samples": len(samples)}
+    for field in ("import_ms", "boto3_import_ms", "first_invoke_ms", "warm_invoke_ms"):
+        values = [sample[field] for sample in samples if field in sample]
+        if values:
+            result[field] = round(statistics.median(values), 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark for the Lambda handlers")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per handler")
+    parser.add_argument("--handler", action="append", choices=sorted(HANDLERS), help="only run these handlers")
+    parser.add_argument("--endpoint-url", help="AWS endpoint of a local stand-in such as moto server")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.endpoint_url)
+        return
+
+    results = [measure(name, args.repeat, args.endpoint_url) for name in (args.handler or sorted(HANDLERS))]
+    print("%-22s %10s %10s %10s %10s  %s" % ("handler", "import_ms", "boto3_ms", "first_ms", "warm_ms", "status"))
+    for result in results:
+        print("%-22s %10s %10s %10s %10s  %s" % (result["handler"], result.get("import_ms", "-"),
+            result.get("boto3_import_ms", "-"), result.get("first_invoke_ms", "-"),
+            result.get("warm_invoke_ms", "-"), result["status"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"timestamp": int(time.time()), "python": sys.version.split()[0], "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-import json, os, boto3, datetime, sys, pprint
+import json, os, datetime, sys, pprint, time
+import aws_clients, aws_executor, api_accounting, tracing, emf_metrics
 
 # Global variable used to send emails and slack messages
 SENDER_EMAIL = os.environ.get("sender_email")
@@ -6,6 +7,9 @@ APP_URL = os.environ.get("slack_application_url")
 CHANNEL = os.environ.get("slack_channel")
 CHANNEL_ID = os.environ.get("slack_channel_id")
 
+# Metrics flushed as CloudWatch EMF documents at the end of each invocation
+METRICS = emf_metrics.MetricsLogger("aws_cleanup")
+
 
 def lambda_handler(event, context):
     """
@@ -15,19 +19,40 @@ def lambda_handler(event, context):
     :return: codes indicating success or failure
     """
 
+    tracing.TRACER.reset()
+    METRICS.reset()
+    try:
+        with tracing.profiled(tracing.profile_mode(event)):
+            return run_cleanup(event, context)
+    finally:
+        scanned = sum(METRICS.total('scan', 'Scanned' + resource) for resource in ('Asg', 'Ec2', 'Ami'))
+        METRICS.put('scan', 'ResourcesScanned', scanned)
+        METRICS.rate('scan', 'ResourcesScannedPerSecond', scanned, tracing.TRACER.summary().get('scan', {}).get('wall_ms', 0) / 1000.0)
+        METRICS.success_rate('notify', 'NotificationsSent', 'NotificationFailures', 'NotificationSuccessRate')
+        METRICS.flush()
+
+
+def run_cleanup(event, context):
+    """
+    # Runs one sweep: scan, classify and enforce each resource type, then report and notify owners
+    :param event: event data in the form of a dict
+    :param context: runtime information of type LambdaContext
+    :return: codes indicating success or failure
+    """
+
     mode = os.environ.get("mode")
     if not mode:
         mode = "audit"
 
     print("Operating in " + mode + " mode")
+    accountant = api_accounting.install()
+    accountant.reset()
         
     fudge_factor = int(os.environ.get("expiration_fudge_factor"))
     if not fudge_factor:
         fudge_factor = 5
 
-    # If a server was to be deleted today, and fudge factor was 5, the server
-    # will be deleted 5 days from today
-    expiration_date = (datetime.date.today() - datetime.timedelta(days = fudge_factor)).strftime('%Y-%m-%d')
+    expiration_date = get_expiration_date(fudge_factor)
 
     expiring_emails = {}
     expired_emails = {}
@@ -41,41 +66,95 @@ def lambda_handler(event, context):
     # search for expirations in ec2 images
     amis = cleanup_ami(mode, expiration_date, expiring_emails, expired_emails)
 
-    print(string_dict("expiring resource emails", expiring_emails))
-    print(string_dict("expired resource emails", expired_emails))
-
-    if asgs or ec2s or amis:
-        msg = {
-            "expired_resources": {
-                "asgs" : asgs,
-                "ec2s" : ec2s,
-                "amis" : amis,
-            },
-            "expiring_resources_email_recipients" : expiring_emails,
-            "expired_resources_email_recipients" : expired_emails
-        }
-        snitch_ret_val = None
-        if mode == "enforce":
-            snitch_ret_val = notify_snitch("enforce_aws_cleanup", "clear resources", "info", msg)
-        else:
-            snitch_ret_val = notify_snitch("audit_aws_cleanup", "clear resources", "info", msg)
-            
-        if snitch_ret_val:
-            return snitch_ret_val
+    snitch_ret_val = report_sweep(mode, asgs, ec2s, amis, expiring_emails, expired_emails, accountant.summary())
+    if snitch_ret_val:
+        return snitch_ret_val
+
+    notify_ret_val = notify_owners(expiring_emails, expired_emails, fudge_factor)
+    if notify_ret_val:
+        return notify_ret_val
+
+    print(accountant.format_table())
+    return {
+        "statusCode": 200,
+        "body": json.dumps('Successful'),
+        "api_calls": accountant.summary(),
+        "stages": tracing.TRACER.summary()
+    }
+
+
+def get_expiration_date(fudge_factor):
+    """
+    # If a server was to be deleted today, and fudge factor was 5, the server
+    # will be deleted 5 days from today
+    :param fudge_factor: days of grace after the Expiration tag
+    :return: expiration date string, resources expiring on or before it are expired
+    """
+
+    return (datetime.date.today() - datetime.timedelta(days = fudge_factor)).strftime('%Y-%m-%d')
+
+
+def report_sweep(mode, asgs, ec2s, amis, expiring_emails, expired_emails, api_calls):
+    """
+    # logs the sweep results and sends the summary to snitch if anything expired
+    :param mode: runs in either audit mode or enforce mode
+    :param asgs: expired auto scaling group names
+    :param ec2s: expired instance ids
+    :param amis: expired image ids
+    :param expiring_emails: contains recipients for expiring resources
+    :param expired_emails: contains recipients for expired resources
+    :param api_calls: API call accounting table
+    :return: any errors from notifying snitch
+    """
+
+    with tracing.span('report'):
+        print(string_dict("expiring resource emails", expiring_emails))
+        print(string_dict("expired resource emails", expired_emails))
+
+        print("API executor metrics: " + json.dumps(aws_executor.get_executor().metrics()))
+
+        if asgs or ec2s or amis:
+            msg = {
+                "expired_resources": {
+                    "asgs" : asgs,
+                    "ec2s" : ec2s,
+                    "amis" : amis,
+                },
+                "expiring_resources_email_recipients" : expiring_emails,
+                "expired_resources_email_recipients" : expired_emails,
+                "api_calls" : api_calls
+            }
+            if mode == "enforce":
+                return notify_snitch("enforce_aws_cleanup", "clear resources", "info", msg)
+            return notify_snitch("audit_aws_cleanup", "clear resources", "info", msg)
+
+    return None
+
+
+def notify_owners(expiring_emails, expired_emails, fudge_factor):
+    """
+    # emails and slacks the owners of expiring and expired resources
+    :param expiring_emails: contains recipients for expiring resources
+    :param expired_emails: contains recipients for expired resources
+    :param fudge_factor: days until expiring resources are terminated
+    :return: the first error from the email or slack lambda, None if all were sent
+    """
 
-    lambda_client = boto3.client('lambda')
     for email in expiring_emails.keys():
         nt_ids = expiring_emails[email]['nt_ids']
         expiring_emails[email].pop('nt_ids')
         
         # send email to resource owner about expired resources
-        messages = create_messages(string_dict("Applications", expiring_emails[email]), "is about to be deleted", "in " + str(fudge_factor) + " days")
-        email_ret_val = send_email(email, messages, "Expiring Application in AWS", "Warning: Your Application is about to be terminated!")
+        with tracing.span('render', template='expiring'):
+            messages = create_messages(string_dict("Applications", expiring_emails[email]), "is about to be deleted", "in " + str(fudge_factor) + " days")
+        with tracing.span('notify', channel='email'):
+            email_ret_val = send_email(email, messages, "Expiring Application in AWS", "Warning: Your Application is about to be terminated!")
         if email_ret_val:
             return email_ret_val
 
         # send slack message to resource owner about expired resources
-        slack_ret_val = send_slack(messages[1].rsplit("\n",6)[0], nt_ids)
+        with tracing.span('notify', channel='slack'):
+            slack_ret_val = send_slack(messages[1].rsplit("\n",6)[0], nt_ids)
         if slack_ret_val:
             return slack_ret_val
 
@@ -84,21 +163,21 @@ def lambda_handler(event, context):
         expired_emails[email].pop('nt_ids')
 
         # send email to resource owner about expiring resources
-        messages = create_messages(string_dict("Applications", expired_emails[email]), "was terminated", "today")
-        email_ret_val = send_email(email, messages, "Expired Resources in AWS", "Alert: Your resources have been terminated")
+        with tracing.span('render', template='expired'):
+            messages = create_messages(string_dict("Applications", expired_emails[email]), "was terminated", "today")
+        with tracing.span('notify', channel='email'):
+            email_ret_val = send_email(email, messages, "Expired Resources in AWS", "Alert: Your resources have been terminated")
         if email_ret_val:
             return email_ret_val
         
 
         # send slack message to resource owner about expiring resources
-        slack_ret_val = send_slack(messages[1].rsplit("\n", 6)[0], nt_ids)
+        with tracing.span('notify', channel='slack'):
+            slack_ret_val = send_slack(messages[1].rsplit("\n", 6)[0], nt_ids)
         if slack_ret_val:
             return slack_ret_val
 
-    return {
-        "statusCode": 200,
-        "body": json.dumps('Successful')
-    }
+    return None
 
 
 def cleanup_asg(mode, expiration_date, expiring_emails, expired_emails):
@@ -113,53 +192,57 @@ def cleanup_asg(mode, expiration_date, expiring_emails, expired_emails):
 
     exceptions = os.environ.get("except_asg_name")
 
-    client = boto3.client('autoscaling')
-    paginator = client.get_paginator('describe_auto_scaling_groups')
-    page_iterator = paginator.paginate(
-        PaginationConfig={'PageSize': 100}
-    )
+    client = aws_clients.get_client('autoscaling')
+    with tracing.span('scan', resource='asg'):
+        pages = aws_executor.paginate(client, 'describe_auto_scaling_groups', MaxRecords=100)
 
-    # Get the emails for resources that expire fudge days before today
-    response = page_iterator.search(
-        'AutoScalingGroups[] | [?contains(Tags[].Key, `Expiration`)]'.format(
-            'Expiration', '*'))
+        # Get the emails for resources that expire fudge days before today
+        response = [asg for page in pages for asg in page['AutoScalingGroups']
+                    if any(tag['Key'] == 'Expiration' for tag in asg['Tags'])]
+    record_scan('Asg', len(response))
 
     expired_asgs = []
-    add_to_list(expired_asgs, expired_emails, expiring_emails, expiration_date, response, "AutoScalingGroupName", exceptions)
+    with tracing.span('classify', resource='asg'):
+        expiring = add_to_list(expired_asgs, expired_emails, expiring_emails, expiration_date, response, "AutoScalingGroupName", exceptions)
+    record_classify('Asg', len(expired_asgs), expiring)
 
     object_print("clearing out asgs: ", expired_asgs)
 
-    # Clear out the ASGs that expire today    
-    if mode == "enforce" and expired_asgs:
-        for asg in expired_asgs:
-            try:
-                date = datetime.datetime.strptime(expiration_date, '%Y-%m-%d') + datetime.timedelta(days = 30)
-                client.update_auto_scaling_group(
-                    AutoScalingGroupName=asg,
-                    MinSize=0,
-                    DesiredCapacity=0
-                )
-                client.create_or_update_tags(
-                    Tags=[
-                        {
-                            'Key': 'Expiration',
-                            'ResourceId': asg,
-                            'ResourceType': 'auto-scaling-group',
-                            'Value': date.strftime('%Y-%m-%d'),
-                            'PropagateAtLaunch': True
-                        },
-                    ],
-                )
-            except Exception as e:
-                asgs = pprint.pformat(expired_asgs)
-                print("An error occured while updating desired auto scaling group size to zero for: " + asgs)
-                print(str(e))
-                snitch_ret_val = notify_snitch("cleanup_asg", "clear auto scaling group data", "error", str(e))
-                if snitch_ret_val:
-                    print("Error notifying snitch!")
-                    return snitch_ret_val
+    with tracing.span('enforce', resource='asg'):
+        # Clear out the ASGs that expire today    
+        if mode == "enforce" and expired_asgs:
+            for asg in expired_asgs:
+                started = time.time()
+                try:
+                    date = datetime.datetime.strptime(expiration_date, '%Y-%m-%d') + datetime.timedelta(days = 30)
+                    aws_executor.call(client, 'update_auto_scaling_group',
+                        AutoScalingGroupName=asg,
+                        MinSize=0,
+                        DesiredCapacity=0
+                    )
+                    aws_executor.call(client, 'create_or_update_tags',
+                        Tags=[
+                            {
+                                'Key': 'Expiration',
+                                'ResourceId': asg,
+                                'ResourceType': 'auto-scaling-group',
+                                'Value': date.strftime('%Y-%m-%d'),
+                                'PropagateAtLaunch': True
+                            },
+                        ],
+                    )
+                    record_enforcement('Asg', started)
+                except Exception as e:
+                    METRICS.put('enforce', 'EnforcementErrors', 1)
+                    asgs = pprint.pformat(expired_asgs)
+                    print("An error occured while updating desired auto scaling group size to zero for: " + asgs)
+                    print(str(e))
+                    snitch_ret_val = notify_snitch("cleanup_asg", "clear auto scaling group data", "error", str(e))
+                    if snitch_ret_val:
+                        print("Error notifying snitch!")
+                        return snitch_ret_val
                     
-                sys.exit()            
+                    sys.exit()            
 
     return expired_asgs
 
@@ -174,30 +257,39 @@ def cleanup_ec2(mode, expiration_date, expiring_emails, expired_emails):
     :return expired_ec2s: returns instances that have expired
     """
 
-    ec2client = boto3.client('ec2')
+    ec2client = aws_clients.get_client('ec2')
     exceptions = os.environ.get("except_instance_id")
 
-    response = query_resources(ec2client, 'instances')
+    with tracing.span('scan', resource='ec2'):
+        response = query_resources(ec2client, 'instances')
+    record_scan('Ec2', sum(len(reservation["Instances"]) for reservation in response.get("Reservations", [])))
     expired_instances = []  
-    for reservation in (response["Reservations"]):
-        add_to_list(expired_instances, expired_emails, expiring_emails, expiration_date, reservation["Instances"], "InstanceId", exceptions)
+    expiring = 0
+    with tracing.span('classify', resource='ec2'):
+        for reservation in (response["Reservations"]):
+            expiring += add_to_list(expired_instances, expired_emails, expiring_emails, expiration_date, reservation["Instances"], "InstanceId", exceptions)
+    record_classify('Ec2', len(expired_instances), expiring)
 
     object_print("terminating instances: ", expired_instances)
 
-    if mode == "enforce" and expired_instances:
-        for instance in expired_instances:
-            try: 
-                ec2client.terminate_instances(InstanceIds=expired_instances)
-            except Exception as e:
-                ec2s = pprint.pformat(expired_instances)
-                print("An error occured while terminating the following instances: " + ec2s)
-                print(str(e))
-                snitch_ret_val = notify_snitch("cleanup_ec2", "terminate instances", "error", str(e))
-                if snitch_ret_val:
-                    print("Error notifying Snitch!")
-                    return snitch_ret_val
+    with tracing.span('enforce', resource='ec2'):
+        if mode == "enforce" and expired_instances:
+            for instance in expired_instances:
+                started = time.time()
+                try: 
+                    aws_executor.call(ec2client, 'terminate_instances', InstanceIds=expired_instances)
+                    record_enforcement('Ec2', started)
+                except Exception as e:
+                    METRICS.put('enforce', 'EnforcementErrors', 1)
+                    ec2s = pprint.pformat(expired_instances)
+                    print("An error occured while terminating the following instances: " + ec2s)
+                    print(str(e))
+                    snitch_ret_val = notify_snitch("cleanup_ec2", "terminate instances", "error", str(e))
+                    if snitch_ret_val:
+                        print("Error notifying Snitch!")
+                        return snitch_ret_val
                     
-                sys.exit()
+                    sys.exit()
 
     return expired_instances
 
@@ -212,25 +304,33 @@ def cleanup_ami(mode, expiration_date, expiring_emails, expired_emails):
     :return expired_amis: returns images that have expired
     """
 
-    client = boto3.client('ec2')
+    client = aws_clients.get_client('ec2')
     exceptions = os.environ.get("except_image_id")
 
-    response = query_resources(client, 'images')
+    with tracing.span('scan', resource='ami'):
+        response = query_resources(client, 'images')
+    record_scan('Ami', len(response.get("Images", [])))
     expired_images = []
-    add_to_list(expired_images, expired_emails, expiring_emails, expiration_date, response["Images"], "ImageId", exceptions)
+    with tracing.span('classify', resource='ami'):
+        expiring = add_to_list(expired_images, expired_emails, expiring_emails, expiration_date, response["Images"], "ImageId", exceptions)
+    record_classify('Ami', len(expired_images), expiring)
 
     object_print("terminating images: ", expired_images)
 
-    if mode == "enforce" and expired_images:
-        for image in expired_images:
-            try:
-                data = client.deregister_image(ImageId=image)
-            except Exception as e:
-                amis = pprint.pformat(expired_images)
-                print( "An error occured while terminating the following images: " + amis)
-                print(str(e))
-                ret_val = notify_snitch("cleanup_ami", "terminate images", "error", str(e))
-                sys.exit()
+    with tracing.span('enforce', resource='ami'):
+        if mode == "enforce" and expired_images:
+            for image in expired_images:
+                started = time.time()
+                try:
+                    data = aws_executor.call(client, 'deregister_image', ImageId=image)
+                    record_enforcement('Ami', started)
+                except Exception as e:
+                    METRICS.put('enforce', 'EnforcementErrors', 1)
+                    amis = pprint.pformat(expired_images)
+                    print( "An error occured while terminating the following images: " + amis)
+                    print(str(e))
+                    ret_val = notify_snitch("cleanup_ami", "terminate images", "error", str(e))
+                    sys.exit()
 
     return expired_images
 
@@ -240,10 +340,10 @@ def query_resources(client, resource_type):
     # Helper method for cleanup_ec2 and cleanup_ami. Searches for tags that have an expiration date
     :param client: Boto3 client for each resource
     :param resource_type: type of resource to describe
-    :return reponse: returns the response from the client after describing it
+    :return reponse: returns the response from the client after describing it, with all pages merged
     """
 
-    return getattr(client, ('describe_' + resource_type))(
+    pages = aws_executor.paginate(client, 'describe_' + resource_type,
         Filters=[
             {
                 'Name': 'tag:Expiration',
@@ -251,6 +351,12 @@ def query_resources(client, resource_type):
             }
         ]
     )
+    response = {}
+    for page in pages:
+        for key, value in page.items():
+            if isinstance(value, list):
+                response.setdefault(key, []).extend(value)
+    return response
 
 
 def add_to_list(resource_list, expired_emails, expiring_emails, expiration_date, response, attribute, exceptions):
@@ -263,9 +369,10 @@ def add_to_list(resource_list, expired_emails, expiring_emails, expiration_date,
     :param response: the reponse from the client after describing
     :param attribute: the attribute to identify an individual resource
     :param exceptions: exceptions of resources to avoid
-    :return: N/A
+    :return: number of resources expiring today
     """
 
+    expiring = 0
     for item in response:
         if item[attribute] not in exceptions:
             expired = False
@@ -275,6 +382,7 @@ def add_to_list(resource_list, expired_emails, expiring_emails, expiration_date,
                     expired_date = datetime.datetime.strptime(expiration_date, "%Y-%m-%d")
                     if date.date() == datetime.date.today():
                         add_to_emails(expiring_emails, item)
+                        expiring += 1
 
                     if date.date() <= expired_date.date():
                         expired = True
@@ -283,6 +391,8 @@ def add_to_list(resource_list, expired_emails, expiring_emails, expiration_date,
             if expired:
                 resource_list.append(item[attribute])
                 add_to_emails(expired_emails, item)
+
+    return expiring
              
 
 def add_to_emails(emails, item):
@@ -322,6 +432,53 @@ def add_to_emails(emails, item):
 
 
 
+def record_scan(resource, count):
+    """
+    # buffers the scan count for one resource type
+    :param resource: resource type suffix EX) Ec2
+    :param count: number of resources returned by the scan
+    :return: N/A
+    """
+
+    METRICS.put('scan', 'Scanned' + resource, count)
+
+
+def record_classify(resource, expired, expiring):
+    """
+    # buffers the expired and expiring counts for one resource type
+    :param resource: resource type suffix EX) Ec2
+    :param expired: number of expired resources
+    :param expiring: number of resources expiring today
+    :return: N/A
+    """
+
+    METRICS.put('classify', 'Expired' + resource, expired)
+    METRICS.put('classify', 'Expiring' + resource, expiring)
+
+
+def record_enforcement(resource, started):
+    """
+    # buffers the latency of one enforcement action
+    :param resource: resource type suffix EX) Ec2
+    :param started: time.time() when the action started
+    :return: N/A
+    """
+
+    METRICS.put('enforce', 'Enforced' + resource, 1)
+    METRICS.put('enforce', 'EnforcementLatency', round((time.time() - started) * 1000.0, 3), 'Milliseconds')
+
+
+def record_notification(ret_val):
+    """
+    # counts a notification as sent or failed
+    :param ret_val: the error returned by checkError, None on success
+    :return: ret_val unchanged
+    """
+
+    METRICS.put('notify', 'NotificationFailures' if ret_val else 'NotificationsSent', 1)
+    return ret_val
+
+
 def object_print(message, structure):
     """
     # Prints a data structure
@@ -396,14 +553,14 @@ def notify_snitch(comp_name, action, level, msg):
     :param msg: message to send to snitch
     :return: any errors from lambda invoke
     """
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_clients.get_client('lambda')
     data = {
         'comp_name': comp_name, 
         'action':action, 
         'level': level, 
         'msg': msg
     }          
-    invoke_response = lambda_client.invoke(
+    invoke_response = aws_executor.call(lambda_client, 'invoke',
         FunctionName= os.environ.get("notify_snitch"),
         InvocationType= "RequestResponse",
         Payload= json.dumps(data)
@@ -420,7 +577,7 @@ def send_email(email, messages, subj, heading):
     :param heading: heading line
     :return: any errors from lambda invoke
     """
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_clients.get_client('lambda')
     email_data = {
         'sender_mail': SENDER_EMAIL,
         'email': email,
@@ -429,12 +586,12 @@ def send_email(email, messages, subj, heading):
         'messages': messages, 
         'region': os.environ.get("AWS_DEFAULT_REGION")
     }
-    invoke_email_response = lambda_client.invoke(
+    invoke_email_response = aws_executor.call(lambda_client, 'invoke',
         FunctionName= os.environ.get("formatted_email"),
         InvocationType= "RequestResponse",
         Payload= json.dumps(email_data)
     )
-    return checkError(invoke_email_response, "Error sending email!")
+    return record_notification(checkError(invoke_email_response, "Error sending email!"))
     
 
 def send_slack(message, nt_ids):
@@ -444,7 +601,7 @@ def send_slack(message, nt_ids):
     :param nt_ids: list containing nt_ids
     :return: any errors from lambda invoke
     """
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_clients.get_client('lambda')
     slack_data = {
             'application_url': APP_URL,
             'channel': CHANNEL,
@@ -454,12 +611,12 @@ def send_slack(message, nt_ids):
     if nt_ids:
         slack_data['nt_ids'] = nt_ids
 
-    invoke_slack_response = lambda_client.invoke(
+    invoke_slack_response = aws_executor.call(lambda_client, 'invoke',
         FunctionName= os.environ.get("slack_message"),
         InvocationType= "RequestResponse",
         Payload= json.dumps(slack_data)
     )
-    return checkError(invoke_slack_response, "Error notifying snitch!")
+    return record_notification(checkError(invoke_slack_response, "Error notifying snitch!"))
 
 
 def checkError(invoke_response, message):
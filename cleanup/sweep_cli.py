@@ -0,0 +1,223 @@
+"""
+# Offline runner for the cleanup sweep.
+
+Runs the same scan, classify, enforce and notify code as the cleanup Lambda,
+but from a workstation or build host with no 15 minute limit. The sweep is
+split into shards of (region, resource type), spread over a multiprocessing
+pool. Finished shards are written to a checkpoint file, so an interrupted run
+can be picked up again with --resume.
+
+Examples:
+    python cleanup/sweep_cli.py --regions us-east-1,us-west-2 --dry-run
+    python cleanup/sweep_cli.py --mode enforce --processes 8 --resume
+    python cleanup/sweep_cli.py --endpoint-url http://localhost:5000 --dry-run
+"""
+import argparse, json, multiprocessing, os, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(os.path.dirname(HERE), 'common'), HERE]
+
+import aws_clients, aws_cleanup
+
+# resource type: (sweep function, metric suffix used by aws_cleanup)
+RESOURCE_TYPES = {
+    'asg': (aws_cleanup.cleanup_asg, 'Asg'),
+    'ec2': (aws_cleanup.cleanup_ec2, 'Ec2'),
+    'ami': (aws_cleanup.cleanup_ami, 'Ami'),
+}
+
+
+def sweep_shard(shard):
+    """
+    # scans, classifies and (in enforce mode) cleans up one region and resource type
+    :param shard: dict with region, resource, mode and expiration_date
+    :return: dict with the expired resources, owner emails and timings
+    """
+
+    os.environ['AWS_DEFAULT_REGION'] = shard['region']
+    aws_clients.reset()
+    aws_cleanup.METRICS.reset()
+
+    sweep, suffix = RESOURCE_TYPES[shard['resource']]
+    result = dict(shard)
+    expiring_emails = {}
+    expired_emails = {}
+    started = time.time()
+    try:
+        expired = sweep(shard['mode'], shard['expiration_date'], expiring_emails, expired_emails)
+        # the sweep functions hand back snitch errors as a dict instead of a list
+        if isinstance(expired, dict):
+            raise RuntimeError(json.dumps(expired))
+        result['expired'] = expired
+        result['status'] = 'done'
+    except BaseException as e:
+        # sys.exit() in the enforce path must not take the pool worker down
+        result['expired'] = []
+        result['status'] = 'failed'
+        result['error'] = type(e).__name__ + ': ' + str(e)
+    result['expiring_emails'] = expiring_emails
+    result['expired_emails'] = expired_emails
+    result['scanned'] = aws_cleanup.METRICS.total('scan', 'Scanned' + suffix)
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+
+def merge_emails(target, source):
+    """
+    # merges one shard's owner email dict into the running total
+    :param target: dict of email to {stack: [roles], 'nt_ids': [ids]}
+    :param source: dict in the same shape
+    :return: N/A
+    """
+
+    for email, stacks in source.items():
+        entry = target.setdefault(email, {'nt_ids': []})
+        for stack, values in stacks.items():
+            merged = entry.setdefault(stack, [])
+            for value in values:
+                if value not in merged:
+                    merged.append(value)
+
+
+def shard_key(shard):
+    return shard['region'] + '/' + shard['resource']
+
+
+def load_checkpoint(path, mode, expiration_date, resume):
+    """
+    # loads the previous run's checkpoint, starting over if it was for a different sweep
+    :param path: checkpoint file
+    :param mode: audit or enforce
+    :param expiration_date: expiration date of this run
+    :param resume: only reuse the file when --resume was given
+    :return: checkpoint dict
+    """
+
+    fresh = {'mode': mode, 'expiration_date': expiration_date, 'shards': {}, 'notified': False}
+    if not resume or not os.path.exists(path):
+        return fresh
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('mode') != mode or checkpoint.get('expiration_date') != expiration_date:
+        print("Checkpoint " + path + " is for a different sweep, starting over")
+        return fresh
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """
+    # writes the checkpoint atomically so a crash never leaves a partial file
+    :param path: checkpoint file
+    :param checkpoint: checkpoint dict
+    :return: N/A
+    """
+
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(temp, path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep expired AWS resources outside of Lambda")
+    parser.add_argument('--mode', choices=['audit', 'enforce'], default=os.environ.get('mode') or 'audit',
+                        help="enforce terminates expired resources, audit only reports them")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="audit mode without Snitch, email or Slack notifications")
+    parser.add_argument('--regions', default=os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1',
+                        help="comma separated regions to sweep")
+    parser.add_argument('--resources', default=','.join(sorted(RESOURCE_TYPES)),
+                        help="comma separated resource types: " + ', '.join(sorted(RESOURCE_TYPES)))
+    parser.add_argument('--fudge-factor', type=int, default=int(os.environ.get('expiration_fudge_factor') or 5),
+                        help="days of grace after the Expiration tag")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes in the pool")
+    parser.add_argument('--checkpoint', default='cleanup_sweep_checkpoint.json',
+                        help="file recording finished shards")
+    parser.add_argument('--resume', action='store_true', help="skip shards finished by a previous run")
+    parser.add_argument('--endpoint-url', help="AWS endpoint of a local stand-in such as moto server")
+    parser.add_argument('--report', help="write the final results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    mode = 'audit' if args.dry_run else args.mode
+    if args.endpoint_url:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url
+    for name in ('except_asg_name', 'except_image_id', 'except_instance_id'):
+        os.environ.setdefault(name, '')
+
+    expiration_date = aws_cleanup.get_expiration_date(args.fudge_factor)
+    checkpoint = load_checkpoint(args.checkpoint, mode, expiration_date, args.resume)
+    shards = [{'region': region.strip(), 'resource': resource.strip(), 'mode': mode, 'expiration_date': expiration_date}
+              for region in args.regions.split(',') if region.strip()
+              for resource in args.resources.split(',') if resource.strip()]
+    pending = [shard for shard in shards if checkpoint['shards'].get(shard_key(shard), {}).get('status') != 'done']
+
+    print("Sweeping %d shards in %s mode (%d already done), expiration date %s"
+          % (len(shards), mode, len(shards) - len(pending), expiration_date))
+
+    started = time.time()
+    scanned = 0
+    if pending:
+        pool = multiprocessing.Pool(max(1, min(args.processes, len(pending))))
+        try:
+            for count, result in enumerate(pool.imap_unordered(sweep_shard, pending), 1):
+                checkpoint['shards'][shard_key(result)] = result
+                save_checkpoint(args.checkpoint, checkpoint)
+                scanned += result['scanned']
+                elapsed = time.time() - started
+                print("[%d/%d] %s %s: %d scanned, %d expired in %.1fs | %d scanned total, %.1f resources/s"
+                      % (count, len(pending), shard_key(result), result['status'], result['scanned'],
+                         len(result['expired']), result['seconds'], scanned, scanned / elapsed if elapsed else 0.0))
+                if result['status'] != 'done':
+                    print("    " + result['error'])
+        finally:
+            pool.close()
+            pool.join()
+
+    results = [checkpoint['shards'][shard_key(shard)] for shard in shards]
+    failed = [shard_key(result) for result in results if result.get('status') != 'done']
+    expired = dict((resource, []) for resource in RESOURCE_TYPES)
+    expiring_emails = {}
+    expired_emails = {}
+    for result in results:
+        expired[result['resource']].extend(result['expired'])
+        merge_emails(expiring_emails, result['expiring_emails'])
+        merge_emails(expired_emails, result['expired_emails'])
+
+    if failed:
+        print("Failed shards, rerun with --resume to retry: " + ', '.join(failed))
+    elif args.dry_run:
+        print(aws_cleanup.string_dict("expiring resource emails", expiring_emails))
+        print(aws_cleanup.string_dict("expired resource emails", expired_emails))
+    elif not checkpoint['notified']:
+        ret_val = aws_cleanup.report_sweep(mode, expired['asg'], expired['ec2'], expired['ami'],
+                                           expiring_emails, expired_emails, None)
+        ret_val = ret_val or aws_cleanup.notify_owners(expiring_emails, expired_emails, args.fudge_factor)
+        if ret_val:
+            print("Error notifying owners: " + json.dumps(ret_val))
+            failed.append('notify')
+        else:
+            checkpoint['notified'] = True
+            save_checkpoint(args.checkpoint, checkpoint)
+
+    summary = {
+        'mode': mode,
+        'expiration_date': expiration_date,
+        'expired': expired,
+        'failed_shards': failed,
+        'scanned': sum(result['scanned'] for result in results),
+        'seconds': round(time.time() - started, 3),
+    }
+    print(json.dumps(summary))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(dict(summary, expiring_emails=expiring_emails, expired_emails=expired_emails), f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import threading, time
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+# Upper bounds (milliseconds) of the latency histogram buckets
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_START_KEY = 'api_accounting_start'
+
+
+class ApiAccountant(object):
+    """
+    # Records count, latency histogram, retries and bytes for every AWS operation
+    # by listening on the botocore before-call/after-call events
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.invocations = {}
+
+    def reset(self):
+        """
+        # clears the counters, called at the start of each invocation
+        :return: N/A
+        """
+
+        with self.lock:
+            self.operations = {}
+            self.invocations = {}
+
+    def register(self, events):
+        """
+        # hooks the accountant onto a botocore event emitter
+        :param events: the events attribute of a boto3 session or client
+        :return: N/A
+        """
+
+        events.register('before-parameter-build', self.before_parameter_build, unique_id='api-accounting-start')
+        events.register('before-call', self.before_call, unique_id='api-accounting-before')
+        events.register('after-call', self.after_call, unique_id='api-accounting-after')
+        events.register('after-call-error', self.after_call_error, unique_id='api-accounting-error')
+
+    def before_parameter_build(self, params, model, context, **kwargs):
+        # after-call-error only carries the context, so keep the model there
+        context[_START_KEY] = time.time()
+        context['api_accounting_model'] = model
+        if model.name == 'Invoke':
+            context['api_accounting_function'] = params.get('FunctionName')
+            payload = params.get('Payload') or b''
+            context['api_accounting_payload_bytes'] = len(payload) if isinstance(payload, (bytes, str)) else 0
+
+    def before_call(self, params, context, **kwargs):
+        # not reached when a Stubber answers the call
+        body = params.get('body')
+        if isinstance(body, dict):
+            body = urlencode(body)
+        context['api_accounting_request_bytes'] = len(body) if isinstance(body, (bytes, str)) else 0
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) if parsed else 0
+        error = http_response is None or http_response.status_code >= 300
+        self._record(model, context, retries, _response_bytes(http_response, model), error)
+
+    def after_call_error(self, context, exception=None, **kwargs):
+        model = context.get('api_accounting_model')
+        if model is not None:
+            self._record(model, context, 0, 0, True)
+
+    def _record(self, model, context, retries, response_bytes, error):
+        start = context.get(_START_KEY)
+        elapsed = (time.time() - start) * 1000.0 if start else 0.0
+        key = model.service_model.service_name + '.' + model.name
+        with self.lock:
+            entry = self.operations.get(key)
+            if entry is None:
+                entry = self.operations[key] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'request_bytes': 0,
+                    'response_bytes': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            entry['calls'] += 1
+            entry['errors'] += 1 if error else 0
+            entry['retries'] += retries
+            entry['request_bytes'] += context.get('api_accounting_request_bytes', 0)
+            entry['response_bytes'] += response_bytes
+            entry['total_ms'] += elapsed
+            entry['max_ms'] = max(entry['max_ms'], elapsed)
+            entry['histogram'][_bucket_index(elapsed)] += 1
+
+            function = context.get('api_accounting_function')
+            if function:
+                invocation = self.invocations.setdefault(function, {
+                    'invokes': 0,
+                    'errors': 0,
+                    'total_ms': 0.0,
+                    'payload_bytes': 0,
+                })
+                invocation['invokes'] += 1
+                invocation['errors'] += 1 if error else 0
+                invocation['total_ms'] += elapsed
+                invocation['payload_bytes'] += context.get('api_accounting_payload_bytes', 0)
+
+    def summary(self):
+        """
+        # per operation table plus per function Lambda invoke totals
+        :return: JSON serializable dict
+        """
+
+        with self.lock:
+            operations = {}
+            for key, entry in sorted(self.operations.items()):
+                row = dict(entry)
+                row['total_ms'] = round(entry['total_ms'], 1)
+                row['max_ms'] = round(entry['max_ms'], 1)
+                row['histogram'] = _label_histogram(entry['histogram'])
+                operations[key] = row
+
+            invocations = {}
+            for function, entry in sorted(self.invocations.items()):
+                row = dict(entry)
+                row['total_ms'] = round(entry['total_ms'], 1)
+                invocations[function] = row
+
+            return {
+                'operations': operations,
+                'lambda_invocations': invocations,
+                'total_calls': sum(entry['calls'] for entry in self.operations.values()),
+            }
+
+    def format_table(self):
+        """
+        # renders the operation table as fixed width text for the logs
+        :return: string table
+        """
+
+        lines = ['%-50s %7s %6s %7s %10s %10s %9s' % ('operation', 'calls', 'errors', 'retries', 'bytes', 'total_ms', 'max_ms')]
+        for key, row in self.summary()['operations'].items():
+            lines.append('%-50s %7d %6d %7d %10d %10.1f %9.1f' % (key, row['calls'], row['errors'], row['retries'],
+                row['response_bytes'], row['total_ms'], row['max_ms']))
+        return '\n'.join(lines)
+
+
+def _bucket_index(elapsed):
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= bound:
+            return index
+    return len(LATENCY_BUCKETS)
+
+
+def _label_histogram(counts):
+    labels = ['<=%dms' % bound for bound in LATENCY_BUCKETS] + ['>%dms' % LATENCY_BUCKETS[-1]]
+    return dict((label, count) for label, count in zip(labels, counts) if count)
+
+
+def _response_bytes(http_response, model):
+    """
+    # size of a response body without consuming streaming payloads
+    """
+
+    if http_response is None:
+        return 0
+    length = http_response.headers.get('content-length') if http_response.headers else None
+    if length:
+        return int(length)
+    if model.has_streaming_output or http_response.raw is None:
+        return 0
+    return len(http_response.content or b'')
+
+
+ACCOUNTANT = ApiAccountant()
+_INSTALLED = set()
+
+
+def install(session=None):
+    """
+    # registers the shared accountant on a boto3 session so every client created from it is counted
+    :param session: boto3 session, defaults to the boto3 default session
+    :return: the shared ApiAccountant
+    """
+
+    if session is None:
+        import boto3
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        session = boto3.DEFAULT_SESSION
+
+    if id(session) not in _INSTALLED:
+        _INSTALLED.add(id(session))
+        ACCOUNTANT.register(session.events)
+    return ACCOUNTANT
+
+
+def instrument(client):
+    """
+    # registers the shared accountant on a client created outside an installed session
+    :param client: boto3 client
+    :return: the client
+    """
+
+    ACCOUNTANT.register(client.meta.events)
+    return client
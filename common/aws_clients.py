@@ -0,0 +1,58 @@
+import threading
+
+# boto3 clients shared across warm invocations, created on first use
+_CLIENTS = {}
+
+# botocore makes one attempt per call, aws_executor is the only retry layer so its
+# token buckets see every throttle and one call is never retried by both
+RETRIES = {'total_max_attempts': 1}
+_LOCK = threading.Lock()
+
+
+def get_client(service, region_name=None):
+    """
+    # returns the cached client for a service, importing boto3 and creating the client on first use.
+    # Clients are created without botocore's retries, aws_executor retries throttled calls
+    :param service: AWS service name EX) ec2
+    :param region_name: region for the client, defaults to the Lambda region
+    :return: boto3 client
+    """
+
+    key = (service, region_name)
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                config = Config(retries=RETRIES)
+                if region_name:
+                    client = boto3.client(service, region_name=region_name, config=config)
+                else:
+                    client = boto3.client(service, config=config)
+                _CLIENTS[key] = client
+    return client
+
+
+def set_client(service, client, region_name=None):
+    """
+    # installs a client for a service, used to point the handlers at local stand-ins
+    :param service: AWS service name
+    :param client: client object to hand out
+    :param region_name: region the client is registered under
+    :return: N/A
+    """
+
+    with _LOCK:
+        _CLIENTS[(service, region_name)] = client
+
+
+def reset():
+    """
+    # drops every cached client
+    :return: N/A
+    """
+
+    with _LOCK:
+        _CLIENTS.clear()
@@ -0,0 +1,260 @@
+import json, os, random, threading, time
+
+# Error codes AWS services use to signal that a caller is being throttled
+THROTTLE_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'SlowDown',
+    'EC2ThrottledException',
+])
+
+# Starting requests per second for each service. A "service.operation" key in
+# the api_rate_limits environment variable overrides a single operation.
+DEFAULT_RATES = {
+    'autoscaling': 10.0,
+    'dynamodb': 50.0,
+    'ec2': 20.0,
+    'lambda': 10.0,
+    'resourcegroupstaggingapi': 5.0,
+    's3': 20.0,
+    'secretsmanager': 20.0,
+    'ses': 10.0,
+    'sqs': 50.0,
+    'ssm': 10.0,
+}
+FALLBACK_RATE = 10.0
+MIN_RATE = 0.5
+
+
+class TokenBucket(object):
+    """
+    # Token bucket whose refill rate adapts to throttling responses. The rate is
+    # halved on every throttle and grows back additively on success, up to the
+    # configured ceiling.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: ceiling and starting rate in requests per second
+        :param burst: maximum tokens that can be saved up, defaults to one second of rate
+        """
+
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        # blocks until a token is available
+        :return: seconds spent waiting
+        """
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        """
+        # multiplicative decrease after a throttling response
+        :return: N/A
+        """
+
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2.0)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        """
+        # additive increase after a successful call
+        :return: N/A
+        """
+
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+class CallExecutor(object):
+    """
+    # Runs boto3 client calls behind per service/operation token buckets and
+    # retries throttled calls with jittered exponential backoff
+    """
+
+    def __init__(self, rates=None, max_attempts=8, base_delay=0.25, max_delay=20.0):
+        """
+        :param rates: dict of "service" or "service.operation" to requests per second
+        :param max_attempts: attempts per call before a throttling error is raised
+        :param base_delay: first backoff ceiling in seconds
+        :param max_delay: largest backoff ceiling in seconds
+        """
+
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """
+        # builds an executor from the api_rate_limits and api_max_attempts environment variables
+        :return: CallExecutor
+        """
+
+        rates = json.loads(os.environ.get("api_rate_limits") or "{}")
+        max_attempts = int(os.environ.get("api_max_attempts") or 8)
+        return cls(rates=rates, max_attempts=max_attempts)
+
+    def _bucket(self, key, service):
+        with self.lock:
+            if key not in self.buckets:
+                rate = self.rates.get(key, self.rates.get(service, FALLBACK_RATE))
+                self.buckets[key] = TokenBucket(rate)
+                self.stats[key] = {
+                    'calls': 0,
+                    'throttles': 0,
+                    'retries': 0,
+                    'errors': 0,
+                    'wait_seconds': 0.0,
+                }
+            return self.buckets[key]
+
+    def _record(self, key, field, amount=1):
+        with self.lock:
+            self.stats[key][field] += amount
+
+    def call(self, client, operation, **kwargs):
+        """
+        # calls a client operation once a token is available, retrying throttled calls
+        :param client: boto3 client
+        :param operation: name of the client method EX) describe_instances
+        :param kwargs: parameters for the operation
+        :return: the operation's response
+        """
+
+        service = client.meta.service_model.service_name
+        key = service + '.' + operation
+        bucket = self._bucket(key, service)
+        method = getattr(client, operation)
+
+        attempt = 0
+        while True:
+            self._record(key, 'wait_seconds', bucket.acquire())
+            self._record(key, 'calls')
+            try:
+                response = method(**kwargs)
+            except Exception as e:
+                # botocore ClientErrors carry the parsed error, checked by duck type so
+                # botocore is not imported before the first client is built
+                code = (getattr(e, 'response', None) or {}).get('Error', {}).get('Code')
+                if code not in THROTTLE_CODES:
+                    self._record(key, 'errors')
+                    raise
+                self._record(key, 'throttles')
+                bucket.throttled()
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    self._record(key, 'errors')
+                    raise
+                self._record(key, 'retries')
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+                continue
+
+            bucket.succeeded()
+            return response
+
+    def paginate(self, client, operation, token_key='NextToken', **kwargs):
+        """
+        # yields each page of a paginated operation, every page going through call()
+        :param client: boto3 client
+        :param operation: name of the client method
+        :param token_key: name of the pagination token in both the request and response
+        :param kwargs: parameters for the operation
+        :return: generator of response pages
+        """
+
+        while True:
+            page = self.call(client, operation, **kwargs)
+            yield page
+            token = page.get(token_key)
+            if not token:
+                return
+            kwargs[token_key] = token
+
+    def metrics(self):
+        """
+        # snapshot of the per operation counters and current adaptive rates
+        :return: dict keyed by "service.operation"
+        """
+
+        with self.lock:
+            snapshot = {}
+            for key, counters in self.stats.items():
+                snapshot[key] = dict(counters)
+                snapshot[key]['wait_seconds'] = round(counters['wait_seconds'], 3)
+                snapshot[key]['rate'] = round(self.buckets[key].rate, 2)
+            return snapshot
+
+
+_DEFAULT = None
+_DEFAULT_LOCK = threading.Lock()
+
+
+def get_executor():
+    """
+    # returns the executor shared by every caller in this container
+    :return: CallExecutor
+    """
+
+    global _DEFAULT
+    if _DEFAULT is None:
+        with _DEFAULT_LOCK:
+            if _DEFAULT is None:
+                _DEFAULT = CallExecutor.from_environment()
+    return _DEFAULT
+
+
+def call(client, operation, **kwargs):
+    """
+    # runs a client operation through the shared executor
+    :param client: boto3 client
+    :param operation: name of the client method
+    :param kwargs: parameters for the operation
+    :return: the operation's response
+    """
+
+    return get_executor().call(client, operation, **kwargs)
+
+
+def paginate(client, operation, token_key='NextToken', **kwargs):
+    """
+    # pages through an operation with the shared executor
+    :param client: boto3 client
+    :param operation: name of the client method
+    :param token_key: name of the pagination token
+    :param kwargs: parameters for the operation
+    :return: generator of response pages
+    """
+
+    return get_executor().paginate(client, operation, token_key, **kwargs)
@@ -0,0 +1,247 @@
+import array, heapq, mmap, os, shutil, struct, threading, time
+import aws_clients, aws_executor
+
+# file layout: header, one offset per record, then the records sorted by name.
+# A record is a 2 byte length and "name<TAB>mail<TAB>slack id" in UTF-8, the
+# name lowercased, so a lookup is a binary search over the offsets
+MAGIC = b'DIX1'
+HEADER = struct.Struct('<4sI')
+OFFSET = struct.Struct('<I')
+LENGTH = struct.Struct('<H')
+
+DEFAULT_TTL = 3600
+LOCAL_COPY = '/tmp/directory_index.bin'
+# names sorted in memory at a time while writing an index
+RUN_SIZE = 100000
+
+_INDEX = None
+_LOCK = threading.Lock()
+
+
+class DirectoryIndex(object):
+    """
+    # Read-only view of an exported directory index. The file is memory
+    # mapped, so opening it costs nothing up front and a lookup is a binary
+    # search touching a few pages.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: local path of the index file
+        """
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(path + " is not a directory index")
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, position):
+        start = OFFSET.unpack_from(self.data, HEADER.size + position * OFFSET.size)[0]
+        length = LENGTH.unpack_from(self.data, start)[0]
+        return self.data[start + LENGTH.size:start + LENGTH.size + length]
+
+    def lookup(self, name):
+        """
+        # finds one name
+        :param name: name to look up EX) an nt_id, case insensitive
+        :return: dict with mail and slack_id, None when the name is not in the index
+        """
+
+        key = name.lower().encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            found = record.split(b'\t', 1)[0]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                fields = record.decode('utf-8').split('\t')
+                return {'mail': fields[1] or None, 'slack_id': fields[2] or None}
+        return None
+
+    def lookup_many(self, names):
+        """
+        # finds many names
+        :param names: names to look up
+        :return: dict of the names that are in the index to dict with mail and slack_id
+        """
+
+        found = {}
+        for name in names:
+            entry = self.lookup(name)
+            if entry is not None:
+                found[name] = entry
+        return found
+
+    def close(self):
+        self.data.close()
+
+
+def _write_run(records, path):
+    with open(path, 'wb') as f:
+        for key in sorted(records):
+            f.write(LENGTH.pack(len(records[key])))
+            f.write(records[key])
+
+
+def _read_run(path, order):
+    with open(path, 'rb') as f:
+        while True:
+            prefix = f.read(LENGTH.size)
+            if not prefix:
+                return
+            record = f.read(LENGTH.unpack(prefix)[0])
+            yield record.split(b'\t', 1)[0], order, record
+
+
+def write_index(entries, path):
+    """
+    # writes an index file, replacing the old one only once the new one is complete. Names are
+    # sorted in runs of RUN_SIZE spilled next to the file and merged, so memory stays bounded
+    # by the run size rather than the size of the directory
+    :param entries: iterable of (name, mail, slack id or None), the first entry of a name wins
+    :return: number of names written
+    """
+
+    runs, records = [], {}
+    try:
+        for name, mail, slack_id in entries:
+            key = name.lower().replace('\t', ' ')
+            if key and key.encode('utf-8') not in records:
+                record = '\t'.join([key, (mail or '').replace('\t', ' '), (slack_id or '').replace('\t', ' ')])
+                records[key.encode('utf-8')] = record.encode('utf-8')
+                if len(records) >= RUN_SIZE:
+                    runs.append(path + '.run' + str(len(runs)))
+                    _write_run(records, runs[-1])
+                    records = {}
+        runs.append(path + '.run' + str(len(runs)))
+        _write_run(records, runs[-1])
+        records = None
+
+        # records go to one file while their offsets are collected, the header needs the count first.
+        # A name in several runs keeps the record of the earliest run, which heapq.merge yields first
+        offsets, offset, last = array.array('I'), 0, None
+        with open(path + '.records', 'wb') as f:
+            for key, order, record in heapq.merge(*[_read_run(run, order) for order, run in enumerate(runs)]):
+                if key == last:
+                    continue
+                last = key
+                offsets.append(offset)
+                f.write(LENGTH.pack(len(record)))
+                f.write(record)
+                offset += LENGTH.size + len(record)
+
+        start = HEADER.size + OFFSET.size * len(offsets)
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f, open(path + '.records', 'rb') as source:
+            f.write(HEADER.pack(MAGIC, len(offsets)))
+            for offset in offsets:
+                f.write(OFFSET.pack(start + offset))
+            shutil.copyfileobj(source, f)
+        os.replace(temporary, path)
+        return len(offsets)
+    finally:
+        for leftover in runs + [path + '.records']:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def publish(path, location):
+    """
+    # copies an index file to where the functions read it from
+    :param path: local path of the index file
+    :param location: s3://bucket/key or a local path
+    :return: N/A
+    """
+
+    if location.startswith('s3://'):
+        bucket, key = location[len('s3://'):].split('/', 1)
+        with open(path, 'rb') as f:
+            aws_executor.call(aws_clients.get_client('s3'), 'put_object', Bucket=bucket, Key=key, Body=f.read())
+    elif os.path.abspath(location) != os.path.abspath(path):
+        with open(path, 'rb') as source, open(location + '.tmp', 'wb') as target:
+            target.write(source.read())
+        os.replace(location + '.tmp', location)
+
+
+def _download(location, etag):
+    from botocore.exceptions import ClientError
+    bucket, key = location[len('s3://'):].split('/', 1)
+    kwargs = {'Bucket': bucket, 'Key': key}
+    if etag:
+        kwargs['IfNoneMatch'] = etag
+    try:
+        response = aws_executor.call(aws_clients.get_client('s3'), 'get_object', **kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return etag
+        raise
+    with open(LOCAL_COPY + '.tmp', 'wb') as f:
+        f.write(response['Body'].read())
+    os.replace(LOCAL_COPY + '.tmp', LOCAL_COPY)
+    return response.get('ETag')
+
+
+def _replace(index, path):
+    # opens the new index before unmapping the old one, so a failed open keeps the old one
+    latest = DirectoryIndex(path)
+    if index is not None:
+        index.close()
+    return latest
+
+
+def get_index():
+    """
+    # returns the index shared across warm invocations, read from the directory_index location.
+    # An index in S3 is downloaded to /tmp and checked for a newer export every directory_index_ttl seconds
+    :return: DirectoryIndex, None when no index is configured or it could not be read
+    """
+
+    global _INDEX
+    location = os.environ.get('directory_index')
+    if not location:
+        return None
+    ttl = int(os.environ.get('directory_index_ttl') or DEFAULT_TTL)
+    with _LOCK:
+        index, etag, checked = _INDEX or (None, None, 0)
+        if index is not None and time.time() - checked < ttl:
+            return index
+        try:
+            if location.startswith('s3://'):
+                latest = _download(location, etag if index is not None else None)
+                if index is None or latest != etag:
+                    index = _replace(index, LOCAL_COPY)
+                etag = latest
+            else:
+                # the export replaces the file, so a new inode or mtime means a new index
+                stat = os.stat(location)
+                latest = (stat.st_ino, stat.st_mtime_ns)
+                if index is None or latest != etag:
+                    index = _replace(index, location)
+                etag = latest
+        except Exception as e:
+            print("Error reading the directory index: " + str(e))
+        # an index that could not be refreshed is used until the next check
+        _INDEX = (index, etag, time.time())
+        return index
+
+
+def reset():
+    """
+    # drops the shared index, unmapping it
+    :return: N/A
+    """
+
+    global _INDEX
+    with _LOCK:
+        if _INDEX is not None and _INDEX[0] is not None:
+            _INDEX[0].close()
+        _INDEX = None
@@ -0,0 +1,136 @@
+import json, os, threading, time
+
+# CloudWatch only accepts up to 100 values for one metric in a document
+MAX_VALUES = 100
+
+
+class MetricsLogger(object):
+    """
+    # Buffers metrics in memory and prints them as CloudWatch Embedded Metric
+    # Format documents, one per stage, when flushed. CloudWatch Logs turns the
+    # documents into metrics without any PutMetricData calls.
+    """
+
+    def __init__(self, service, namespace=None):
+        """
+        :param service: value of the Service dimension EX) aws_cleanup
+        :param namespace: CloudWatch namespace, defaults to the metrics_namespace environment variable
+        """
+
+        self.service = service
+        self.namespace = namespace or os.environ.get("metrics_namespace") or "AWSResourceManager"
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def reset(self):
+        """
+        # drops anything buffered by a previous invocation
+        :return: N/A
+        """
+
+        with self.lock:
+            self.stages = {}
+
+    def put(self, stage, name, value, unit='Count'):
+        """
+        # buffers one metric value. Counts are added up into one value, repeated
+        # values of other units are kept as a list EX) a latency distribution
+        :param stage: value of the Stage dimension EX) scan
+        :param name: metric name EX) ResourcesScanned
+        :param value: number to record
+        :param unit: CloudWatch unit EX) Count, Milliseconds, Count/Second, Percent
+        :return: N/A
+        """
+
+        with self.lock:
+            metrics = self.stages.setdefault(stage, {})
+            metric = metrics.setdefault(name, {'unit': unit, 'values': []})
+            if unit == 'Count' and metric['values']:
+                metric['values'][0] += value
+            else:
+                metric['values'].append(value)
+
+    def rate(self, stage, name, count, seconds):
+        """
+        # buffers a per second rate, skipped when no time was measured
+        :param stage: Stage dimension
+        :param name: metric name
+        :param count: number of items handled
+        :param seconds: elapsed seconds
+        :return: N/A
+        """
+
+        if seconds > 0:
+            self.put(stage, name, round(count / float(seconds), 3), 'Count/Second')
+
+    def total(self, stage, name):
+        """
+        # sum of the values buffered for a metric
+        :param stage: Stage dimension
+        :param name: metric name
+        :return: the sum, 0 if nothing was recorded
+        """
+
+        with self.lock:
+            return sum(self.stages.get(stage, {}).get(name, {}).get('values', []))
+
+    def success_rate(self, stage, succeeded, failed, name):
+        """
+        # buffers the percentage of succeeded out of succeeded + failed
+        :param stage: Stage dimension
+        :param succeeded: name of the success counter
+        :param failed: name of the failure counter
+        :param name: name of the percentage metric
+        :return: N/A
+        """
+
+        ok = self.total(stage, succeeded)
+        attempts = ok + self.total(stage, failed)
+        if attempts:
+            self.put(stage, name, round(100.0 * ok / attempts, 2), 'Percent')
+
+    def documents(self):
+        """
+        # builds the EMF documents for everything buffered
+        :return: list of dicts
+        """
+
+        timestamp = int(time.time() * 1000)
+        documents = []
+        with self.lock:
+            for stage, metrics in self.stages.items():
+                chunks = max(1, max((len(metric['values']) + MAX_VALUES - 1) // MAX_VALUES for metric in metrics.values()))
+                for chunk in range(chunks):
+                    document = {
+                        '_aws': {
+                            'Timestamp': timestamp,
+                            'CloudWatchMetrics': [{
+                                'Namespace': self.namespace,
+                                'Dimensions': [['Service', 'Stage']],
+                                'Metrics': [],
+                            }],
+                        },
+                        'Service': self.service,
+                        'Stage': stage,
+                    }
+                    definitions = document['_aws']['CloudWatchMetrics'][0]['Metrics']
+                    for name, metric in metrics.items():
+                        values = metric['values'][chunk * MAX_VALUES:(chunk + 1) * MAX_VALUES]
+                        if not values:
+                            continue
+                        definitions.append({'Name': name, 'Unit': metric['unit']})
+                        document[name] = values[0] if len(values) == 1 else values
+                    documents.append(document)
+        return documents
+
+    def flush(self):
+        """
+        # prints the EMF documents to the log and clears the buffer
+        :return: number of documents written
+        """
+
+        documents = self.documents()
+        for document in documents:
+            print(json.dumps(document, separators=(',', ':')))
+        self.reset()
+        return len(documents)
@@ -0,0 +1,174 @@
+import os, threading, time
+import kv_store
+from collections import OrderedDict
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_NEGATIVE_TTL = 3600
+DEFAULT_SIZE = 10000
+
+_CACHES = {}
+_LOCK = threading.Lock()
+
+
+class IdentityCache(object):
+    """
+    # Caches owner identity lookups EX) nt_id to email, email to Slack id in an
+    # in-process LRU with a TTL, backed by a kv_store so the results survive
+    # cold starts and are shared with the other functions. Lookups that found
+    # nothing are cached as well, for a shorter time. Lookups that failed are
+    # not cached and are tried again next time.
+    """
+
+    def __init__(self, store, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, size=DEFAULT_SIZE):
+        """
+        :param store: kv_store store the results are persisted in, None to keep them in memory only
+        :param ttl: seconds a found value is kept
+        :param negative_ttl: seconds a lookup that found nothing is kept
+        :param size: entries kept in memory, the least recently used are dropped first
+        """
+
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key, value, expires):
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def resolve(self, key, lookup):
+        """
+        # resolves one key
+        :param key: key to resolve EX) an nt_id
+        :param lookup: function(key) returning the value, None when nothing was found. A lookup that raises is not cached
+        :return: the value, None when nothing was found or the lookup failed
+        """
+
+        def lookup_one(keys):
+            try:
+                return {keys[0]: lookup(keys[0])}
+            except Exception as e:
+                print("Error resolving " + str(keys[0]) + ": " + str(e))
+                return {}
+
+        return self.resolve_many([key], lookup_one).get(key)
+
+    def resolve_many(self, keys, lookup_many):
+        """
+        # resolves many keys, looking up only the ones neither in memory nor in the store, in one call
+        :param keys: keys to resolve
+        :param lookup_many: function(keys) returning a dict of key to value or None when nothing was found. Keys left out of the dict failed and are not cached
+        :return: dict of key to value, None for keys nothing was found for or whose lookup failed
+        """
+
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        resolved = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self.entries.move_to_end(key)
+                    resolved[key] = entry[0]
+                else:
+                    missing.append(key)
+            self.hits += len(resolved)
+
+        if missing and self.store is not None:
+            try:
+                stored = self.store.get_many(missing)
+            except Exception as e:
+                print("Error reading the identity cache: " + str(e))
+                stored = {}
+            with self.lock:
+                for key, item in stored.items():
+                    self._remember(key, item['value'], item['expires'])
+                    resolved[key] = item['value']
+                self.hits += len(stored)
+            missing = [key for key in missing if key not in stored]
+
+        if not missing:
+            return resolved
+
+        with self.lock:
+            self.misses += len(missing)
+        found = lookup_many(missing) or {}
+        positive = {}
+        negative = {}
+        with self.lock:
+            for key in missing:
+                if key not in found:
+                    resolved[key] = None
+                    continue
+                value = found[key]
+                ttl = self.ttl if value is not None else self.negative_ttl
+                self._remember(key, value, now + ttl)
+                (positive if value is not None else negative)[key] = {'value': value, 'expires': now + ttl}
+                resolved[key] = value
+
+        if self.store is not None:
+            try:
+                if positive:
+                    self.store.put_many(positive, self.ttl)
+                if negative:
+                    self.store.put_many(negative, self.negative_ttl)
+            except Exception as e:
+                print("Error writing the identity cache: " + str(e))
+        return resolved
+
+    def stored(self):
+        """
+        # every value that was found and is still kept, without looking anything up
+        :return: dict of key to value
+        """
+
+        if self.store is None:
+            now = time.time()
+            with self.lock:
+                return dict((key, value) for key, (value, expires) in self.entries.items() if value is not None and expires > now)
+        return dict((key, item['value']) for key, item in self.store.items() if item['value'] is not None)
+
+    def stats(self):
+        """
+        # hit and miss counters since the container started
+        :return: dict with hits, misses and size
+        """
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+def get_cache(kind):
+    """
+    # returns the cache shared across warm invocations for one kind of lookup,
+    # configured by identity_ttl, identity_negative_ttl and identity_cache_size
+    :param kind: what is cached EX) email, slack_id
+    :return: IdentityCache
+    """
+
+    with _LOCK:
+        cache = _CACHES.get(kind)
+        if cache is None:
+            cache = IdentityCache(kv_store.get_store('identity-' + kind),
+                                  ttl=int(os.environ.get('identity_ttl') or DEFAULT_TTL),
+                                  negative_ttl=int(os.environ.get('identity_negative_ttl') or DEFAULT_NEGATIVE_TTL),
+                                  size=int(os.environ.get('identity_cache_size') or DEFAULT_SIZE))
+            _CACHES[kind] = cache
+        return cache
+
+
+def reset():
+    """
+    # drops the shared caches
+    :return: N/A
+    """
+
+    with _LOCK:
+        _CACHES.clear()
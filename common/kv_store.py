@@ -0,0 +1,352 @@
+import json, os, sqlite3, threading, time
+import aws_clients, aws_executor
+
+# DynamoDB batch limits
+GET_CHUNK = 100
+WRITE_CHUNK = 25
+
+DEFAULT_PATH = '/tmp/aws_resource_manager.sqlite3'
+
+
+class SqliteStore(object):
+    """
+    # Key/value store with per item expiry in a local SQLite file. On Lambda the
+    # file lives in /tmp, so it is shared by warm invocations of one container
+    # only; it stands in for DynamoStore when no table is configured.
+    """
+
+    def __init__(self, namespace, path=DEFAULT_PATH):
+        """
+        :param namespace: keeps the keys of different users of one file apart EX) idempotency
+        :param path: SQLite database file
+        """
+
+        self.namespace = namespace
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (namespace, key))"
+            )
+
+    def get(self, key):
+        """
+        # reads one item
+        :param key: item key
+        :return: the stored value, None when missing or expired
+        """
+
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        # reads many items
+        :param keys: item keys
+        :return: dict of key to value for the keys found and not expired
+        """
+
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self.lock:
+            # stay below SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.connection.execute(
+                    "SELECT key, value FROM kv WHERE namespace = ? AND expires > ? AND key IN (%s)" % ','.join('?' * len(chunk)),
+                    [self.namespace, now] + chunk
+                )
+                for key, value in rows:
+                    found[key] = json.loads(value)
+        return found
+
+    def put(self, key, value, ttl):
+        """
+        # writes one item
+        :param key: item key
+        :param value: JSON serializable value
+        :param ttl: seconds until the item expires
+        :return: N/A
+        """
+
+        self.put_many({key: value}, ttl)
+
+    def put_many(self, items, ttl):
+        """
+        # writes many items
+        :param items: dict of key to JSON serializable value
+        :param ttl: seconds until the items expire
+        :return: N/A
+        """
+
+        expires = time.time() + ttl
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                [(self.namespace, key, json.dumps(value), expires) for key, value in items.items()]
+            )
+
+    def add(self, key, value, ttl):
+        """
+        # writes an item only if it is missing or expired
+        :param key: item key
+        :param value: JSON serializable value
+        :param ttl: seconds until the item expires
+        :return: True when the item was written
+        """
+
+        now = time.time()
+        # one transaction, so no other writer gets between the delete and the insert.
+        # INSERT OR IGNORE works on every SQLite, unlike an upsert (3.24+)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM kv WHERE namespace = ? AND key = ? AND expires <= ?",
+                                    (self.namespace, key, now))
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO kv (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value), now + ttl)
+            )
+            return cursor.rowcount > 0
+
+    def delete(self, key):
+        """
+        # removes one item
+        :param key: item key
+        :return: N/A
+        """
+
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        """
+        # removes many items
+        :param keys: item keys
+        :return: N/A
+        """
+
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?",
+                                        [(self.namespace, key) for key in keys])
+
+    def items(self, prefix=''):
+        """
+        # lists the items whose key starts with a prefix
+        :param prefix: key prefix, empty for every item
+        :return: list of (key, value) sorted by key
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, value FROM kv WHERE namespace = ? AND expires > ? AND substr(key, 1, ?) = ? ORDER BY key",
+                (self.namespace, time.time(), len(prefix), prefix)
+            ).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+
+class DynamoStore(object):
+    """
+    # Key/value store with per item expiry in a DynamoDB table shared by every
+    # container. The table has a string partition key "namespace", a string
+    # sort key "key" and TTL enabled on the numeric "expires" attribute. DynamoDB
+    # removes expired items lazily, so reads also skip them.
+    """
+
+    def __init__(self, namespace, table):
+        """
+        :param namespace: partition key value for this user of the table EX) idempotency
+        :param table: DynamoDB table name
+        """
+
+        self.namespace = namespace
+        self.table = table
+
+    def _item(self, key, value, expires):
+        return {
+            'namespace': {'S': self.namespace},
+            'key': {'S': key},
+            'value': {'S': json.dumps(value)},
+            'expires': {'N': str(int(expires))},
+        }
+
+    def get(self, key):
+        """
+        # reads one item
+        :param key: item key
+        :return: the stored value, None when missing or expired
+        """
+
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        # reads many items with batch_get_item, retrying unprocessed keys
+        :param keys: item keys
+        :return: dict of key to value for the keys found and not expired
+        """
+
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        client = aws_clients.get_client('dynamodb')
+        for start in range(0, len(keys), GET_CHUNK):
+            request = {self.table: {
+                'Keys': [{'namespace': {'S': self.namespace}, 'key': {'S': key}} for key in keys[start:start + GET_CHUNK]],
+                'ConsistentRead': True,
+            }}
+            while request:
+                response = aws_executor.call(client, 'batch_get_item', RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table, []):
+                    if float(item['expires']['N']) > now:
+                        found[item['key']['S']] = json.loads(item['value']['S'])
+                request = response.get('UnprocessedKeys') or None
+        return found
+
+    def put(self, key, value, ttl):
+        """
+        # writes one item
+        :param key: item key
+        :param value: JSON serializable value
+        :param ttl: seconds until the item expires
+        :return: N/A
+        """
+
+        client = aws_clients.get_client('dynamodb')
+        aws_executor.call(client, 'put_item', TableName=self.table, Item=self._item(key, value, time.time() + ttl))
+
+    def put_many(self, items, ttl):
+        """
+        # writes many items with batch_write_item, retrying unprocessed items
+        :param items: dict of key to JSON serializable value
+        :param ttl: seconds until the items expire
+        :return: N/A
+        """
+
+        expires = time.time() + ttl
+        requests = [{'PutRequest': {'Item': self._item(key, value, expires)}} for key, value in items.items()]
+        client = aws_clients.get_client('dynamodb')
+        for start in range(0, len(requests), WRITE_CHUNK):
+            request = {self.table: requests[start:start + WRITE_CHUNK]}
+            while request:
+                response = aws_executor.call(client, 'batch_write_item', RequestItems=request)
+                request = response.get('UnprocessedItems') or None
+
+    def add(self, key, value, ttl):
+        """
+        # writes an item only if it is missing or expired
+        :param key: item key
+        :param value: JSON serializable value
+        :param ttl: seconds until the item expires
+        :return: True when the item was written
+        """
+        from botocore.exceptions import ClientError
+
+        now = time.time()
+        client = aws_clients.get_client('dynamodb')
+        try:
+            aws_executor.call(client, 'put_item', TableName=self.table, Item=self._item(key, value, now + ttl),
+                ConditionExpression='attribute_not_exists(#key) OR #expires <= :now',
+                ExpressionAttributeNames={'#key': 'key', '#expires': 'expires'},
+                ExpressionAttributeValues={':now': {'N': str(int(now))}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        """
+        # removes one item
+        :param key: item key
+        :return: N/A
+        """
+
+        client = aws_clients.get_client('dynamodb')
+        aws_executor.call(client, 'delete_item', TableName=self.table,
+                          Key={'namespace': {'S': self.namespace}, 'key': {'S': key}})
+
+    def delete_many(self, keys):
+        """
+        # removes many items with batch_write_item, retrying unprocessed items
+        :param keys: item keys
+        :return: N/A
+        """
+
+        requests = [{'DeleteRequest': {'Key': {'namespace': {'S': self.namespace}, 'key': {'S': key}}}}
+                    for key in dict.fromkeys(keys)]
+        client = aws_clients.get_client('dynamodb')
+        for start in range(0, len(requests), WRITE_CHUNK):
+            request = {self.table: requests[start:start + WRITE_CHUNK]}
+            while request:
+                response = aws_executor.call(client, 'batch_write_item', RequestItems=request)
+                request = response.get('UnprocessedItems') or None
+
+    def items(self, prefix=''):
+        """
+        # lists the items whose key starts with a prefix
+        :param prefix: key prefix, empty for every item
+        :return: list of (key, value) sorted by key
+        """
+
+        condition = '#namespace = :namespace'
+        values = {':namespace': {'S': self.namespace}}
+        names = {'#namespace': 'namespace'}
+        if prefix:
+            condition += ' AND begins_with(#key, :prefix)'
+            values[':prefix'] = {'S': prefix}
+            names['#key'] = 'key'
+
+        found = []
+        now = time.time()
+        client = aws_clients.get_client('dynamodb')
+        kwargs = {
+            'TableName': self.table,
+            'KeyConditionExpression': condition,
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+            'ConsistentRead': True,
+        }
+        # query pages with LastEvaluatedKey/ExclusiveStartKey instead of one token name
+        while True:
+            page = aws_executor.call(client, 'query', **kwargs)
+            for item in page.get('Items', []):
+                if float(item['expires']['N']) > now:
+                    found.append((item['key']['S'], json.loads(item['value']['S'])))
+            if not page.get('LastEvaluatedKey'):
+                return found
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+_STORES = {}
+_LOCK = threading.Lock()
+
+
+def get_store(namespace):
+    """
+    # returns the store shared across warm invocations for a namespace. It is a
+    # DynamoStore on the kv_table table when that variable is set, otherwise a
+    # SqliteStore in the kv_path file
+    :param namespace: user of the store EX) idempotency
+    :return: SqliteStore or DynamoStore
+    """
+
+    with _LOCK:
+        store = _STORES.get(namespace)
+        if store is None:
+            table = os.environ.get('kv_table')
+            if table:
+                store = DynamoStore(namespace, table)
+            else:
+                store = SqliteStore(namespace, os.environ.get('kv_path') or DEFAULT_PATH)
+            _STORES[namespace] = store
+        return store
+
+
+def reset():
+    """
+    # drops the shared stores so the next call reads the environment again
+    :return: N/A
+    """
+
+    with _LOCK:
+        _STORES.clear()
@@ -0,0 +1,87 @@
+import json, os
+import aws_clients, aws_executor, secret_cache
+
+SECRET_NAME = "Jido-Active-Directory-Service-Account"
+DOMAIN = "corporate.t-mobile.com"
+BASE_DNAME = "OU=Production,OU=Users,OU=Accounts,DC=Corporate,DC=T-Mobile,DC=com"
+BIND_DNAME = "CN=%s,OU=LDAPS,OU=Non-production,OU=Services,OU=Accounts,DC=corporate,DC=t-mobile,DC=com"
+
+# error code the LDAP query function returns when the service account was refused
+INVALID_CREDENTIALS = 'invalidCredentials'
+
+
+def get_secret(rejected=None):
+    """
+    # gets the LDAP service account secret from AWS secrets manager, cached across warm invocations
+    :param rejected: a value whose credentials were refused, fetches the secret again in case it was rotated
+    :return: the secrets value or None if not found
+    """
+
+    from botocore.exceptions import ClientError
+
+    cache = secret_cache.get_cache()
+    try:
+        if rejected is not None:
+            return cache.rotated(SECRET_NAME, rejected)
+        return cache.get(SECRET_NAME)
+    except ClientError as e:
+        print("Error getting secret key!: " + str(e))
+        return None
+
+
+def lookup_emails(nt_ids):
+    """
+    # looks nt_ids up in LDAP, all of them in one LDAP query Lambda call. When the
+    # service account is refused the secret is fetched again once and the query retried
+    :param nt_ids: the ids to search through
+    :return: dict of nt_id to email address or None if not found, ids whose lookup failed are left out
+    """
+
+    value = get_secret()
+    if value is None:
+        return {}
+    try:
+        try:
+            return query_emails(json.loads(value), nt_ids)
+        except secret_cache.SecretRejected:
+            print("LDAP rejected the service account, fetching the secret again")
+            value = get_secret(rejected=value)
+            if value is None:
+                return {}
+            return query_emails(json.loads(value), nt_ids)
+    except Exception as e:
+        print("Error looking up the emails of " + str(len(nt_ids)) + " ids: " + str(e))
+        return {}
+
+
+def query_emails(secret, nt_ids):
+    """
+    # looks nt_ids up through the LDAP query Lambda, which searches for them over one bind
+    :param secret: the LDAP service account secret
+    :param nt_ids: the ids to search through
+    :return: dict of nt_id to email address or None if not found
+    """
+
+    data = {
+        "domain": DOMAIN,
+        "base_dname": BASE_DNAME,
+        "bind_dname": BIND_DNAME % secret['account_name'],
+        "password": secret['password'],
+        "obj_names": list(nt_ids),
+        "obj_class": "user",
+        "attributes": ["mail"],
+    }
+    invoke_response = aws_executor.call(aws_clients.get_client('lambda'), 'invoke',
+        FunctionName= os.environ.get("query_ldap"),
+        InvocationType= "RequestResponse",
+        Payload= json.dumps(data)
+    )
+    if ("FunctionError" in invoke_response):
+        raise RuntimeError("LDAP query failed: " + invoke_response['FunctionError'])
+    response = json.load(invoke_response['Payload'])
+    if response.get('statusCode') != 200:
+        if response.get('error') == INVALID_CREDENTIALS:
+            raise secret_cache.SecretRejected(response.get('body'))
+        raise RuntimeError("LDAP query failed: " + str(response.get('body')))
+    found = json.loads(response['body'])['found']
+    return dict((nt_id, ((found.get(nt_id) or {}).get('mail') or [None])[0]) for nt_id in nt_ids)
@@ -0,0 +1,141 @@
+import os, threading, time
+import aws_clients, aws_executor
+
+DEFAULT_TTL = 3600
+
+# share of the TTL after which a value is refreshed in the background
+REFRESH_AT = 0.8
+
+_CACHE = None
+_LOCK = threading.Lock()
+
+
+class SecretRejected(Exception):
+    """
+    # Raised by a caller when the credentials in a secret were refused, so the
+    # secret is fetched again in case it was rotated
+    """
+
+
+class SecretCache(object):
+    """
+    # Keeps Secrets Manager values across warm invocations. A value older than
+    # REFRESH_AT of the TTL is still returned while a background thread fetches
+    # the new one, so callers only wait on Secrets Manager on the first use or
+    # after the value expired.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, region_name=None):
+        """
+        :param ttl: seconds a value is used before it has to be fetched again
+        :param region_name: region of the Secrets Manager client, defaults to AWS_DEFAULT_REGION
+        """
+
+        self.ttl = ttl
+        self.region_name = region_name or os.environ.get("AWS_DEFAULT_REGION")
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'refreshes': 0, 'rotations': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def _fetch(self, secret_id):
+        client = aws_clients.get_client('secretsmanager', self.region_name)
+        response = aws_executor.call(client, 'get_secret_value', SecretId=secret_id)
+        value = response.get('SecretString')
+        with self.lock:
+            self.entries[secret_id] = (value, time.time())
+        return value
+
+    def get(self, secret_id):
+        """
+        # returns a secret, fetching it only when it is not cached or has expired
+        :param secret_id: name or ARN of the secret
+        :return: the SecretString
+        """
+
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(secret_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.counters['hits'] += 1
+                if now - entry[1] >= self.ttl * REFRESH_AT and secret_id not in self.refreshing:
+                    self.refreshing.add(secret_id)
+                    thread = threading.Thread(target=self._refresh_in_background, args=(secret_id,))
+                    thread.daemon = True
+                    thread.start()
+                return entry[0]
+
+        # one fetch at a time, threads that waited use its result
+        with self.fetch_lock:
+            with self.lock:
+                entry = self.entries.get(secret_id)
+                if entry is not None and time.time() - entry[1] < self.ttl:
+                    self.counters['hits'] += 1
+                    return entry[0]
+            self._count('misses')
+            return self._fetch(secret_id)
+
+    def _refresh_in_background(self, secret_id):
+        try:
+            self._fetch(secret_id)
+            self._count('refreshes')
+        except Exception as e:
+            self._count('errors')
+            print("Error refreshing secret " + secret_id + ": " + str(e))
+        finally:
+            with self.lock:
+                self.refreshing.discard(secret_id)
+
+    def rotated(self, secret_id, rejected):
+        """
+        # fetches a secret again after its value was rejected, unless another thread already did
+        :param secret_id: name or ARN of the secret
+        :param rejected: the value that was rejected
+        :return: the current SecretString
+        """
+
+        with self.fetch_lock:
+            with self.lock:
+                entry = self.entries.get(secret_id)
+                if entry is not None and entry[0] != rejected:
+                    return entry[0]
+            self._count('rotations')
+            return self._fetch(secret_id)
+
+    def stats(self):
+        """
+        # hit, miss, refresh, rotation and error counters since the container started
+        :return: dict of counters
+        """
+
+        with self.lock:
+            return dict(self.counters)
+
+
+def get_cache():
+    """
+    # returns the cache shared across warm invocations, values are kept for secret_ttl seconds
+    :return: SecretCache
+    """
+
+    global _CACHE
+    with _LOCK:
+        if _CACHE is None:
+            _CACHE = SecretCache(int(os.environ.get('secret_ttl') or DEFAULT_TTL))
+        return _CACHE
+
+
+def reset():
+    """
+    # drops the shared cache
+    :return: N/A
+    """
+
+    global _CACHE
+    with _LOCK:
+        _CACHE = None
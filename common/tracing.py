@@ -0,0 +1,147 @@
+import contextlib, io, json, os, threading, time
+
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+
+class Tracer(object):
+    """
+    # Collects named spans with wall and CPU time and prints each one as a
+    # structured JSON record when it closes
+    """
+
+    def __init__(self, emit=True):
+        """
+        :param emit: print a JSON record for every finished span
+        """
+
+        self.emit = emit
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.records = []
+
+    def reset(self):
+        """
+        # drops the spans of the previous invocation
+        :return: N/A
+        """
+
+        with self.lock:
+            self.records = []
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        # times the enclosed block
+        :param name: stage name EX) scan
+        :param attributes: extra fields added to the record EX) resource='ec2'
+        :return: the record dict, filled in when the block exits
+        """
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        record = {
+            'type': 'span',
+            'name': name,
+            'parent': stack[-1]['name'] if stack else None,
+        }
+        record.update(attributes)
+        stack.append(record)
+        wall = time.time()
+        cpu = time.thread_time()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['wall_ms'] = round((time.time() - wall) * 1000.0, 3)
+            record['cpu_ms'] = round((time.thread_time() - cpu) * 1000.0, 3)
+            stack.pop()
+            with self.lock:
+                self.records.append(record)
+            if self.emit:
+                print(json.dumps(record, default=str))
+
+    def summary(self):
+        """
+        # totals per span name
+        :return: dict of name to count, wall_ms and cpu_ms
+        """
+
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                entry = totals.setdefault(record['name'], {'count': 0, 'wall_ms': 0.0, 'cpu_ms': 0.0})
+                entry['count'] += 1
+                entry['wall_ms'] = round(entry['wall_ms'] + record['wall_ms'], 3)
+                entry['cpu_ms'] = round(entry['cpu_ms'] + record['cpu_ms'], 3)
+        return totals
+
+
+TRACER = Tracer()
+
+
+def span(name, **attributes):
+    """
+    # opens a span on the shared tracer
+    :param name: stage name
+    :param attributes: extra fields for the record
+    :return: context manager
+    """
+
+    return TRACER.span(name, **attributes)
+
+
+def profile_mode(event=None):
+    """
+    # profiler requested for this invocation, the event's "profile" key wins over the trace_profile environment variable
+    :param event: the Lambda event
+    :return: "cprofile", "tracemalloc" or None
+    """
+
+    mode = None
+    if isinstance(event, dict):
+        mode = event.get('profile')
+    mode = (mode or os.environ.get('trace_profile') or '').lower()
+    return mode if mode in PROFILE_MODES else None
+
+
+@contextlib.contextmanager
+def profiled(mode, top=None):
+    """
+    # runs the enclosed block under cProfile or tracemalloc and prints the top entries
+    :param mode: "cprofile", "tracemalloc" or None to do nothing
+    :param top: number of entries to print, defaults to trace_profile_top or 25
+    :return: N/A
+    """
+
+    if mode is None:
+        yield
+        return
+
+    top = top or int(os.environ.get('trace_profile_top') or 25)
+    if mode == 'cprofile':
+        import cProfile, pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            print("cProfile hot spots:\n" + stream.getvalue())
+    else:
+        import tracemalloc
+        tracemalloc.start(int(os.environ.get('trace_profile_frames') or 1))
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = ["tracemalloc current=%d bytes peak=%d bytes, top allocation sites:" % (current, peak)]
+            for stat in snapshot.statistics('lineno')[:top]:
+                lines.append(str(stat))
+            print('\n'.join(lines))
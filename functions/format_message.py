@@ -1,4 +1,5 @@
-import json, boto3, os
+import json, os
+import aws_clients
 
 def lambda_handler(event, context):
     """
@@ -56,7 +57,7 @@ def send_preformatted_email_message(sender_mail, email, subj, heading, messages,
         'text_message': messages[1], 
         'region': region
     }
-    lambda_client = boto3.client('lambda')
+    lambda_client = aws_clients.get_client('lambda')
     invoke_response = lambda_client.invoke(
         FunctionName= os.environ.get("send_email"),
         InvocationType= "RequestResponse",
@@ -1,13 +1,56 @@
-import json, ldap
+import json, os, threading, time, ldap
+import directory_index, identity_cache, secret_cache
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+
+# names per OR-filter search, well under the server's size limit and filter length
+SEARCH_CHUNK = 100
+
+# entries per page of a paged search, under the 1000 Active Directory returns at most
+PAGE_SIZE = 500
+
+# an idle connection is checked with a whoami before it is reused after this many seconds
+HEALTH_CHECK_IDLE = 60
+
+# idle connections kept per service account
+POOL_SIZE = 2
+
+# seconds to wait for the server before a connection counts as dropped
+NETWORK_TIMEOUT = 10
+
+# where an export is written before it is published
+EXPORT_PATH = '/tmp/directory_index.export'
 
 def lambda_handler(event, context):
     """
-    # Handler that triggers upon an event hooked up to Lambda
+    # Handler that triggers upon an event hooked up to Lambda. An event with
+    # obj_names is answered with a JSON dict of name to attributes, null for
+    # names that were not found, an event with export writes the directory
+    # index, otherwise obj_name is looked up on its own
     :param event: event data in the form of a dict
     :param context: runtime information of type LambdaContext
     :return: codes indicating success or failure
     """
 
+    if event.get('export'):
+        # scheduled, so the credentials come from Secrets Manager rather than the event
+        secret = json.loads(secret_cache.get_cache().get(event['secret_name']))
+        return exportIndex(event['domain'], event['base_dname'], event['bind_dname'] % secret['account_name'],
+            secret['password'], event.get('obj_class', 'user'), event.get('index') or os.environ.get('directory_index'))
+
+    if 'obj_names' in event:
+        found = getAttributesBatch(event['domain'], event['base_dname'], event['bind_dname'],
+            event['password'], event['obj_names'], event['obj_class'], event['attributes'])
+        if 'statusCode' in found:
+            # the bind or a search failed
+            return found
+        print("Found " + str(sum(1 for value in found['found'].values() if value is not None)) + " of " + str(len(found['found'])))
+        print("LDAP connections: " + json.dumps(POOL.stats()))
+        return {
+            "statusCode": 200,
+            "body": json.dumps(found),
+        }
+
     attributes = getAttributes(event['domain'], event['base_dname'], event['bind_dname'],
         event['password'], event['obj_name'], event['obj_class'], event['attributes'])
     
@@ -27,57 +70,324 @@ def getAttributes(domain, base_dname, bind_dname, password, obj_name, obj_class,
     :param obj_name: object name to search for. EX) nt_id
     :param obj_class: class of the object
     :param attributes: list of attributes to look for EX) ["Mail"]
-    :return: error codes are returned
+    :return: list with one [(dn, attributes)] per entry found, or an error code
     """
 
-    l = ldap.initialize('ldaps://' + domain + ':636')
-    binddn = bind_dname
-    pw = password
-    basedn = base_dname
-    searchFilter = "(&(name=" + obj_name + ")(objectClass=" + obj_class + "))"
-    searchAttribute = attributes
+    searchFilter = "(&(name=" + escape_filter_chars(obj_name) + ")(objectClass=" + escape_filter_chars(obj_class) + "))"
+
+    def search(l):
+        # every entry, not only the first result message
+        return [[(dn, entry)] for dn, entry in searchPaged(l, base_dname, searchFilter, attributes)]
+
+    try:
+        result_set = POOL.run(domain, bind_dname, password, search)
+    except ldap.LDAPError as e:
+        return {
+            "statusCode": 500,
+            "body": str(e)
+        }
+    if result_set == []:
+        raise ValueError("No results found")
+    # result_set[0][0][1]['attribute'][0] to get attribute of only one result
+    return result_set
+
+def getAttributesBatch(domain, base_dname, bind_dname, password, obj_names, obj_class, attributes):
+    """
+    # queries ldap for many objects over one pooled connection, one OR-filter search per SEARCH_CHUNK names
+    :param domain: the domain to search in
+    :param base_dname: the base to search under, all children will be searched under this base
+    :param bind_dname: the username of the service account
+    :param password: password of the service account
+    :param obj_names: object names to search for. EX) nt_ids
+    :param obj_class: class of the object
+    :param attributes: list of attributes to look for EX) ["mail"]
+    :return: {"found": dict of name to dict of attribute to list of values, None when nothing was found}, or an error code
+    """
+
+    names = list(dict.fromkeys(name for name in obj_names if name))
+
+    def search(l):
+        found = dict((name, None) for name in names)
+        for start in range(0, len(names), SEARCH_CHUNK):
+            for name, values in searchNames(l, base_dname, names[start:start + SEARCH_CHUNK], obj_class, attributes).items():
+                found[name] = values
+        return {"found": found}
+
+    try:
+        return POOL.run(domain, bind_dname, password, search)
+    except ldap.LDAPError as e:
+        return {
+            "statusCode": 500,
+            "body": str(e)
+        }
+
+def exportIndex(domain, base_dname, bind_dname, password, obj_class, location):
+    """
+    # streams every object with a mail address under base_dname into a directory index, with the
+    # Slack ids already in the identity cache, and publishes it for auto-tag and slack_message
+    :param domain: the domain to search in
+    :param base_dname: the base to search under, all children will be searched under this base
+    :param bind_dname: the username of the service account
+    :param password: password of the service account
+    :param obj_class: class of the objects
+    :param location: s3://bucket/key or a local path the index is published to
+    :return: codes indicating success or failure, with the number of names exported
+    """
+
+    if not location:
+        err = "No index location, set index in the event or the directory_index variable"
+        print(err)
+        return {
+            "statusCode": 500,
+            "body": err
+        }
+    try:
+        slack_ids = dict((email.lower(), slack_id) for email, slack_id in identity_cache.get_cache('slack_id').stored().items())
+    except Exception as e:
+        print("Error reading the known Slack ids: " + str(e))
+        slack_ids = {}
+    searchFilter = "(&(objectClass=" + escape_filter_chars(obj_class) + ")(mail=*))"
+
+    def export(l):
+        entries = ((entry['name'][0], entry['mail'][0], slack_ids.get(entry['mail'][0].lower()))
+                   for dn, entry in searchPaged(l, base_dname, searchFilter, ['name', 'mail'])
+                   if entry.get('name') and entry.get('mail'))
+        return directory_index.write_index(entries, EXPORT_PATH)
 
-    #this will scope the entire subtree under base_dname
-    searchScope = ldap.SCOPE_SUBTREE
+    try:
+        count = POOL.run(domain, bind_dname, password, export)
+    except ldap.LDAPError as e:
+        return {
+            "statusCode": 500,
+            "body": str(e)
+        }
+    if isinstance(count, dict):
+        return count
+    directory_index.publish(EXPORT_PATH, location)
+    print("Exported " + str(count) + " names to " + location)
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"exported": count, "index": location}),
+    }
+
+def searchNames(l, base_dname, names, obj_class, attributes):
+    """
+    # one search for a chunk of names
+    :param l: bound ldap connection
+    :param base_dname: the base to search under
+    :param names: object names to search for
+    :param obj_class: class of the object
+    :param attributes: list of attributes to look for
+    :return: dict of the names that were found to dict of attribute to list of values
+    """
+
+    searchFilter = "(&(objectClass=" + escape_filter_chars(obj_class) + ")(|" + \
+        "".join("(name=" + escape_filter_chars(name) + ")" for name in names) + "))"
+    # name is read back to tell which entry answers which id, matching is case insensitive
+    wanted = dict((name.lower(), name) for name in names)
+    found = {}
+    for dn, entry in searchPaged(l, base_dname, searchFilter, list(attributes) + ['name']):
+        name = entry.get('name', [''])[0].lower()
+        if name not in wanted:
+            continue
+        if 'name' not in attributes:
+            entry.pop('name', None)
+        found[wanted[name]] = entry
+    return found
+
+def searchPaged(l, base_dname, searchFilter, attributes, page_size=PAGE_SIZE):
+    """
+    # streams the entries of a subtree search a page at a time with the Simple Paged Results control,
+    # so a large pull never holds more than one page in memory
+    :param l: bound ldap connection
+    :param base_dname: the base to search under
+    :param searchFilter: the ldap filter
+    :param attributes: list of attributes to return
+    :param page_size: entries the server returns per page
+    :return: generator of (dn, dict of attribute to list of decoded values), referrals are skipped
+    """
+
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = l.search_ext(base_dname, ldap.SCOPE_SUBTREE, searchFilter, attributes, serverctrls=[control])
+        result_type, result_data, result_msgid, serverctrls = l.result3(msgid)
+        for dn, entry in result_data:
+            if dn is None:
+                # a referral
+                continue
+            yield dn, dict((key, [decode(value) for value in values]) for key, values in entry.items())
+        cookies = [ctrl.cookie for ctrl in serverctrls if ctrl.controlType == SimplePagedResultsControl.controlType]
+        if not cookies or not cookies[0]:
+            break
+        control.cookie = cookies[0]
+
+def bind(domain, bind_dname, password):
+    """
+    # opens an LDAPS connection and binds as the service account
+    :param domain: the domain to connect to
+    :param bind_dname: the username of the service account
+    :param password: password of the service account
+    :return: the bound connection, or an error code
+    """
+
+    l = ldap.initialize('ldaps://' + domain + ':636')
 
     #Bind to the server
     try:
         l.protocol_version = ldap.VERSION3
-        l.simple_bind_s(binddn, pw)
+        l.set_option(ldap.OPT_NETWORK_TIMEOUT, NETWORK_TIMEOUT)
+        # Active Directory referrals would need another bind
+        l.set_option(ldap.OPT_REFERRALS, 0)
+        l.simple_bind_s(bind_dname, password)
 
     except ldap.INVALID_CREDENTIALS:
+        # callers test the error code to fetch a rotated secret, not the message
         return { 
             "statusCode": 500,
+            "error": "invalidCredentials",
             "body" : "Your username or password is incorrect."
         }
 
-    except ldap.LDAPError as e:
-        if type(e.message) == dict and e.message.has_key('desc'):
-            print(e.message['desc'])
-        else:
-            return {
-                "statusCode": 500, 
-                "body": str(e)
-            }
-    try:
-        ldap_result_id = l.search(basedn, searchScope, searchFilter, searchAttribute)
-        result_set = []
-        while 1:
-            result_type, result_data = l.result(ldap_result_id, 0)
-            if (result_data == []):
-                raise ValueError("No results found")
-            else:
-                ## if you are expecting multiple results you can append them
-                ## otherwise you can just wait until the initial result and break out
-                if result_type == ldap.RES_SEARCH_ENTRY:
-                    result_set.append(result_data)
-            return result_set
-            # result_set[0][0][1]['attribute'][0] to get attribute of only one result
     except ldap.LDAPError as e:
         return {
-            "statusCode": 500,
+            "statusCode": 500, 
             "body": str(e)
         }
-    l.unbind_s()
-    return None
+    return l
+
+def unbind(l):
+    # closes a connection that may already be dead
+    try:
+        l.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+def decode(value):
+    # attribute values come back as bytes
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class ConnectionPool(object):
+    """
+    # Keeps bound connections across warm invocations, so a lookup does not
+    # pay for a TLS handshake and a bind every time. A connection that sat
+    # idle for HEALTH_CHECK_IDLE seconds is checked with a whoami before it
+    # is handed out, and one that dropped during a search is replaced and the
+    # search run once more. Connections of a rotated password are closed.
+    """
+
+    def __init__(self, size=POOL_SIZE, health_check_idle=HEALTH_CHECK_IDLE):
+        """
+        :param size: idle connections kept per service account
+        :param health_check_idle: seconds idle after which a connection is checked before reuse
+        """
+
+        self.size = size
+        self.health_check_idle = health_check_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.counters = {'opened': 0, 'reused': 0, 'reconnects': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def acquire(self, domain, bind_dname, password):
+        """
+        # hands out a healthy idle connection, or binds a new one
+        :param domain: the domain to connect to
+        :param bind_dname: the username of the service account
+        :param password: password of the service account
+        :return: the bound connection, or an error code
+        """
+
+        key = (domain, bind_dname, password)
+        stale = []
+        with self.lock:
+            for other in list(self.idle):
+                if other[:2] == key[:2] and other != key:
+                    # the password was rotated
+                    stale += [l for l, used in self.idle.pop(other)]
+            connections = self.idle.setdefault(key, [])
+        for l in stale:
+            unbind(l)
+
+        while True:
+            with self.lock:
+                if not connections:
+                    break
+                l, used = connections.pop()
+            if time.time() - used < self.health_check_idle:
+                self._count('reused')
+                return l
+            try:
+                l.whoami_s()
+                self._count('reused')
+                return l
+            except ldap.LDAPError as e:
+                print("Dropping an LDAP connection that failed its health check: " + str(e))
+                unbind(l)
+
+        l = bind(domain, bind_dname, password)
+        if not isinstance(l, dict):
+            self._count('opened')
+        return l
+
+    def release(self, domain, bind_dname, password, l):
+        """
+        # returns a connection for reuse, closing it when enough are idle
+        :param domain: the domain it is connected to
+        :param bind_dname: the username it is bound as
+        :param password: the password it is bound with
+        :param l: the connection
+        :return: N/A
+        """
+
+        with self.lock:
+            connections = self.idle.setdefault((domain, bind_dname, password), [])
+            if len(connections) < self.size:
+                connections.append((l, time.time()))
+                return
+        unbind(l)
+
+    def run(self, domain, bind_dname, password, work):
+        """
+        # runs work on a pooled connection, reconnecting and running it once more when the connection dropped
+        :param domain: the domain to connect to
+        :param bind_dname: the username of the service account
+        :param password: password of the service account
+        :param work: function(connection) returning the result
+        :return: the result of work, or an error code when the bind failed
+        """
+
+        for attempt in range(2):
+            l = self.acquire(domain, bind_dname, password)
+            if isinstance(l, dict):
+                return l
+            try:
+                result = work(l)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT) as e:
+                unbind(l)
+                if attempt:
+                    raise
+                print("LDAP connection dropped, reconnecting: " + str(e))
+                self._count('reconnects')
+                continue
+            except Exception:
+                unbind(l)
+                raise
+            self.release(domain, bind_dname, password, l)
+            return result
+
+    def stats(self):
+        """
+        # connection counters since the container started
+        :return: dict of opened, reused and reconnects
+        """
+
+        with self.lock:
+            return dict(self.counters)
+
 
+# shared across warm invocations
+POOL = ConnectionPool()
@@ -1,11 +1,14 @@
-from botocore.vendored import requests
-import json, datetime, boto3, os
+import json, datetime, os
+import aws_clients
 
 SENDER_EMAIL = os.environ.get("sender_email")
 EMAIL_RECIPIENT = os.environ.get("email_recipient")
 APP_URL = os.environ.get("slack_application_url")
 CHANNEL = os.environ.get("slack_channel")
 
+# Snitch request headers, parsed from the environment on first use
+HEADERS = None
+
 
 def lambda_handler(event, context):
     """
@@ -47,7 +50,11 @@ def notify_snitch(comp_name, action, level, msg):
     :return: returns any errors
     """
 
-    headers = json.loads(os.environ.get("headers"))
+    from botocore.vendored import requests
+    global HEADERS
+    if HEADERS is None:
+        HEADERS = json.loads(os.environ.get("headers"))
+    headers = HEADERS
     epoch = int(datetime.datetime.now().strftime('%s'))
     data = {
         "source": "aws_lamba",
@@ -79,7 +86,7 @@ def notify_snitch(comp_name, action, level, msg):
                                        """ + json_data)
         messages.append("The AWS Lambda function, dev-png-aws-manage was unable to communicate with Snitch; " + str(e) + "\n This message was sent to alert you that Snitch requests are not working. Without Snitch any logging or monitoring is down and we cannot view events.")
         
-        lambda_client = boto3.client('lambda')
+        lambda_client = aws_clients.get_client('lambda')
         email_data = {
             'sender_mail': SENDER_EMAIL,
             'email': EMAIL_RECIPIENT,
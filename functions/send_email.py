@@ -1,5 +1,5 @@
-import boto3, json
-from botocore.exceptions import ClientError
+import json
+import aws_clients
 
 
 def lambda_handler(event, context):
@@ -44,6 +44,7 @@ def send_email(email_sender, email, subj, heading, html_message, text_message, r
     :return: N/A
     """
 
+    from botocore.exceptions import ClientError
     SENDER = email_sender
     RECIPIENT = email
     SUBJECT = subj
@@ -57,8 +58,8 @@ def send_email(email_sender, email, subj, heading, html_message, text_message, r
     # The character encoding for the email.
     CHARSET = "UTF-8"
 
-    # Create a new SES resource and specify a region.
-    client = boto3.client('ses',region_name=region)
+    # SES client for the region, reused across warm invocations
+    client = aws_clients.get_client('ses', region)
 
     # Try to send the email.
     try:
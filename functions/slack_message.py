@@ -1,5 +1,5 @@
-from botocore.vendored import requests
-import json, boto3, base64, ast, os
+import json, os
+import identity_cache, directory_index, ldap_lookup
 
 # Global variables used for slack channel access
 ACCESS_TOKEN = os.environ.get("oauth_access_token")
@@ -57,75 +57,29 @@ def lambda_handler(event, context):
 
 def tag_name(nt_id, url, channel):
     """
-    # searches for a slack id through nt_id and invites them
+    # searches for a slack id through nt_id and invites them. The directory index is
+    # read first, and the email, slack id and invite are cached, so repeat owners
+    # cost no LDAP, Secrets Manager or Slack calls
     :param nt_id: the id of the user for slack
     :param url: the url of the slack application
     :param channel: the channel to invite users to
     :return: slack id
     """
-    secret = json.loads(get_secret())
-    username = secret['account_name']
-    pw = secret['password']
-    data = {
-                "domain": "corporate.t-mobile.com",
-                "base_dname": "OU=Production,OU=Users,OU=Accounts,DC=Corporate,DC=T-Mobile,DC=com",
-                "bind_dname": "CN=%s,OU=LDAPS,OU=Non-production,OU=Services,OU=Accounts,DC=corporate,DC=t-mobile,DC=com" % username,
-                "password": pw,
-                "obj_name": nt_id,
-                "obj_class": "user",
-                "attributes": ["mail"],
-            }
-    lambda_client = boto3.client('lambda')
-    invoke_response = lambda_client.invoke(
-        FunctionName= os.environ.get("query_ldap"),
-        InvocationType= "RequestResponse",
-        Payload= json.dumps(data)
-    )
-    if ("FunctionError" not in invoke_response):
-        data = ast.literal_eval(json.load(invoke_response['Payload'])['body'])
-        print(data)
-        email = data[0][0][1]['mail'][0]
-        print("data returned from ldap query: "),
-        print(data)
+    index = directory_index.get_index()
+    entry = (index.lookup(nt_id) if index is not None else None) or {}
+    email = entry.get('mail') or identity_cache.get_cache('email').resolve_many([nt_id], ldap_lookup.lookup_emails).get(nt_id)
+    if email:
         print("email of nt_id: " + email)
-        slack_id = get_user_id(email, HEADERS, TOKEN)
+        slack_id = entry.get('slack_id') or \
+            identity_cache.get_cache('slack_id').resolve(email, lambda email: get_user_id(email, HEADERS, TOKEN))
         if slack_id:
-            invite_user(slack_id, channel)
+            identity_cache.get_cache('slack_invite').resolve(channel + '#' + slack_id,
+                lambda key: invite_user(slack_id, channel))
             return "<@" + slack_id + ">"   
 
     return nt_id
 
 
-def get_secret():
-    """
-    # gets the secret from AWS secrets manager
-    :param N/A:
-    :return: the secrets value or None if not found
-    """
-
-    secret_name = "Jido-Active-Directory-Service-Account"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name= os.environ.get("AWS_DEFAULT_REGION")
-    )
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId= secret_name
-        )
-    except ClientError as e:
-        print("Error getting secret key!: " + str(e))
-        return None
-    else:
-        # Decrypts secret using the associated KMS CMK.
-        if 'SecretString' in get_secret_value_response:
-            return get_secret_value_response['SecretString']
-
-    return None
-
-
 def get_user_id(email, headers, token):
     """
     # gets the slack id from a given email
@@ -135,12 +89,17 @@ def get_user_id(email, headers, token):
     :return: the slack_id
     """
 
+    from botocore.vendored import requests
     payload = { 'token': token, 'email': email}
     response = requests.get('https://slack.com/api/users.lookupByEmail', headers=headers, params=payload)
     if response.ok:
-        return response.json()['user']['id']
-    
-    return None
+        body = response.json()
+        if body.get('ok') is False:
+            # no slack user has this email
+            return None
+        return body['user']['id']
+
+    raise ValueError("Slack lookup failed with status " + str(response.status_code))
 
 
 def checkMember(member_id, name, headers, token):
@@ -153,6 +112,7 @@ def checkMember(member_id, name, headers, token):
     :return: true if the member matches the name
     """
 
+    from botocore.vendored import requests
     payload = { 'token' : token, 'user' : member_id }
     response = requests.get('https://slack.com/api/users.info', headers=headers, params=payload)
     print (response.json()["user"]["name"])
@@ -171,6 +131,7 @@ def send_message(application_url, channel, message):
     :return: N/A
     """
 
+    from botocore.vendored import requests
     headers = {
         'Content-type': 'application/json',
     }
@@ -185,12 +146,21 @@ def invite_user(slack_id, channel):
     # invites a user to a channel
     :param slack_id: the id of the user to invite
     :param channel: the channel to invite to
-    :return: N/A
+    :return: True once the user is in the channel, raises when the invite failed so it is not cached
     """
+
+    from botocore.vendored import requests
     data = {
         'token': ACCESS_TOKEN,
         'channel': channel,
         'user': slack_id
     }
     response = requests.post("https://slack.com/api/channels.invite", headers= HEADERS, data=data)
-    print(response.text)
\ No newline at end of file
+    print(response.text)
+    if response.ok:
+        body = response.json()
+        if body.get('ok') or body.get('error') == 'already_in_channel':
+            return True
+        raise ValueError("Slack invite failed: " + str(body.get('error')))
+
+    raise ValueError("Slack invite failed with status " + str(response.status_code))
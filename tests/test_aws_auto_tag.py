@@ -0,0 +1,46 @@
+import boto3
+import aws_clients, aws_auto_tag, fake_aws
+
+
+def autoscaling(groups, writes):
+    # groups: dict of group name to dict of tag key to value, writes collects the CreateOrUpdateTags calls
+    def describe(params):
+        return {'AutoScalingGroups': [
+            {'AutoScalingGroupName': name, 'Tags': [{'Key': key, 'Value': value, 'PropagateAtLaunch': True}
+                                                    for key, value in groups[name].items()]}
+            for name in params['AutoScalingGroupNames'] if name in groups]}
+
+    def create(params):
+        writes.extend(params['Tags'])
+        return {}
+
+    client = boto3.client('autoscaling')
+    fake_aws.FakeService({'DescribeAutoScalingGroups': describe, 'CreateOrUpdateTags': create}).attach(client)
+    aws_clients.set_client('autoscaling', client)
+
+
+def instance(instance_id, expiration):
+    return {'InstanceId': instance_id, 'Tags': [{'Key': 'Expiration', 'Value': expiration}]}
+
+
+def test_group_tagged_from_first_described_instance():
+    writes = []
+    autoscaling({'web': {}}, writes)
+    try:
+        failed = aws_auto_tag.tag_groups({'web': ['i-1', 'i-2']}, {'i-2': instance('i-2', '2030-01-01')}, {})
+    finally:
+        aws_clients.reset()
+    assert failed == []
+    assert [(tag['ResourceId'], tag['Key'], tag['Value']) for tag in writes] == [('web', 'Expiration', '2030-01-01')]
+
+
+def test_group_failed_when_no_instance_described():
+    writes = []
+    autoscaling({'web': {}, 'api': {}}, writes)
+    try:
+        failed = aws_auto_tag.tag_groups({'web': ['i-1'], 'api': ['i-3']}, {'i-3': instance('i-3', '2030-01-01')}, {})
+    finally:
+        aws_clients.reset()
+    # the claim of web is given back, so its suppressed launches are retried instead of waiting out the window
+    assert failed == ['web']
+    assert [tag['ResourceId'] for tag in writes] == ['api']
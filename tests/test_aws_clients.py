@@ -0,0 +1,36 @@
+import pytest
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+import aws_clients, aws_executor
+
+THROTTLED = (b'<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message>'
+             b'</Error></Errors><RequestID>1</RequestID></Response>')
+
+
+class Raw(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_throttle_reaches_executor_on_first_attempt():
+    aws_clients.reset()
+    sent = []
+
+    def throttle(request, **kwargs):
+        # answers below botocore's retry handler, so its retries would show up as extra sends
+        sent.append(request)
+        return AWSResponse(request.url, 503, {}, Raw(THROTTLED))
+
+    client = aws_clients.get_client('ec2')
+    client.meta.events.register('before-send.ec2.DescribeInstances', throttle)
+    executor = aws_executor.CallExecutor(max_attempts=1)
+    try:
+        with pytest.raises(ClientError):
+            executor.call(client, 'describe_instances')
+    finally:
+        aws_clients.reset()
+    assert len(sent) == 1
+    assert executor.stats['ec2.describe_instances']['throttles'] == 1
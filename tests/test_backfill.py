@@ -0,0 +1,74 @@
+import boto3
+import aws_clients, backfill, fake_aws, kv_store
+
+ARNS = ["arn:aws:ec2:us-east-1:123456789012:image/ami-%08x" % number for number in range(6)]
+
+
+def tagging(pages, tagged, failing):
+    # pages of ARNs answered in order, tagged collects the ARNs written, failing are reported in FailedResourcesMap
+    def get_resources(params):
+        start = int(params.get('PaginationToken') or 0)
+        response = {'ResourceTagMappingList': [{'ResourceARN': arn, 'Tags': []} for arn in pages[start]]}
+        if start + 1 < len(pages):
+            response['PaginationToken'] = str(start + 1)
+        return response
+
+    def tag_resources(params):
+        failed = dict((arn, {'StatusCode': 500, 'ErrorCode': 'InternalServiceException', 'ErrorMessage': 'failed'})
+                      for arn in params['ResourceARNList'] if arn in failing)
+        tagged.extend(arn for arn in params['ResourceARNList'] if arn not in failed)
+        return {'FailedResourcesMap': failed}
+
+    client = boto3.client('resourcegroupstaggingapi')
+    fake_aws.FakeService({'GetResources': get_resources, 'TagResources': tag_resources}).attach(client)
+    aws_clients.set_client('resourcegroupstaggingapi', client)
+
+
+def compute(resources):
+    return dict((resource['ResourceARN'], [{'Key': 'Expiration', 'Value': '2030-01-01'}]) for resource in resources)
+
+
+class Pages(object):
+    # deadline stand-in letting a run scan a fixed number of pages
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __call__(self):
+        self.pages -= 1
+        return self.pages < 0
+
+
+def run(store, enforce, pages=None):
+    job = backfill.Backfill(compute, store, ['ec2:image'], workers=1, enforce=enforce)
+    if pages is not None:
+        job._out_of_time = Pages(pages)
+    return job.run()
+
+
+def test_audit_checkpoint_does_not_move_enforce(tmp_path):
+    tagged = []
+    tagging([ARNS[:3], ARNS[3:]], tagged, set())
+    store = kv_store.SqliteStore('backfill', str(tmp_path / 'kv.sqlite3'))
+    try:
+        assert not run(store, False, pages=1)['complete']
+        result = run(store, True)
+    finally:
+        aws_clients.reset()
+    assert result['complete']
+    assert sorted(tagged) == ARNS
+
+
+def test_failed_resources_retried_next_run(tmp_path):
+    tagged = []
+    failing = set([ARNS[1]])
+    tagging([ARNS[:3], ARNS[3:]], tagged, failing)
+    store = kv_store.SqliteStore('backfill', str(tmp_path / 'kv.sqlite3'))
+    try:
+        first = run(store, True, pages=1)
+        failing.clear()
+        second = run(store, True)
+    finally:
+        aws_clients.reset()
+    assert (first['tagged'], first['failed'], first['complete']) == (2, 1, False)
+    assert (second['tagged'], second['failed'], second['complete']) == (6, 0, True)
+    assert sorted(tagged) == ARNS
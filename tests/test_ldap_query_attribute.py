@@ -0,0 +1,14 @@
+import pytest
+
+ldap_query_attribute = pytest.importorskip('ldap_query_attribute', exc_type=ImportError)
+
+
+def test_export_without_location(monkeypatch):
+    monkeypatch.delenv('directory_index', raising=False)
+    exported = []
+    monkeypatch.setattr(ldap_query_attribute.POOL, 'run', lambda *args: exported.append(args))
+    response = ldap_query_attribute.exportIndex('corp.example.com', 'OU=Users,DC=corp', 'CN=svc', 'secret', 'user', None)
+    assert response['statusCode'] == 500
+    assert 'directory_index' in response['body']
+    # nothing is searched for an export that could not be published
+    assert exported == []